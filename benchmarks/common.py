@@ -0,0 +1,102 @@
+"""Helpers shared by the benchmarks: realistic payloads, a scratch database wired into ``main.app`` and latency stats."""
+import os
+import random
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from main import app
+from src import migrations, models
+from src.catalog import flight_cache
+from src.seats import seat_maps
+from src.database import get_db, make_engine
+
+
+BENCH_USER = ("bench", "bench")
+
+FIRST_NAMES = ["Kirill", "Clara", "Jan", "Eva", "Tomas", "Lucie", "Martin", "Anna", "Petr", "Jana", "Oliver", "Mia"]
+LAST_NAMES = ["Rass", "Davis", "Novak", "Svoboda", "Dvorak", "Smith", "Miller", "Horak", "Wilson", "Kral"]
+AIRLINES = ["United Airlines", "Czech Airlines", "Lufthansa", "Ryanair", "Air France", "KLM Royal Dutch"]
+AIRPORTS = ["PRG", "LHR", "CDG", "FRA", "AMS", "SFO", "SEA", "JFK", "BCN", "VIE", "WAW", "BUD"]
+TRAVEL_CLASSES = ["economy"] * 8 + ["business"] * 3 + ["first"]
+STATUSES = ["confirmed"] * 6 + ["pending"] * 3 + ["cancelled"]
+
+
+def reservation_payload(i: int, rng: random.Random, flights: int = 200) -> dict:
+    """Reservation for passenger ``i`` on one of ``flights`` flights, so flights are shared like in production.
+
+    Passengers sharing a flight get different seats, for up to 2600 passengers per flight.
+    """
+    flight = i % flights
+    seat_row, seat_letter = divmod(i // flights % 2600, 26)
+    flight_rng = random.Random(flight)
+    origin, destination = flight_rng.sample(AIRPORTS, 2)
+    departure = datetime(2025, 1, 1, 6) + timedelta(hours=flight_rng.randrange(24 * 365))
+    return {
+        "passenger_info": {
+            "id": i,
+            "full_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            "email": f"passenger{i}@example.com",
+            "phone_number": f"+420{rng.randrange(10 ** 8, 10 ** 9)}"
+        },
+        "flight_details": {
+            "flight_number": f"BN{flight}",
+            "airline": flight_rng.choice(AIRLINES),
+            "origin_airport": origin,
+            "destination_airport": destination,
+            "departure_datetime": departure.isoformat(),
+            "arrival_datetime": (departure + timedelta(minutes=flight_rng.randrange(60, 600))).isoformat(),
+            "seat_information": f"{seat_row}{chr(ord('A') + seat_letter)}",
+            "travel_class": rng.choice(TRAVEL_CLASSES)
+        },
+        "total_price": round(rng.uniform(29, 1500), 2),
+        "reservation_status": rng.choice(STATUSES)
+    }
+
+
+@asynccontextmanager
+async def scratch_database(database_url: str = None):
+    """Point ``main.app`` at a freshly migrated database with a ``bench``/``bench`` user for the block."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = make_engine(database_url or f"sqlite+aiosqlite:///{os.path.join(tmp_dir, 'bench.db')}")
+        session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(migrations.upgrade)
+        async with session_factory() as db:
+            db.add(models.AuthUser(username=BENCH_USER[0], password=models.hash_password(BENCH_USER[1])))
+            await db.commit()
+
+        async def override_get_db():
+            async with session_factory() as db:
+                yield db
+
+        app.dependency_overrides[get_db] = override_get_db
+        flight_cache.clear()
+        seat_maps.clear()
+        try:
+            yield engine
+        finally:
+            app.dependency_overrides.pop(get_db, None)
+            flight_cache.clear()
+            seat_maps.clear()
+            await engine.dispose()
+
+
+def percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    in_ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "mean_ms": in_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": in_ms(percentile(latencies, 0.50)),
+        "p95_ms": in_ms(percentile(latencies, 0.95)),
+        "p99_ms": in_ms(percentile(latencies, 0.99)),
+    }
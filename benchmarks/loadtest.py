@@ -0,0 +1,215 @@
+"""Load test of the reservation API with per-endpoint throughput and latency percentiles.
+
+By default drives ``main.app`` in-process through an ASGI transport against a scratch database
+(``--database-url`` to use another one); ``--base-url`` targets a running server instead. Results are written
+as JSON so runs can be compared. Run from the repo root:
+
+    python -m benchmarks.loadtest --concurrency 10 --requests 500 --seed 5000
+    python -m benchmarks.loadtest --base-url http://127.0.0.1:8000 --auth kirill:mypass
+    python -m benchmarks.loadtest --compare benchmarks/results/loadtest-<before>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from contextlib import nullcontext
+from datetime import datetime
+import httpx
+from main import app
+from benchmarks.common import BENCH_USER, reservation_payload, scratch_database, summarize
+
+
+ENDPOINTS = ("create", "list", "get", "update", "delete", "auth_failure")
+SEED_BATCH = 500
+
+
+class LoadTest:
+
+    def __init__(
+            self, client: httpx.AsyncClient, username: str, concurrency: int, requests: int, seed: int,
+            page_size: int, id_base: int = 0
+    ):
+        self.client = client
+        self.username = username
+        self.concurrency = concurrency
+        self.requests = requests
+        self.seed = seed
+        self.page_size = page_size
+        self.rng = random.Random(42)
+        self.next_passenger = id_base
+        self.payloads = {}
+        self.created = []
+
+    def _new_payload(self):
+        self.next_passenger += 1
+        return reservation_payload(self.next_passenger, self.rng)
+
+    async def seed_reservations(self):
+        started = time.perf_counter()
+        for offset in range(0, self.seed, SEED_BATCH):
+            batch = [self._new_payload() for _ in range(min(SEED_BATCH, self.seed - offset))]
+            response = await self.client.post("/reservations/batch", json=batch)
+            response.raise_for_status()
+            for payload, result in zip(batch, response.json()):
+                if 'id' in result:
+                    self.payloads[result['id']] = payload
+        return time.perf_counter() - started
+
+    async def _run(self, make_request, expected_status: int = 200, total: int = None):
+        pending = iter(range(self.requests if total is None else total))
+        latencies = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for i in pending:
+                started = time.perf_counter()
+                try:
+                    response = await make_request(i)
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != expected_status:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+    async def create(self):
+        async def request(i):
+            response = await self.client.post("/reservations", json=self._new_payload())
+            if response.status_code == 200:
+                self.created.append(response.json()['id'])
+            return response
+        return await self._run(request)
+
+    async def list(self):
+        return await self._run(lambda i: self.client.get("/reservations", params={'limit': self.page_size}))
+
+    async def get(self):
+        ids = list(self.payloads)
+        return await self._run(lambda i: self.client.get(f"/reservations/{self.rng.choice(ids)}"))
+
+    async def update(self):
+        ids = list(self.payloads)
+
+        async def request(i):
+            reservation_id = self.rng.choice(ids)
+            payload = dict(self.payloads[reservation_id])
+            payload['reservation_status'] = self.rng.choice(['confirmed', 'pending', 'cancelled'])
+            return await self.client.put(f"/reservations/{reservation_id}", json=payload)
+        return await self._run(request)
+
+    async def delete(self):
+        ids = list(self.created)
+        return await self._run(lambda i: self.client.delete(f"/reservations/{ids[i]}"), total=len(ids))
+
+    async def auth_failure(self):
+        return await self._run(
+            lambda i: self.client.get("/reservations", auth=(self.username, 'wrong password')),
+            expected_status=401
+        )
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, baseline: dict = None):
+    header = f"{'endpoint':<14}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}"
+    print(header + (f"{'req/s Δ':>10}{'p95 Δ':>9}" if baseline else ""))
+    for endpoint, stats in results['endpoints'].items():
+        line = (
+            f"{endpoint:<14}{stats['throughput_rps'] or 0:>9.1f}{stats['p50_ms'] or 0:>9.1f}"
+            f"{stats['p95_ms'] or 0:>9.1f}{stats['p99_ms'] or 0:>9.1f}{stats['errors']:>8}"
+        )
+        before = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if before and before['throughput_rps'] and before['p95_ms']:
+            line += f"{(stats['throughput_rps'] / before['throughput_rps'] - 1) * 100:>+9.0f}%"
+            line += f"{(stats['p95_ms'] / before['p95_ms'] - 1) * 100:>+8.0f}%"
+        print(line)
+
+
+async def run(args) -> dict:
+    auth = tuple(args.auth.split(':', 1)) if args.auth else BENCH_USER
+    if args.base_url:
+        database = nullcontext()
+        client_kwargs = {'base_url': args.base_url}
+    else:
+        database = scratch_database(args.database_url)
+        client_kwargs = {'base_url': "http://bench", 'transport': httpx.ASGITransport(app=app)}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with database:
+        async with httpx.AsyncClient(auth=auth, timeout=60, limits=limits, **client_kwargs) as client:
+            load_test = LoadTest(
+                client, auth[0], args.concurrency, args.requests, args.seed, args.page_size, args.id_base
+            )
+            seed_seconds = await load_test.seed_reservations()
+            endpoints = {}
+            for endpoint in args.endpoints:
+                endpoints[endpoint] = await getattr(load_test, endpoint)()
+    return {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            "target": args.base_url or "in-process",
+            "database_url": None if args.base_url else args.database_url or "sqlite (scratch)",
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "seed": args.seed,
+            "page_size": args.page_size,
+        },
+        "seed_seconds": round(seed_seconds, 2),
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--seed", type=int, default=2000, help="reservations created before measuring")
+    parser.add_argument("--page-size", type=int, default=50, help="limit used by the list endpoint")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--base-url", help="load test a running server instead of the in-process app")
+    parser.add_argument("--auth", help="user:password, required with --base-url")
+    parser.add_argument("--id-base", type=int, help="first passenger id, defaults to a per-run offset with --base-url")
+    parser.add_argument("--database-url", help="database of the in-process app, a scratch SQLite file by default")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "results"), help="directory for the JSON")
+    parser.add_argument("--compare", help="earlier results JSON to print deltas against")
+    args = parser.parse_args()
+    if args.base_url and not args.auth:
+        parser.error("--auth is required with --base-url")
+    if 'delete' in args.endpoints and 'create' not in args.endpoints:
+        parser.error("delete removes the reservations made by create")
+    if args.id_base is None:
+        # passengers are created with explicit ids, keep runs against the same server from colliding
+        args.id_base = int(time.time()) % 100_000 * 10_000 if args.base_url else 0
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Cost of serializing 1k reservations: ORM objects + pydantic + stdlib JSON versus Core rows + orjson.
+
+Both paths load the same reservations from a scratch SQLite database. Run from the repo root:
+
+    python -m benchmarks.serialization --reservations 1000 --repeat 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import orjson
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import models, schemas
+from src.serialization import reservation_from_row, reservation_rows
+from benchmarks.common import reservation_payload, scratch_database
+
+
+async def _seed(db: AsyncSession, total: int):
+    rng = random.Random(0)
+    payloads = [reservation_payload(i, rng) for i in range(1, total + 1)]
+    flights = {p['flight_details']['flight_number']: p['flight_details'] for p in payloads}
+    flight_ids = {row.flight_number: row.id for row in await db.execute(
+        insert(models.FlightDetails).returning(models.FlightDetails.id, models.FlightDetails.flight_number),
+        [schemas.FlightDetails(**flight).model_dump() for flight in flights.values()]
+    )}
+    await db.execute(insert(models.PassengerInfo), [p['passenger_info'] for p in payloads])
+    await db.execute(insert(models.Reservation), [{
+        'total_price': p['total_price'],
+        'reservation_status': p['reservation_status'],
+        'passenger_info_id': p['passenger_info']['id'],
+        'flight_details_id': flight_ids[p['flight_details']['flight_number']],
+        'auth_user_id': 1,
+    } for p in payloads])
+    await db.commit()
+
+
+def _orm_path(reservations) -> bytes:
+    # what the endpoints did before: validate into the schema, jsonable_encoder, stdlib json
+    content = jsonable_encoder([schemas.ReservationOut.model_validate(reservation) for reservation in reservations])
+    return json.dumps(content, separators=(',', ':')).encode()
+
+
+def _fast_path(rows) -> bytes:
+    return orjson.dumps([reservation_from_row(row) for row in rows])
+
+
+async def _timed(repeat: int, run):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await run()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+async def main(total: int, repeat: int):
+    async with scratch_database() as engine:
+        async with AsyncSession(engine) as db:
+            await _seed(db, total)
+        orm_query = select(models.Reservation).order_by(models.Reservation.id)
+        rows_query = reservation_rows().order_by(models.Reservation.id)
+
+        async def orm_load():
+            async with AsyncSession(engine) as db:
+                return (await db.scalars(orm_query)).all()
+
+        async def rows_load():
+            async with AsyncSession(engine) as db:
+                return (await db.execute(rows_query)).all()
+
+        reservations, rows = await orm_load(), await rows_load()
+        assert json.loads(_orm_path(reservations)) == json.loads(_fast_path(rows))
+
+        async def orm_serialize():
+            _orm_path(reservations)
+
+        async def fast_serialize():
+            _fast_path(rows)
+
+        async def orm_end_to_end():
+            _orm_path(await orm_load())
+
+        async def fast_end_to_end():
+            _fast_path(await rows_load())
+
+        per_1k = 1000 / total * 1000
+        print(f"{total} reservations, best of {repeat}, ms per 1k reservations")
+        print(f"{'':<22}{'serialize':>12}{'load + serialize':>18}")
+        for name, serialize, end_to_end in (
+                ("ORM + pydantic + json", orm_serialize, orm_end_to_end),
+                ("Core rows + orjson", fast_serialize, fast_end_to_end),
+        ):
+            print(
+                f"{name:<22}{await _timed(repeat, serialize) * per_1k:>12.1f}"
+                f"{await _timed(repeat, end_to_end) * per_1k:>18.1f}"
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reservations", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.reservations, args.repeat))
@@ -0,0 +1,63 @@
+"""Throughput of the reservation API at 1/10/100 concurrent clients.
+
+Drives ``main.app`` in-process through an ASGI transport against a scratch
+SQLite database, so nothing touches ``local.db``. Run from the repo root:
+
+    python -m benchmarks.throughput --requests 500
+"""
+import argparse
+import asyncio
+import random
+import time
+import httpx
+from main import app
+from benchmarks.common import BENCH_USER, percentile, reservation_payload, scratch_database
+
+
+CONCURRENCY_LEVELS = (1, 10, 100)
+
+
+async def _run(client: httpx.AsyncClient, clients: int, total: int, make_request):
+    pending = iter(range(total))
+    latencies = []
+
+    async def worker():
+        for i in pending:
+            started = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return total / elapsed, percentile(latencies, 0.99) * 1000
+
+
+async def main(total: int):
+    rng = random.Random(0)
+    async with scratch_database():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", auth=BENCH_USER) as client:
+            offset = 0
+            print(f"{'endpoint':<28}{'clients':>8}{'req/s':>10}{'p99 ms':>10}")
+            for clients in CONCURRENCY_LEVELS:
+                base = offset
+                rps, p99 = await _run(
+                    client, clients, total,
+                    lambda c, i: c.post("/reservations", json=reservation_payload(base + i + 1, rng))
+                )
+                print(f"{'POST /reservations':<28}{clients:>8}{rps:>10.0f}{p99:>10.1f}")
+                rps, p99 = await _run(
+                    client, clients, total * 2,
+                    lambda c, i: c.get(f"/reservations/{base + i % total + 1}")
+                )
+                print(f"{'GET /reservations/{id}':<28}{clients:>8}{rps:>10.0f}{p99:>10.1f}")
+                offset += total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="requests per concurrency level")
+    asyncio.run(main(parser.parse_args().requests))
@@ -1,38 +1,77 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, Body, WebSocket
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 import uvicorn
-from sqlalchemy.orm import Session
-from src import models, schemas
-from src.database import get_db
+from sqlalchemy import select, insert, update, and_, or_, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import bulk, conditional, export, feed, idempotency, metrics, models, schemas, seats
+from src.reporting import REPORT_DIMENSIONS, SummaryDelta, report_query
+from src.search import ReservationSearch
+from src.serialization import dumps_ndjson, reservation_from_row, reservation_rows
+from src.database import get_db, init_db, dialect_insert, make_engine, make_session_factory, sync_id_sequence
 from datetime import datetime
-from sqlalchemy.exc import IntegrityError
-from typing import Annotated
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from src.email_notify import notify_user
+from typing import Annotated, Any, Literal
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
+from src.auth import credentials_cache, get_auth_user_username, get_websocket_user
+from src.catalog import cache_flight, flight_cache, invalidate_flights
+from src.email_notify import coalesce_notification, enqueue_notification, notification_dispatcher
+from src.feed import change_feed
+from src.settings import settings
 
-app = FastAPI()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # runs in every worker process: connections, the HTTP client and cached state are never shared between them
+    engine = make_engine()
+    app.state.engine = engine
+    app.state.session_factory = make_session_factory(engine)
+    credentials_cache.clear()
+    flight_cache.clear()
+    seats.seat_maps.clear()
+    if settings.migrate_on_startup:
+        await init_db(engine)
+    await notification_dispatcher.start(app.state.session_factory)
+    await change_feed.start(app.state.session_factory)
+    app.state.ready = True
+    yield
+    # the server stopped accepting connections and waited for in-flight requests before getting here
+    app.state.ready = False
+    await change_feed.stop()
+    await notification_dispatcher.stop()
+    await engine.dispose()
 
-security = HTTPBasic()
 
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.registry.add_collector(metrics.cache_collector(
+    {'flights': flight_cache, 'seat_maps': seats.seat_maps, 'credentials': credentials_cache}
+))
 
-def get_auth_user_username(
-    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
-    db: Session = Depends(get_db)
-):
-    unauthorised_except = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Invalid username or password",
-        headers={"WWW-Authenticate": "Basic"}
-    )
-    user = db.query(models.AuthUser).filter(models.AuthUser.username == credentials.username).first()
-    if not user:
-        raise unauthorised_except
-    if not credentials.password == user.decode_pass():
-        raise unauthorised_except
-    return {
-        'username': credentials.username,
-        'id': user.id
-    }
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    # Prometheus text exposition format, scraped without credentials
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health/live", include_in_schema=False)
+def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness(request: Request, db: AsyncSession = Depends(get_db)):
+    if not getattr(request.app.state, 'ready', False):
+        return ORJSONResponse({"status": "starting or shutting down"}, status_code=503)
+    try:
+        await db.execute(text("SELECT 1"))
+    except (OSError, SQLAlchemyError):
+        return ORJSONResponse({"status": "database unavailable"}, status_code=503)
+    return {"status": "ok"}
 
 
 @app.get("/basic-auth")
@@ -44,146 +83,658 @@ def basic_authorise_user(
     }
 
 
-def _check_and_create(model, model_attr: str, new_resrvtn, new_attr: str, new_attr_id: str, db: Session):
-    db_obj = db.query(model).filter(
-        getattr(model, model_attr) == getattr(getattr(new_resrvtn, new_attr), new_attr_id)
-    ).first()
-    if not db_obj:
-        db_obj = model(**getattr(new_resrvtn, new_attr).dict())
-        db.add(db_obj)
-        db.commit()
-        db.refresh(db_obj)
-    return db_obj
+@app.get("/cache-stats")
+def get_cache_stats(
+    auth_user: dict = Depends(get_auth_user_username)
+):
+    return {
+        "flights": flight_cache.stats(),
+        "seat_maps": seats.seat_maps.stats(),
+        "credentials": credentials_cache.stats(),
+    }
+
+
+async def _check_and_create(model, model_attr: str, values: dict, db: AsyncSession):
+    if values.get(model_attr) is None:
+        # nothing to conflict on, the database assigns the id
+        return (await db.execute(insert(model).values(**values).returning(*model.__table__.columns))).one()
+    # upsert that resolves to the existing row on conflict, in one round trip and without a separate SELECT
+    stmt = dialect_insert(db, model).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model_attr], set_={model_attr: getattr(stmt.excluded, model_attr)}
+    ).returning(*model.__table__.columns)
+    row = (await db.execute(stmt)).one()
+    if model_attr == 'id':
+        await sync_id_sequence(db, model)
+    return row
 
 
 @app.post("/reservations")
-@notify_user('created')
 async def create_reservation(
         reservation: schemas.Reservation,
-        db: Session = Depends(get_db),
+        idempotency_key: str = Header(
+            None, max_length=idempotency.IDEMPOTENCY_KEY_MAX_LENGTH,
+            description="Retries sent with the same key get the response of the first request, which runs once"
+        ),
+        db: AsyncSession = Depends(get_db),
         auth_user: dict = Depends(get_auth_user_username),
 ):
-    existing_reservation = db.query(models.Reservation).join(models.FlightDetails).filter(
-        models.Reservation.passenger_info_id == reservation.passenger_info.id,
-        models.FlightDetails.flight_number == reservation.flight_details.flight_number
-    ).first()
-    if existing_reservation:
-        raise HTTPException(status_code=400, detail="Reservation already exists for this passenger and flight.")
-    passenger = _check_and_create(models.PassengerInfo, 'id', reservation, 'passenger_info', 'id', db)
-    flight = _check_and_create(
-        models.FlightDetails, 'flight_number', reservation, 'flight_details', 'flight_number', db
-    )
-    # Create a new Reservation record
-    new_reservation = models.Reservation(
-        total_price=reservation.total_price,
-        reservation_status=reservation.reservation_status,
-        passenger_info_id=passenger.id,
-        flight_details_id=flight.id,
-        auth_user_id=auth_user['id']
-    )
-    db.add(new_reservation)
-    db.commit()
-    db.refresh(new_reservation)
-    db.refresh(new_reservation.flight_details)
-    db.refresh(new_reservation.passenger_info)
-    return schemas.ReservationOut.model_validate(new_reservation), True
+    seat = seats.canonical_seat(reservation.flight_details.seat_information)
+    holds_seat = seats.holds_seat(reservation.reservation_status)
+    if idempotency_key is not None:
+        fingerprint = idempotency.request_hash(reservation.model_dump(mode='json'))
+        if not await idempotency.claim(db, auth_user['id'], idempotency_key, fingerprint):
+            return await idempotency.replay(db, auth_user['id'], idempotency_key, fingerprint)
+    try:
+        flight = flight_cache.get(reservation.flight_details.flight_number)
+        flight_cached = flight is not None
+        if not flight_cached:
+            flight = await _check_and_create(
+                models.FlightDetails, 'flight_number', reservation.flight_details.model_dump(), db
+            )
+        if holds_seat and (await seats.seat_map(db, flight.id)).is_taken(seat):
+            raise await _refuse_seat(db, reservation.passenger_info.id, flight, seat)
+        passenger = await _check_and_create(
+            models.PassengerInfo, 'id', reservation.passenger_info.model_dump(exclude_none=True), db
+        )
+        # Create a new Reservation record, the unique (passenger, flight) index rejects duplicates
+        new_reservation = (await db.execute(dialect_insert(db, models.Reservation).values(
+            total_price=reservation.total_price,
+            reservation_status=reservation.reservation_status,
+            passenger_info_id=passenger.id,
+            flight_details_id=flight.id,
+            auth_user_id=auth_user['id'],
+            seat_information=seat,
+        ).on_conflict_do_nothing(
+            index_elements=['passenger_info_id', 'flight_details_id']
+        ).returning(*models.Reservation.__table__.columns))).one_or_none()
+        if new_reservation is None:
+            await db.rollback()
+            raise _already_exists()
+        # the seat map may be stale, the primary key of seat_assignments decides
+        if holds_seat and not await seats.hold_seat(db, flight.id, seat, new_reservation.id):
+            await db.rollback()
+            raise _seat_taken(seat, flight.flight_number)
+        enqueue_notification(
+            db, passenger, flight, new_reservation.reservation_status, 'created', new_reservation.id
+        )
+        feed.record_event(db, auth_user['id'], new_reservation.id, 'created')
+        summary = SummaryDelta()
+        summary.add(auth_user['id'], flight.id, new_reservation.reservation_status, new_reservation.total_price)
+        await summary.apply(db)
+        created = schemas.ReservationOut(
+            **new_reservation._asdict(),
+            passenger_info=schemas.PassengerInfo.model_validate(passenger),
+            flight_details=schemas.FlightDetails.model_validate(flight).model_copy(update={'seat_information': seat}),
+        )
+        if idempotency_key is not None:
+            await idempotency.complete(db, auth_user['id'], idempotency_key, created.model_dump_json())
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Failed to create reservation: integrity error")
+    if not flight_cached:
+        cache_flight(flight)
+    if holds_seat:
+        seats.mark_taken(flight.id, seat)
+    notification_dispatcher.wake()
+    change_feed.wake()
+    return created
+
+
+def _already_exists():
+    return HTTPException(status_code=400, detail="Reservation already exists for this passenger and flight.")
+
+
+def _seat_taken(seat: str, flight_number: str):
+    return HTTPException(status_code=409, detail=f"Seat {seat} is already taken on flight {flight_number}.")
+
+
+async def _refuse_seat(db: AsyncSession, passenger_id: int | None, flight, seat: str):
+    # a repeated request is reported as the duplicate reservation it is, not as a seat conflict
+    duplicate = passenger_id is not None and await db.scalar(select(models.Reservation.id).filter(
+        models.Reservation.passenger_info_id == passenger_id, models.Reservation.flight_details_id == flight.id
+    ))
+    await db.rollback()
+    return _already_exists() if duplicate else _seat_taken(seat, flight.flight_number)
 
 
-@app.get("/reservations")
+RESERVATIONS_BATCH_MAX = 1000
+
+
+@app.post("/reservations/batch", openapi_extra={
+    # items are validated one by one, so the body is not declared as list[schemas.Reservation]; document them anyway
+    'requestBody': {
+        'content': {'application/json': {'schema': {'items': {'$ref': '#/components/schemas/Reservation'}}}}
+    }
+})
+async def create_reservations_batch(
+        reservations: Annotated[list[Any], Body(max_length=RESERVATIONS_BATCH_MAX)],
+        db: AsyncSession = Depends(get_db),
+        auth_user: dict = Depends(get_auth_user_username),
+):
+    results = [None] * len(reservations)
+    valid = {}
+    for index, item in enumerate(reservations):
+        try:
+            valid[index] = schemas.Reservation.model_validate(item)
+        except ValidationError as e:
+            results[index] = {'index': index, 'error': e.errors(include_url=False, include_context=False)}
+
+    catalog = bulk.Catalog()
+    for number in {r.flight_details.flight_number for r in valid.values()}:
+        flight = flight_cache.get(number)
+        if flight is not None:
+            catalog.flights[number] = flight.id
+    records = [reservation.model_dump(exclude={'id'}) for reservation in valid.values()]
+    try:
+        outcomes = await bulk.create_reservations(db, catalog, auth_user['id'], records, notify=True)
+        await db.commit()
+    except IntegrityError:
+        # a concurrent request created one of the new passengers, flights or seats after they were checked
+        await db.rollback()
+        raise HTTPException(
+            status_code=409, detail="Reservations were created concurrently, the batch was not applied. Retry it."
+        )
+    created = False
+    for index, record, outcome in zip(valid, records, outcomes):
+        if isinstance(outcome, str) or outcome is None:
+            results[index] = {'index': index, 'error': outcome or bulk.ALREADY_BOOKED}
+            continue
+        results[index] = {'index': index, 'id': outcome}
+        created = True
+        if seats.holds_seat(record['reservation_status']):
+            flight = record['flight_details']
+            seats.mark_taken(catalog.flights[flight['flight_number']], seats.canonical_seat(flight['seat_information']))
+    if created:
+        notification_dispatcher.wake()
+        change_feed.wake()
+    return results
+
+
+def _user_reservations(auth_user_id: int):
+    # served by ix_reservations_auth_user_id_id_updated, including the ordering and the keyset range on id
+    return select(models.Reservation).filter(models.Reservation.auth_user_id == auth_user_id)
+
+
+def _user_reservation_rows(auth_user_id: int):
+    # flat rows for the read endpoints, serialized without building ORM objects and pydantic models
+    return reservation_rows().filter(models.Reservation.auth_user_id == auth_user_id)
+
+
+RESERVATIONS_PAGE_MAX = 1000
+RESERVATIONS_STREAM_CHUNK = 500
+
+
+async def _stream_reservations(bind, search: ReservationSearch, query, after_id, after_value, limit):
+    # the request's session is closed before the body is sent, and a connection held while a slow client reads would
+    # be missing from the pool: every chunk is a keyset page read on a short session of its own
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = RESERVATIONS_STREAM_CHUNK if remaining is None else min(remaining, RESERVATIONS_STREAM_CHUNK)
+        async with AsyncSession(bind=bind) as db:
+            rows = (await db.execute(search.page(query, after_id, size, after_value))).all()
+        if rows:
+            yield dumps_ndjson(rows)
+        if len(rows) < size:
+            return
+        if remaining is not None:
+            remaining -= len(rows)
+        cursor = search.cursor(reservation_from_row(rows[-1]))
+        after_id, after_value = cursor['after_id'], cursor.get('after_value')
+
+
+@app.get("/reservations", response_model=list[schemas.ReservationOut])
 async def get_reservations(
-        db: Session = Depends(get_db),
+        request: Request,
+        limit: int = Query(None, ge=1, le=RESERVATIONS_PAGE_MAX, description="Page size"),
+        after_id: int = Query(None, ge=0, description="Return reservations after this one in the sort order"),
+        after_value: str = Query(None, description="Sort value of the after_id reservation, set in the Link header"),
+        stream: bool = Query(False, description="Stream the reservations as NDJSON"),
+        search: ReservationSearch = Depends(),
+        db: AsyncSession = Depends(get_db),
         auth_user: dict = Depends(get_auth_user_username),
 ):
-    reservations = db.query(models.Reservation).filter(
-        models.Reservation.auth_user_id == auth_user['id']
-    ).all()
-    return [schemas.ReservationOut.model_validate(reservation) for reservation in reservations]
+    def page(query, joined: bool = False):
+        return search.page(search.apply(query, joined), after_id, limit, after_value)
+
+    total = None
+    if search.include_total:
+        total = await db.scalar(search.count(auth_user['id']))
+    if stream:
+        query = search.apply(_user_reservation_rows(auth_user['id']), joined=True)
+        response = StreamingResponse(
+            _stream_reservations(db.bind, search, query, after_id, after_value, limit),
+            media_type="application/x-ndjson",
+        )
+        if total is not None:
+            response.headers['X-Total-Count'] = str(total)
+        return response
+    if 'if-none-match' in request.headers:
+        # polls of an unchanged page are answered from the reservations index alone; If-Modified-Since is ignored,
+        # the page has no Last-Modified (see src.conditional)
+        validators = _user_reservations(auth_user['id']).with_only_columns(
+            models.Reservation.id, models.Reservation.last_update_timestamp
+        )
+        count, id_sum, last_update = (await db.execute(conditional.page_validators_query(page(validators)))).one()
+        etag = conditional.page_etag(count, id_sum, last_update)
+        if conditional.not_modified(request, etag, None):
+            return conditional.not_modified_response(etag, None)
+    rows = (await db.execute(page(_user_reservation_rows(auth_user['id']), joined=True))).all()
+    reservations = [reservation_from_row(row) for row in rows]
+    response = ORJSONResponse(reservations)
+    conditional.set_validators(response, conditional.page_validator(rows), None)
+    if total is not None:
+        response.headers['X-Total-Count'] = str(total)
+    if limit is not None and len(rows) == limit:
+        next_url = request.url.remove_query_params(['after_id', 'after_value']).include_query_params(
+            **search.cursor(reservations[-1])
+        )
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
 
 
-@app.get("/reservations/{reservation_id}")
+@app.get("/reservations/{reservation_id}", response_model=schemas.ReservationOut)
 async def get_reservation_by_id(
         reservation_id: int,
-        db: Session = Depends(get_db),
+        request: Request,
+        db: AsyncSession = Depends(get_db),
         auth_user: dict = Depends(get_auth_user_username),
 ):
-    reservation = db.query(models.Reservation).filter(
-        models.Reservation.id == reservation_id,
-        models.Reservation.auth_user_id == auth_user['id']
-    ).first()
-    if not reservation:
+    if conditional.is_conditional(request):
+        last_update = await db.scalar(
+            _user_reservations(auth_user['id']).with_only_columns(models.Reservation.last_update_timestamp)
+            .filter(models.Reservation.id == reservation_id)
+        )
+        etag = conditional.reservation_etag(reservation_id, last_update)
+        if last_update is not None and conditional.not_modified(request, etag, last_update):
+            return conditional.not_modified_response(etag, last_update)
+    row = (await db.execute(
+        _user_reservation_rows(auth_user['id']).filter(models.Reservation.id == reservation_id)
+    )).one_or_none()
+    if row is None:
         raise HTTPException(status_code=404, detail="Reservation not found")
-    return schemas.ReservationOut.model_validate(reservation)
+    response = ORJSONResponse(reservation_from_row(row))
+    conditional.set_validators(
+        response, conditional.reservation_etag(row.id, row.last_update_timestamp), row.last_update_timestamp
+    )
+    return response
 
 
-def _check_and_update(
-        model, model_attr: str, orig_db_resvtn, orig_attr: str, new_resvtn, attr_to_check: str, db: Session
-):
+def _check_and_update(model, orig_db_resvtn, new_resvtn, attr_to_check: str, exclude: set = None):
     if getattr(new_resvtn, attr_to_check):
-        db_obj = db.query(model).filter(
-            getattr(model, model_attr) == getattr(orig_db_resvtn, orig_attr)
-        ).first()
+        # related rows are loaded together with the reservation, no need to query them again
+        db_obj = getattr(orig_db_resvtn, attr_to_check)
         if not db_obj:
             raise HTTPException(
                 status_code=404, detail=f"{str(model)} associated with the reservation not found"
             )
-        for attr, val in getattr(new_resvtn, attr_to_check).model_dump().items():
-            setattr(getattr(orig_db_resvtn, attr_to_check), attr, val)
+        for attr, val in getattr(new_resvtn, attr_to_check).model_dump(exclude=exclude).items():
+            setattr(db_obj, attr, val)
+
+
+async def _touch_sharing(db: AsyncSession, shared: list, reservation_id: int, timestamp: datetime):
+    """Mark the other reservations of a changed passenger or flight as updated, ``shared`` selects them."""
+    others = and_(or_(*shared), models.Reservation.id != reservation_id)
+    await db.execute(
+        update(models.Reservation).filter(others)
+        .values(last_update_timestamp=timestamp, version=models.Reservation.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    await feed.record_updates(db, others)
 
 
 @app.put("/reservations/{reservation_id}")
-@notify_user('updated')
 async def update_reservation(
         reservation_id: int,
         reservation: schemas.Reservation,
-        db: Session = Depends(get_db),
+        request: Request,
+        response: Response,
+        db: AsyncSession = Depends(get_db),
         auth_user: dict = Depends(get_auth_user_username),
 ):
-    old_reservation = db.query(models.Reservation).filter(
-        models.Reservation.id == reservation_id,
-        models.Reservation.auth_user_id == auth_user['id']
-    ).first()
+    old_reservation = await db.scalar(
+        _user_reservations(auth_user['id']).filter(models.Reservation.id == reservation_id)
+    )
     if not old_reservation:
         raise HTTPException(status_code=404, detail="Reservation not found")
+    etag = conditional.reservation_etag(reservation_id, old_reservation.last_update_timestamp)
+    if conditional.precondition_failed(request, etag):
+        raise HTTPException(
+            status_code=412, detail="Reservation was modified since it was read.", headers={'ETag': etag}
+        )
+    flight_id, old_flight_number = old_reservation.flight_details_id, old_reservation.flight_details.flight_number
+    old_seat = old_reservation.seat_information or seats.canonical_seat(old_reservation.flight_details.seat_information)
+    new_seat = seats.canonical_seat(reservation.flight_details.seat_information)
+    old_holds = seats.holds_seat(old_reservation.reservation_status)
+    new_holds = seats.holds_seat(reservation.reservation_status)
+    seat_changed = (old_holds, old_seat) != (new_holds, new_seat)
+    # checked before anything is modified, the map may be loaded with a query that would flush the changes
+    if seat_changed and new_holds and (await seats.seat_map(db, flight_id)).is_taken(new_seat):
+        raise _seat_taken(new_seat, old_flight_number)
     # Update PassengerInfo
-    _check_and_update(
-        models.PassengerInfo, 'id', old_reservation, 'passenger_info_id', reservation, 'passenger_info', db
-    )
-    _check_and_update(
-        models.FlightDetails, 'id', old_reservation, 'flight_details_id', reservation, 'flight_details', db
-    )
-    old_status = old_reservation.reservation_status
+    _check_and_update(models.PassengerInfo, old_reservation, reservation, 'passenger_info')
+    # the seat belongs to the reservation, not to the flight shared with other reservations
+    _check_and_update(models.FlightDetails, old_reservation, reservation, 'flight_details', {'seat_information'})
+    old_status, old_price = old_reservation.reservation_status, old_reservation.total_price
+    old_auth_user_id = old_reservation.auth_user_id
     # Update Reservation fields
     for attr, value in reservation.model_dump().items():
         if attr not in ("passenger_info", "flight_details", "id"):
             setattr(old_reservation, attr, value)
     old_reservation.auth_user_id = auth_user['id']
+    old_reservation.seat_information = new_seat
     old_reservation.last_update_timestamp = datetime.now()
+    changed = [
+        relation for relation in ('passenger_info', 'flight_details')
+        if db.is_modified(getattr(old_reservation, relation))
+    ]
+    # other reservations of a changed passenger or flight render differently too, so their ETags have to change
+    shared = [
+        getattr(models.Reservation, f'{relation}_id') == getattr(old_reservation, relation).id for relation in changed
+    ]
+    status_changed = old_reservation.reservation_status != old_status
+    summary = SummaryDelta()
+    summary.remove(old_auth_user_id, old_reservation.flight_details_id, old_status, old_price)
+    summary.add(
+        old_reservation.auth_user_id, old_reservation.flight_details_id,
+        old_reservation.reservation_status, old_reservation.total_price
+    )
+    released = False
+    try:
+        if seat_changed:
+            released = old_holds and await seats.release_seat(db, reservation_id)
+            if new_holds and not await seats.hold_seat(db, flight_id, new_seat, reservation_id):
+                await db.rollback()
+                raise _seat_taken(new_seat, old_flight_number)
+        if shared:
+            await _touch_sharing(db, shared, reservation_id, old_reservation.last_update_timestamp)
+        feed.record_event(db, auth_user['id'], reservation_id, 'updated')
+        if status_changed:
+            await coalesce_notification(
+                db, reservation_id, old_reservation.passenger_info, old_reservation.flight_details,
+                old_reservation.reservation_status
+            )
+        await summary.apply(db)
+        await db.commit()
+    except StaleDataError:
+        # the UPDATE only applies to the version read above, another request changed the reservation in between
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Reservation was modified concurrently, read it and retry.")
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Failed to update reservation: integrity error")
+    if 'flight_details' in changed:
+        invalidate_flights(old_flight_number, old_reservation.flight_details.flight_number)
+    if released:
+        seats.mark_free(flight_id, old_seat)
+    if seat_changed and new_holds:
+        seats.mark_taken(flight_id, new_seat)
+    if status_changed:
+        notification_dispatcher.wake()
+    change_feed.wake()
+    updated = schemas.ReservationOut.model_validate(old_reservation)
+    updated.flight_details.seat_information = new_seat
+    conditional.set_validators(
+        response, conditional.reservation_etag(reservation_id, old_reservation.last_update_timestamp),
+        old_reservation.last_update_timestamp
+    )
+    return updated
+
+
+@app.patch("/reservations/{reservation_id}", response_model=schemas.ReservationOut)
+async def patch_reservation(
+        reservation_id: int,
+        changes: schemas.ReservationPatch,
+        request: Request,
+        db: AsyncSession = Depends(get_db),
+        auth_user: dict = Depends(get_auth_user_username),
+):
+    row = (await db.execute(
+        _user_reservation_rows(auth_user['id']).add_columns(models.Reservation.version)
+        .filter(models.Reservation.id == reservation_id)
+    )).one_or_none()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    etag = conditional.reservation_etag(reservation_id, row.last_update_timestamp)
+    if conditional.precondition_failed(request, etag):
+        raise HTTPException(
+            status_code=412, detail="Reservation was modified since it was read.", headers={'ETag': etag}
+        )
+    current = reservation_from_row(row)
+    patch = changes.model_dump(exclude_none=True)
+    # only the columns whose value changes are written
+    values = {
+        name: value for name, value in patch.items()
+        if name not in ('passenger_info', 'flight_details') and current[name] != value
+    }
+    passenger = {
+        name: value for name, value in patch.get('passenger_info', {}).items()
+        if current['passenger_info'][name] != value
+    }
+    flight = {
+        name: value for name, value in patch.get('flight_details', {}).items()
+        if name != 'seat_information' and current['flight_details'][name] != value
+    }
+    old_seat = seats.canonical_seat(current['flight_details']['seat_information'])
+    new_seat = seats.canonical_seat(patch.get('flight_details', {}).get('seat_information', old_seat))
+    if new_seat != old_seat:
+        values['seat_information'] = new_seat
+    if not (values or passenger or flight):
+        response = ORJSONResponse(current)
+        conditional.set_validators(response, etag, row.last_update_timestamp)
+        return response
+
+    flight_id, old_flight_number = row.flight_details_id, current['flight_details']['flight_number']
+    old_status, old_price = current['reservation_status'], current['total_price']
+    new_status, new_price = values.get('reservation_status', old_status), values.get('total_price', old_price)
+    old_holds, new_holds = seats.holds_seat(old_status), seats.holds_seat(new_status)
+    seat_changed = (old_holds, old_seat) != (new_holds, new_seat)
+    if seat_changed and new_holds and (await seats.seat_map(db, flight_id)).is_taken(new_seat):
+        raise _seat_taken(new_seat, old_flight_number)
+    last_update = datetime.now()
+    released = False
     try:
-        db.commit()
+        # the UPDATE only applies to the version read above, like the ORM's version check of PUT
+        updated = await db.execute(
+            update(models.Reservation)
+            .filter(models.Reservation.id == reservation_id, models.Reservation.version == row.version)
+            .values(**values, last_update_timestamp=last_update, version=models.Reservation.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if updated.rowcount != 1:
+            await db.rollback()
+            raise HTTPException(status_code=409, detail="Reservation was modified concurrently, read it and retry.")
+        shared = []
+        if passenger:
+            await db.execute(
+                update(models.PassengerInfo).filter(models.PassengerInfo.id == row.passenger_info_id).values(passenger)
+            )
+            shared.append(models.Reservation.passenger_info_id == row.passenger_info_id)
+        if flight:
+            await db.execute(update(models.FlightDetails).filter(models.FlightDetails.id == flight_id).values(flight))
+            shared.append(models.Reservation.flight_details_id == flight_id)
+        if shared:
+            await _touch_sharing(db, shared, reservation_id, last_update)
+        if seat_changed:
+            released = old_holds and await seats.release_seat(db, reservation_id)
+            if new_holds and not await seats.hold_seat(db, flight_id, new_seat, reservation_id):
+                await db.rollback()
+                raise _seat_taken(new_seat, old_flight_number)
+        current.update({name: value for name, value in values.items() if name != 'seat_information'})
+        current['passenger_info'].update(passenger)
+        current['flight_details'].update(flight, seat_information=new_seat)
+        current['last_update_timestamp'] = last_update
+        feed.record_event(db, auth_user['id'], reservation_id, 'updated')
+        if new_status != old_status:
+            await coalesce_notification(
+                db, reservation_id, schemas.PassengerInfo.model_construct(**current['passenger_info']),
+                schemas.FlightDetails.model_construct(**current['flight_details']), new_status
+            )
+        summary = SummaryDelta()
+        summary.remove(auth_user['id'], flight_id, old_status, old_price)
+        summary.add(auth_user['id'], flight_id, new_status, new_price)
+        await summary.apply(db)
+        await db.commit()
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail="Failed to update reservation: integrity error")
-    db.refresh(old_reservation)
-    return schemas.ReservationOut.model_validate(old_reservation), old_reservation.reservation_status != old_status
+    if flight:
+        invalidate_flights(old_flight_number, current['flight_details']['flight_number'])
+    if released:
+        seats.mark_free(flight_id, old_seat)
+    if seat_changed and new_holds:
+        seats.mark_taken(flight_id, new_seat)
+    if new_status != old_status:
+        notification_dispatcher.wake()
+    change_feed.wake()
+    response = ORJSONResponse(current)
+    conditional.set_validators(
+        response, conditional.reservation_etag(reservation_id, last_update), last_update
+    )
+    return response
 
 
 @app.delete("/reservations/{reservation_id}", response_model=dict)
 async def delete_reservation(
         reservation_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
         auth_user: str = Depends(get_auth_user_username),
 ):
-    reservation = db.query(models.Reservation).filter(
-        models.Reservation.id == reservation_id,
-        models.Reservation.auth_user_id == auth_user['id']
-    ).first()
+    reservation = await db.scalar(
+        _user_reservations(auth_user['id']).filter(models.Reservation.id == reservation_id)
+    )
     if not reservation:
         raise HTTPException(status_code=404, detail="Reservation not found")
-    db.delete(reservation)
-    db.commit()
-
+    try:
+        released = await seats.release_seat(db, reservation_id)
+        await db.delete(reservation)
+        feed.record_event(db, auth_user['id'], reservation_id, 'deleted')
+        summary = SummaryDelta()
+        summary.remove(
+            reservation.auth_user_id, reservation.flight_details_id, reservation.reservation_status,
+            reservation.total_price
+        )
+        await summary.apply(db)
+        await db.commit()
+    except StaleDataError:
+        # the DELETE only applies to the version read above, the seat, event and summary are rolled back with it
+        await db.rollback()
+        exists = await db.scalar(select(models.Reservation.id).filter(models.Reservation.id == reservation_id))
+        if exists is None:
+            raise HTTPException(status_code=404, detail="Reservation not found")
+        raise HTTPException(status_code=409, detail="Reservation was modified concurrently, read it and retry.")
+    if released:
+        seats.mark_free(reservation.flight_details_id, reservation.seat_information)
+    change_feed.wake()
     return {"message": "Reservation deleted successfully"}
 
 
+@app.get("/flights/{flight_number}/seats")
+async def get_flight_seats(
+        flight_number: str,
+        db: AsyncSession = Depends(get_db),
+        auth_user: dict = Depends(get_auth_user_username),
+):
+    flight = flight_cache.get(flight_number)
+    if flight is None:
+        flight = (await db.execute(
+            select(*models.FlightDetails.__table__.columns).filter(models.FlightDetails.flight_number == flight_number)
+        )).one_or_none()
+        if flight is None:
+            raise HTTPException(status_code=404, detail="Flight not found")
+        cache_flight(flight)
+    # answered from seat_assignments, or from memory while the flight's map is cached
+    seat_map = await seats.seat_map(db, flight.id)
+    return ORJSONResponse({'flight_number': flight.flight_number, **seat_map.as_dict()})
+
+
+@app.get("/feeds/reservations")
+async def reservation_feed(
+        after: int = Query(None, ge=0, description="Replay the events after this sequence number first"),
+        last_event_id: int = Header(None, ge=0, description="Sent by reconnecting EventSource clients, as after"),
+        auth_user: dict = Depends(get_auth_user_username),
+):
+    # nothing held while the stream is open, replays read on sessions of their own
+    events = change_feed.events(
+        auth_user['id'], after if after is not None else last_event_id, heartbeat=feed.FEED_HEARTBEAT
+    )
+    return StreamingResponse(
+        feed.sse_stream(events), media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.websocket("/feeds/reservations")
+async def reservation_feed_websocket(
+        websocket: WebSocket,
+        after: int = Query(None, ge=0, description="Replay the events after this sequence number first"),
+        auth_user: dict = Depends(get_websocket_user),
+):
+    await websocket.accept()
+    await feed.websocket_stream(websocket, change_feed.events(auth_user['id'], after))
+
+
+@app.get("/reports/reservations")
+async def get_reservations_report(
+        group_by: list[Literal[tuple(REPORT_DIMENSIONS)]] = Query(
+            ['flight_number'], description="Dimensions to group by, may be repeated"
+        ),
+        db: AsyncSession = Depends(get_db),
+        auth_user: dict = Depends(get_auth_user_username),
+):
+    group_by = list(dict.fromkeys(group_by))
+    rows = await db.execute(report_query(auth_user['id'], group_by))
+    return ORJSONResponse([
+        {**row._asdict(), 'revenue': round(row.revenue, 2)} for row in rows
+    ])
+
+
+@app.get("/exports/reservations")
+async def export_reservations(
+        export_format: Literal[tuple(export.EXPORT_MEDIA_TYPES)] = Query('csv', alias='format'),
+        gzip: bool = Query(False, description="Compress the export with gzip"),
+        all_users: bool = Query(False, description="Export the reservations of all users, for admins only"),
+        db: AsyncSession = Depends(get_db),
+        auth_user: dict = Depends(get_auth_user_username),
+):
+    if all_users and auth_user['username'] not in settings.admin_usernames:
+        raise HTTPException(status_code=403, detail="Only admins may export the reservations of all users")
+    if export_format == 'parquet' and not export.parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export is not available on this server")
+    query = export.export_query(None if all_users else auth_user['id'], export_format)
+    # read, encoded and sent chunk by chunk on the export's own session
+    body = export.encode(export_format, query, export.read_chunks(db.bind, query))
+    filename = f"reservations.{export_format}"
+    media_type = export.EXPORT_MEDIA_TYPES[export_format]
+    if gzip:
+        body = export.gzipped(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        body, media_type=media_type, headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+def serve():
+    """Production server: migrate once, then run ``web_concurrency`` workers, one per CPU by default."""
+    asyncio.run(_migrate())
+    # the workers are spawned processes and read their settings from the environment again
+    os.environ['MIGRATE_ON_STARTUP'] = 'false'
+    uvicorn.run(
+        "main:app", host=settings.host, port=settings.port,
+        workers=settings.web_concurrency or os.cpu_count() or 1,
+        timeout_graceful_shutdown=settings.graceful_shutdown_timeout,
+    )
+
+
+async def _migrate():
+    engine = make_engine()
+    try:
+        await init_db(engine)
+    finally:
+        await engine.dispose()
+
+
 if __name__ == '__main__':
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    serve()
@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from typing import Annotated
+from fastapi import Depends, HTTPException, WebSocket, WebSocketException, status
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.security.utils import get_authorization_scheme_param
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from src import models
+from src.cache import TTLCache
+from src.database import get_db
+
+
+CREDENTIALS_CACHE_SIZE = 1024
+CREDENTIALS_CACHE_TTL = 300  # seconds
+
+security = HTTPBasic()
+
+# Verified credentials, keyed on a keyed digest of username + password so plain passwords never sit in memory.
+credentials_cache = TTLCache(maxsize=CREDENTIALS_CACHE_SIZE, ttl=CREDENTIALS_CACHE_TTL)
+_cache_key_secret = secrets.token_bytes(32)
+
+
+def _credentials_key(username: str, password: str) -> bytes:
+    return hmac.new(
+        _cache_key_secret, f"{username}\0{password}".encode('utf-8'), hashlib.sha256
+    ).digest()
+
+
+def invalidate_user_credentials(username: str):
+    credentials_cache.discard_where(lambda key, auth_user: auth_user['username'] == username)
+
+
+@event.listens_for(models.AuthUser.password, 'set')
+def _on_password_change(target, value, oldvalue, initiator):
+    if target.username is not None:
+        invalidate_user_credentials(target.username)
+
+
+async def get_auth_user_username(
+    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+    db: AsyncSession = Depends(get_db)
+):
+    return await authenticate(db, credentials.username, credentials.password)
+
+
+async def authenticate(db: AsyncSession, username: str, password: str) -> dict:
+    cache_key = _credentials_key(username, password)
+    auth_user = credentials_cache.get(cache_key)
+    if auth_user is not None:
+        return auth_user
+
+    unauthorised_except = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid username or password",
+        headers={"WWW-Authenticate": "Basic"}
+    )
+    user = await db.scalar(select(models.AuthUser).filter(models.AuthUser.username == username))
+    if not user:
+        raise unauthorised_except
+    # bcrypt is deliberately slow, keep it off the event loop
+    if not await run_in_threadpool(user.check_password, password):
+        raise unauthorised_except
+    if user.needs_rehash():
+        user.password = await run_in_threadpool(models.hash_password, password)
+        await db.commit()
+    auth_user = {
+        'username': username,
+        'id': user.id
+    }
+    credentials_cache.set(cache_key, auth_user)
+    return auth_user
+
+
+async def get_websocket_user(websocket: WebSocket):
+    """Basic Auth of a WebSocket handshake, refused with 1008 (policy violation) before it is accepted."""
+    try:
+        scheme, param = get_authorization_scheme_param(websocket.headers.get('authorization'))
+        if scheme.lower() != 'basic':
+            raise ValueError(scheme)
+        username, _, password = base64.b64decode(param).decode('utf-8').partition(':')
+    except ValueError:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Basic Auth required")
+    # a session of its own, the connection is not held for the lifetime of the WebSocket
+    async with websocket.app.state.session_factory() as db:
+        try:
+            return await authenticate(db, username, password)
+        except HTTPException:
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid username or password")
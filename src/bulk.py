@@ -0,0 +1,211 @@
+"""Multi-row creation of reservations, shared by ``POST /reservations/batch`` and ``python -m src.importer``.
+
+Records are checked against the database with one lookup per kind (passengers, flights, reservations, seats) and
+against the records before them, then the accepted ones are written with one multi-row insert per table, in the
+session's transaction.
+"""
+from datetime import datetime
+from sqlalchemy import insert, or_, select, tuple_
+from src import feed, models, seats
+from src.database import sync_id_sequence
+from src.email_notify import enqueue_notifications
+from src.reporting import SummaryDelta
+
+
+ALREADY_BOOKED = "Reservation already exists for this passenger and flight."
+EMAIL_TAKEN = "Passenger email is already registered."
+
+
+class Catalog:
+    """Passengers and flights known to be in the database, looked up once and kept for the following records."""
+
+    def __init__(self):
+        self.passenger_emails = {}  # email -> id
+        self.passenger_ids = {}  # id -> email
+        self.passenger_names = {}  # id -> full_name
+        self.flights = {}  # flight_number -> id
+
+    def add_passenger(self, passenger_id: int, email: str, full_name: str):
+        self.passenger_ids[passenger_id] = email
+        self.passenger_emails[email] = passenger_id
+        self.passenger_names[passenger_id] = full_name
+
+    async def load(self, db, passengers: list[dict], flight_numbers: set[str]):
+        ids = {p['id'] for p in passengers if p['id'] is not None and p['id'] not in self.passenger_ids}
+        emails = {p['email'] for p in passengers if p['email'] not in self.passenger_emails}
+        if ids or emails:
+            passenger = models.PassengerInfo
+            for row in await db.execute(select(passenger.id, passenger.email, passenger.full_name).filter(
+                or_(passenger.id.in_(ids), passenger.email.in_(emails))
+            )):
+                self.add_passenger(row.id, row.email, row.full_name)
+        flight_numbers = flight_numbers - self.flights.keys()
+        if flight_numbers:
+            self.flights.update((await db.execute(
+                select(models.FlightDetails.flight_number, models.FlightDetails.id)
+                .filter(models.FlightDetails.flight_number.in_(flight_numbers))
+            )).all())
+
+
+async def create_reservations(db, catalog: Catalog, auth_user_id: int, records: list[dict],
+                              merge_passengers: bool = False, notify: bool = False) -> list:
+    """Insert the reservations of ``records``, ``schemas.Reservation`` dumps with optional timestamps.
+
+    Returns per record the id of the new reservation, ``None`` when it is in the database already, or the reason it
+    was rejected. With ``merge_passengers`` a passenger without an id is the one with their email, otherwise a new
+    passenger whose email must not be registered yet.
+    """
+    await catalog.load(
+        db, [r['passenger_info'] for r in records], {r['flight_details']['flight_number'] for r in records}
+    )
+
+    def passenger_key(passenger):
+        if passenger['id'] is not None or not merge_passengers:
+            return passenger['id']
+        return catalog.passenger_emails.get(passenger['email'])
+
+    # only passengers and flights already in the database can have reservations there
+    known_pairs = {
+        (passenger_key(r['passenger_info']), catalog.flights.get(r['flight_details']['flight_number']))
+        for r in records
+    }
+    known_pairs = {pair for pair in known_pairs if None not in pair}
+    booked = set()
+    if known_pairs:
+        booked = set((await db.execute(
+            select(models.Reservation.passenger_info_id, models.Reservation.flight_details_id).filter(
+                tuple_(models.Reservation.passenger_info_id, models.Reservation.flight_details_id).in_(known_pairs)
+            )
+        )).all())
+    seat_requests = {
+        (catalog.flights[flight['flight_number']], seats.canonical_seat(flight['seat_information']))
+        for flight, status in ((r['flight_details'], r['reservation_status']) for r in records)
+        if flight['flight_number'] in catalog.flights and seats.holds_seat(status)
+    }
+    held_seats = set()
+    if seat_requests:
+        held_seats = set((await db.execute(
+            select(models.SeatAssignment.flight_details_id, models.SeatAssignment.seat_information).filter(
+                tuple_(models.SeatAssignment.flight_details_id, models.SeatAssignment.seat_information)
+                .in_(seat_requests)
+            )
+        )).all())
+
+    outcomes = [None] * len(records)
+    new_passengers = {}
+    new_anonymous = {}
+    new_emails = set()
+    new_flights = {}
+    accepted = {}
+    pairs = set()
+    records_seats = set()
+    for index, record in enumerate(records):
+        passenger, flight = record['passenger_info'], record['flight_details']
+        flight_number, seat = flight['flight_number'], seats.canonical_seat(flight['seat_information'])
+        passenger_id = passenger_key(passenger)
+        flight_id = catalog.flights.get(flight_number)
+        if (passenger_id, flight_id) in booked:
+            continue
+        # emails identify passengers among the records as well as ids do, and also the ones not inserted yet
+        email = catalog.passenger_ids.get(passenger_id) or new_passengers.get(passenger_id, passenger)['email']
+        pair = (email, flight_number)
+        if pair in pairs:
+            outcomes[index] = ALREADY_BOOKED
+            continue
+        holds_seat = seats.holds_seat(record['reservation_status'])
+        if holds_seat and ((flight_id, seat) in held_seats or (flight_number, seat) in records_seats):
+            outcomes[index] = f"Seat {seat} is already taken on flight {flight_number}."
+            continue
+        if passenger_id is None:
+            if not merge_passengers and (email in catalog.passenger_emails or email in new_emails):
+                outcomes[index] = EMAIL_TAKEN
+                continue
+            if email not in new_emails:
+                new_anonymous[email] = passenger
+                new_emails.add(email)
+        elif passenger_id not in catalog.passenger_ids and passenger_id not in new_passengers:
+            if email in catalog.passenger_emails or email in new_emails:
+                outcomes[index] = EMAIL_TAKEN
+                continue
+            new_passengers[passenger_id] = passenger
+            new_emails.add(email)
+        if flight_id is None:
+            new_flights.setdefault(flight_number, flight)
+        pairs.add(pair)
+        if holds_seat:
+            records_seats.add((flight_number, seat))
+        accepted[index] = record
+
+    # Core inserts, executemany without the ORM's bulk bookkeeping
+    passengers, flights = models.PassengerInfo.__table__, models.FlightDetails.__table__
+    if new_passengers:
+        await db.execute(insert(passengers), list(new_passengers.values()))
+        await sync_id_sequence(db, models.PassengerInfo)
+        for passenger in new_passengers.values():
+            catalog.add_passenger(passenger['id'], passenger['email'], passenger['full_name'])
+    if new_anonymous:
+        inserted = await db.execute(
+            insert(passengers).returning(passengers.c.id, passengers.c.email),
+            [{k: v for k, v in p.items() if k != 'id'} for p in new_anonymous.values()]
+        )
+        for row in inserted:
+            catalog.add_passenger(row.id, row.email, new_anonymous[row.email]['full_name'])
+    if new_flights:
+        catalog.flights.update((await db.execute(
+            insert(flights).returning(flights.c.flight_number, flights.c.id), list(new_flights.values())
+        )).all())
+    if not accepted:
+        return outcomes
+
+    now = datetime.now()
+    rows = []
+    for record in accepted.values():
+        passenger, flight = record['passenger_info'], record['flight_details']
+        row = {
+            'total_price': record['total_price'],
+            'reservation_status': record['reservation_status'],
+            'passenger_info_id': catalog.passenger_emails[passenger['email']] if passenger['id'] is None
+            else passenger['id'],
+            'flight_details_id': catalog.flights[flight['flight_number']],
+            'auth_user_id': auth_user_id,
+            'seat_information': seats.canonical_seat(flight['seat_information']),
+        }
+        if 'creation_timestamp' in record:
+            created = record['creation_timestamp'] or now
+            row.update(creation_timestamp=created, last_update_timestamp=record['last_update_timestamp'] or created)
+        rows.append(row)
+    reservations = models.Reservation.__table__
+    inserted = await db.execute(
+        insert(reservations).returning(
+            reservations.c.id, reservations.c.passenger_info_id, reservations.c.flight_details_id
+        ),
+        rows
+    )
+    # RETURNING order is not guaranteed for multi-row inserts, (passenger, flight) is unique among the records
+    reservation_ids = {(row.passenger_info_id, row.flight_details_id): row.id for row in inserted}
+    for index, row in zip(accepted, rows):
+        outcomes[index] = reservation_ids[(row['passenger_info_id'], row['flight_details_id'])]
+    holds = [
+        {
+            'flight_details_id': row['flight_details_id'], 'seat_information': row['seat_information'],
+            'reservation_id': outcomes[index],
+        }
+        for index, row in zip(accepted, rows) if seats.holds_seat(row['reservation_status'])
+    ]
+    if holds:
+        await db.execute(insert(models.SeatAssignment.__table__), holds)
+    if notify:
+        await enqueue_notifications(db, [
+            (
+                outcomes[index], catalog.passenger_ids[row['passenger_info_id']],
+                catalog.passenger_names[row['passenger_info_id']], record['flight_details']['flight_number'],
+                row['reservation_status'],
+            )
+            for (index, record), row in zip(accepted.items(), rows)
+        ], 'created')
+    await feed.record_events(db, auth_user_id, reservation_ids.values(), 'created')
+    summary = SummaryDelta()
+    for row in rows:
+        summary.add(row['auth_user_id'], row['flight_details_id'], row['reservation_status'], row['total_price'])
+    await summary.apply(db)
+    return outcomes
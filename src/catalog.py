@@ -0,0 +1,19 @@
+from src.cache import TTLCache
+
+
+FLIGHT_CACHE_SIZE = 4096
+# Flights changed by another worker process are served stale for at most this long.
+FLIGHT_CACHE_TTL = 60  # seconds
+
+# Committed flight rows keyed on flight_number, so popular flights resolve without a database round trip.
+flight_cache = TTLCache(maxsize=FLIGHT_CACHE_SIZE, ttl=FLIGHT_CACHE_TTL)
+
+
+def cache_flight(flight):
+    """Cache a flight row, only once the transaction that read or created it has committed."""
+    flight_cache.set(flight.flight_number, flight)
+
+
+def invalidate_flights(*flight_numbers: str):
+    for flight_number in flight_numbers:
+        flight_cache.pop(flight_number)
@@ -0,0 +1,86 @@
+"""ETag/Last-Modified validators for reservation reads, derived from ``Reservation.last_update_timestamp``.
+
+The ETag of a reservation is also the ``If-Match`` precondition of ``PUT /reservations/{reservation_id}``.
+Pages of reservations only get an ETag: a delete does not move the latest ``last_update_timestamp`` of a page, so a
+Last-Modified derived from it would answer 304 for a page that lost a reservation.
+"""
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response
+from sqlalchemy import func, select
+
+
+def _stamp(timestamp: datetime | None) -> str:
+    return f"{timestamp:%Y%m%d%H%M%S%f}" if timestamp else "0"
+
+
+def reservation_etag(reservation_id: int, last_update: datetime | None) -> str:
+    # strong, every change of the representation (also through a shared passenger or flight) sets last_update
+    return f'"{reservation_id}-{_stamp(last_update)}"'
+
+
+def page_etag(count: int, id_sum: int | None, last_update: datetime | None) -> str:
+    # count and sum of the ids change when a reservation is created or deleted, the timestamp when one is updated
+    return f'W/"{count}-{id_sum or 0}-{_stamp(last_update)}"'
+
+
+def page_validator(rows) -> str:
+    """``page_etag`` of rows already loaded, matching what ``page_validators_query`` selects."""
+    last_update = max((row.last_update_timestamp for row in rows if row.last_update_timestamp), default=None)
+    return page_etag(len(rows), sum(row.id for row in rows), last_update)
+
+
+def page_validators_query(page):
+    """Aggregate for ``page_etag`` over ``page``, a select of ``Reservation.id`` and ``last_update_timestamp``."""
+    page = page.subquery()
+    return select(func.count(), func.sum(page.c.id), func.max(page.c.last_update_timestamp))
+
+
+def http_date(timestamp: datetime) -> str:
+    # timestamps are stored in local time without a zone
+    return format_datetime(timestamp.astimezone(timezone.utc), usegmt=True)
+
+
+def is_conditional(request: Request) -> bool:
+    return 'if-none-match' in request.headers or 'if-modified-since' in request.headers
+
+
+def not_modified(request: Request, etag: str, last_modified: datetime | None) -> bool:
+    """Evaluate If-None-Match, or If-Modified-Since when it is absent, as RFC 9110 orders them."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        # weak comparison
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return etag.removeprefix('W/') in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    return last_modified.astimezone(timezone.utc).replace(microsecond=0) <= since
+
+
+def precondition_failed(request: Request, etag: str) -> bool:
+    """Evaluate If-Match against the current ``etag``, with the strong comparison RFC 9110 requires."""
+    if_match = request.headers.get('if-match')
+    if if_match is None or if_match.strip() == '*':
+        return False
+    return etag not in {tag.strip() for tag in if_match.split(',')}
+
+
+def set_validators(response: Response, etag: str, last_modified: datetime | None):
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+
+
+def not_modified_response(etag: str, last_modified: datetime | None) -> Response:
+    response = Response(status_code=304)
+    set_validators(response, etag, last_modified)
+    return response
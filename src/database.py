@@ -1,20 +1,100 @@
-import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker, Session
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from src import migrations
+from src.metrics import instrument_engine
 from src.models import Base
+from src.settings import Settings, settings
 
 
-DB_URL = "sqlite:///./local.db"
+def _sqlite_pragmas(config: Settings):
+    return [
+        f"PRAGMA journal_mode={config.sqlite_journal_mode}",
+        f"PRAGMA synchronous={config.sqlite_synchronous}",
+        f"PRAGMA busy_timeout={config.sqlite_busy_timeout_ms}",
+        # negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size=-{config.sqlite_cache_size_kib}",
+        f"PRAGMA mmap_size={config.sqlite_mmap_size}",
+        "PRAGMA temp_store=MEMORY",
+    ]
 
-engine = sa.create_engine(DB_URL)
-SessionLocal = sessionmaker(bind=engine)
-Base.metadata.create_all(bind=engine)
 
-db = SessionLocal()
+def make_engine(url: str | None = None, config: Settings = settings):
+    url = make_url(url or config.database_url)
+    kwargs = {
+        'echo': config.db_echo,
+        'pool_pre_ping': config.db_pool_pre_ping,
+        'pool_timeout': config.db_pool_timeout,
+    }
+    if url.get_backend_name() == 'sqlite':
+        # aiosqlite opens a new connection (and thread) per session by default, pool them instead. With WAL readers
+        # never wait for the writer, and writers queue on the busy timeout, so several connections are safe: reads
+        # and streams do not wait behind each other and behind every write.
+        engine = create_async_engine(
+            url, poolclass=AsyncAdaptedQueuePool,
+            pool_size=5 if config.db_pool_size is None else config.db_pool_size,
+            max_overflow=5 if config.db_max_overflow is None else config.db_max_overflow,
+            **kwargs
+        )
+        pragmas = _sqlite_pragmas(config)
 
+        @event.listens_for(engine.sync_engine, "connect")
+        def _on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+    else:
+        connect_args = {}
+        if url.get_backend_name() == 'postgresql':
+            connect_args['server_settings'] = {'statement_timeout': str(config.db_statement_timeout_ms)}
+        engine = create_async_engine(
+            url,
+            pool_size=10 if config.db_pool_size is None else config.db_pool_size,
+            max_overflow=20 if config.db_max_overflow is None else config.db_max_overflow,
+            pool_recycle=config.db_pool_recycle,
+            connect_args=connect_args,
+            **kwargs
+        )
+    instrument_engine(engine)
+    return engine
 
-def get_db():
-    db_inst = SessionLocal()
-    try:
-        return db_inst
-    finally:
-        db_inst.close()
+
+def make_session_factory(engine):
+    return async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def dialect_insert(db, model):
+    """INSERT construct of the session's dialect, which supports ``on_conflict_do_*`` upserts."""
+    if db.bind.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def sync_id_sequence(db, model):
+    """Move the id sequence of ``model`` past ids inserted explicitly, so it does not hand them out again.
+
+    Only PostgreSQL needs it, SQLite continues after the largest rowid.
+    """
+    if db.bind.dialect.name != 'postgresql':
+        return
+    table = model.__table__.name
+    # never moves the sequence back, ids handed out to transactions still open would be handed out twice
+    await db.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), max(id)) FROM {table} "
+        f"HAVING max(id) > coalesce(pg_sequence_last_value(pg_get_serial_sequence('{table}', 'id')::regclass), 0)"
+    ))
+
+
+async def init_db(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(migrations.upgrade)
+
+
+async def get_db(request: Request):
+    # the engine and session factory belong to the worker process, see the lifespan in main.py
+    async with request.app.state.session_factory() as db_inst:
+        yield db_inst
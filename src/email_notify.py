@@ -1,39 +1,332 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
 import httpx
-from fastapi import HTTPException
-from functools import wraps
+from sqlalchemy import case, func, insert, select, update
+from src import models
+from src.metrics import notification_send_duration, notifications_coalesced, notifications_rate_limited
+from src.settings import settings
 
 
+logger = logging.getLogger(__name__)
+
 mock_url = "https://httpbin.org/post"
 
+NOTIFICATION_TIMEOUT = 10  # seconds per delivery attempt
+RECIPIENT_BUCKETS_MAX = 10000  # full buckets are dropped beyond this many recipients
+POSTPONE_MARGIN = 0.01  # seconds, so a postponed row is not claimed again just before its token is there
+
+# Shared by all deliveries of the running dispatcher so connections to the gateway are pooled.
+_http_client: httpx.AsyncClient | None = None
+
+
+class NotificationError(Exception):
+    pass
+
 
 async def send_notification(email: str, message: str):
     payload = {
         "email": email,
         "message": message
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(mock_url, json=payload, timeout=120)
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to send notification to {email}: {response.text}"
-            )
-
-
-def notify_user(action: str):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            result, send_notification_flag = await func(*args, **kwargs)
-            reservation = result
-            email = reservation.passenger_info.email
-            message = (
-                f"Dear {reservation.passenger_info.full_name}, your reservation has been {action}. "
-                f"Details: Flight {reservation.flight_details.flight_number}, "
-                f"Status: {reservation.reservation_status}."
-            )
-            if send_notification_flag:
-                await send_notification(email, message)
-            return result
-        return wrapper
-    return decorator
+    if _http_client is None:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(mock_url, json=payload, timeout=NOTIFICATION_TIMEOUT)
+    else:
+        response = await _http_client.post(mock_url, json=payload)
+    if response.status_code != 200:
+        raise NotificationError(f"Failed to send notification to {email}: {response.text}")
+
+
+def build_message(full_name: str, action: str, flight_number: str, reservation_status: str):
+    return (
+        f"Dear {full_name}, your reservation has been {action}. "
+        f"Details: Flight {flight_number}, "
+        f"Status: {reservation_status}."
+    )
+
+
+def _held_until(reservation_id: int | None) -> datetime:
+    # held for the coalescing window, so changes of the reservation made within it are merged into the row
+    now = datetime.now()
+    if reservation_id is None:
+        return now
+    return now + timedelta(seconds=settings.notification_coalesce_seconds)
+
+
+def enqueue_notification(db, passenger, flight, reservation_status: str, action: str, reservation_id: int = None):
+    """Add an outbox row to ``db`` so it is committed in the same transaction as the reservation."""
+    db.add(models.NotificationOutbox(
+        email=passenger.email,
+        message=build_message(passenger.full_name, action, flight.flight_number, reservation_status),
+        reservation_id=reservation_id,
+        action=action,
+        next_attempt_at=_held_until(reservation_id),
+    ))
+
+
+async def enqueue_notifications(db, recipients, action: str):
+    """Bulk variant of ``enqueue_notification`` for (reservation_id, email, full_name, flight_number,
+    reservation_status) tuples."""
+    if recipients:
+        await db.execute(insert(models.NotificationOutbox), [
+            {
+                'email': email,
+                'message': build_message(full_name, action, flight_number, reservation_status),
+                'reservation_id': reservation_id,
+                'action': action,
+                'next_attempt_at': _held_until(reservation_id),
+            }
+            for reservation_id, email, full_name, flight_number, reservation_status in recipients
+        ])
+
+
+async def coalesce_notification(db, reservation_id: int, passenger, flight, reservation_status: str):
+    """Notify of the reservation's new status, in the recipient's notification of it still held if there is one.
+
+    The merged message keeps 'created' when the reservation's creation was not sent yet.
+    """
+    outbox = models.NotificationOutbox
+    merged = await db.execute(
+        update(outbox).filter(
+            outbox.reservation_id == reservation_id,
+            outbox.email == passenger.email,
+            # not claimed by a dispatcher, nor retried after a failed attempt
+            outbox.status == 'pending',
+            outbox.attempts == 0,
+            outbox.next_attempt_at > datetime.now(),
+        ).values(message=case(
+            (outbox.action == 'created',
+             build_message(passenger.full_name, 'created', flight.flight_number, reservation_status)),
+            else_=build_message(passenger.full_name, 'updated', flight.flight_number, reservation_status),
+        )).returning(outbox.id).execution_options(synchronize_session=False)
+    )
+    if merged.first() is not None:
+        notifications_coalesced.inc()
+        return
+    enqueue_notification(db, passenger, flight, reservation_status, 'updated', reservation_id)
+
+
+class TokenBucket:
+    """``rate`` tokens per second, up to ``burst`` saved up."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # end of the turns handed out by ``schedule``
+        self.scheduled = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst and self.scheduled <= self.updated
+
+    def try_take(self) -> float:
+        """Take a token if there is one and return 0, otherwise the seconds until there is one."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def schedule(self) -> float:
+        """Seconds until the turn of a request ``try_take`` refused, one token after the turns handed out before."""
+        self._refill()
+        turn = max(self.scheduled, self.updated + (1 - self.tokens) / self.rate)
+        self.scheduled = turn + 1 / self.rate
+        return turn - self.updated
+
+    def reserve(self) -> float:
+        """Take a token, in advance if need be, returns the seconds to wait before using it."""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class NotificationDispatcher:
+    """Delivers pending outbox rows in the background with bounded concurrency and retries."""
+
+    def __init__(
+            self, session_factory=None, concurrency: int = 8, batch_size: int = 100, max_attempts: int = 5,
+            backoff_base: float = 2.0, backoff_max: float = 300.0, poll_interval: float = 5.0,
+            lease: float = 60.0, recipient_rate: float = settings.notification_recipient_rate,
+            recipient_burst: int = settings.notification_recipient_burst,
+            send_rate: float = settings.notification_send_rate
+    ):
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        # a claimed row becomes due again after the lease, in case its worker died mid-delivery
+        self.lease = lease
+        # rows of a recipient over its limit are postponed, sends over the overall limit wait for their turn
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self._recipient_buckets = {}
+        self._send_bucket = TokenBucket(send_rate, max(send_rate, 1)) if send_rate else None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    async def start(self, session_factory=None):
+        global _http_client
+        if session_factory is not None:
+            self.session_factory = session_factory
+        self._stopping = False
+        # an Event binds to the first loop waiting on it, the app may be started again on a new loop
+        self._wakeup = asyncio.Event()
+        _http_client = httpx.AsyncClient(
+            timeout=NOTIFICATION_TIMEOUT,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Let the running batch finish for up to ``timeout`` seconds, undelivered rows stay in the outbox."""
+        global _http_client
+        if self._task is not None:
+            self._stopping = True
+            self.wake()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                # wait_for cancelled the task, its claimed rows are retried once their lease expires
+                pass
+            self._task = None
+        if _http_client is not None:
+            await _http_client.aclose()
+            _http_client = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            timeout = self.poll_interval
+            try:
+                await self.drain()
+                timeout = await self._until_next_due()
+            except Exception:
+                logger.exception("Notification delivery round failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain(self):
+        """Deliver due notifications until none are left, returns the number delivered."""
+        delivered = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(row):
+            wait = self._recipient_wait(row.email)
+            if wait:
+                notifications_rate_limited.inc()
+                # the postponed delivery is not an attempt
+                return {
+                    'id': row.id, 'status': 'pending', 'attempts': row.attempts - 1,
+                    'next_attempt_at': datetime.now() + timedelta(seconds=wait),
+                }
+            async with semaphore:
+                return await self._deliver(row)
+
+        while not self._stopping and (batch := await self._claim_batch()):
+            outcomes = await asyncio.gather(*(deliver(row) for row in batch))
+            async with self.session_factory() as db:
+                await db.execute(update(models.NotificationOutbox), outcomes)
+                await db.commit()
+            delivered += sum(outcome['status'] == 'sent' for outcome in outcomes)
+        return delivered
+
+    async def _until_next_due(self) -> float:
+        # held and postponed rows are due before the next poll, sleep until the first of them
+        async with self.session_factory() as db:
+            due = await db.scalar(select(func.min(models.NotificationOutbox.next_attempt_at)).filter(
+                models.NotificationOutbox.status == 'pending'
+            ))
+        if due is None:
+            return self.poll_interval
+        return min(max((due - datetime.now()).total_seconds(), 0.1), self.poll_interval)
+
+    def _recipient_wait(self, email: str) -> float:
+        if not self.recipient_rate:
+            return 0
+        if len(self._recipient_buckets) > RECIPIENT_BUCKETS_MAX:
+            self._recipient_buckets = {
+                recipient: bucket for recipient, bucket in self._recipient_buckets.items() if not bucket.full
+            }
+        bucket = self._recipient_buckets.get(email)
+        if bucket is None:
+            bucket = self._recipient_buckets[email] = TokenBucket(self.recipient_rate, self.recipient_burst)
+        if bucket.try_take() == 0:
+            return 0
+        # each postponed row gets a turn of its own, so they come back one per token and in order
+        return bucket.schedule() + POSTPONE_MARGIN
+
+    def _due_ids(self, now: datetime):
+        # served by ix_notification_outbox_due; on PostgreSQL rows claimed by another dispatcher are skipped
+        return select(models.NotificationOutbox.id).filter(
+            models.NotificationOutbox.status == 'pending',
+            models.NotificationOutbox.next_attempt_at <= now
+        ).order_by(models.NotificationOutbox.next_attempt_at).limit(self.batch_size).with_for_update(skip_locked=True)
+
+    async def _claim_batch(self):
+        now = datetime.now()
+        due_ids = self._due_ids(now).scalar_subquery()
+        # the due condition is re-checked by the UPDATE itself, so concurrent dispatchers never claim the same row
+        claim = update(models.NotificationOutbox).filter(
+            models.NotificationOutbox.id.in_(due_ids),
+            models.NotificationOutbox.status == 'pending',
+            models.NotificationOutbox.next_attempt_at <= now
+        ).values(
+            attempts=models.NotificationOutbox.attempts + 1,
+            next_attempt_at=now + timedelta(seconds=self.lease)
+        ).returning(
+            models.NotificationOutbox.id, models.NotificationOutbox.email,
+            models.NotificationOutbox.message, models.NotificationOutbox.attempts
+        )
+        async with self.session_factory() as db:
+            rows = sorted((await db.execute(claim)).all(), key=lambda row: row.id)
+            await db.commit()
+        return rows
+
+    def _backoff(self, attempts: int):
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1)
+
+    async def _deliver(self, row):
+        if self._send_bucket is not None:
+            await asyncio.sleep(self._send_bucket.reserve())
+        started = time.perf_counter()
+        try:
+            await send_notification(row.email, row.message)
+        except Exception as exc:
+            notification_send_duration.observe(('error',), time.perf_counter() - started)
+            logger.warning("Notification %s attempt %s failed: %s", row.id, row.attempts, exc)
+            if row.attempts >= self.max_attempts:
+                return {'id': row.id, 'status': 'failed', 'last_error': str(exc)}
+            return {
+                'id': row.id,
+                'status': 'pending',
+                'last_error': str(exc),
+                'next_attempt_at': datetime.now() + timedelta(seconds=self._backoff(row.attempts))
+            }
+        notification_send_duration.observe(('sent',), time.perf_counter() - started)
+        return {'id': row.id, 'status': 'sent', 'last_error': None, 'sent_timestamp': datetime.now()}
+
+
+# started by the app's lifespan with the session factory of the worker process
+notification_dispatcher = NotificationDispatcher()
@@ -0,0 +1,200 @@
+"""Streaming export of reservations with their passenger and flight, as CSV, JSONL or Parquet.
+
+Rows are read ``EXPORT_CHUNK`` at a time by keyset on the id, and each chunk is encoded and sent (or written) before
+the next one is read, so memory use does not grow with the number of reservations. Served by
+``GET /exports/reservations`` and available from the command line:
+
+    python -m src.export --format csv --gzip --output reservations.csv.gz [--user kirill]
+"""
+import argparse
+import asyncio
+import csv
+import importlib.util
+import io
+import sys
+import zlib
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import models
+from src.database import make_engine
+from src.serialization import dumps_ndjson, reservation_rows
+
+
+EXPORT_CHUNK = 5000
+EXPORT_MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def parquet_available() -> bool:
+    # pyarrow is an optional dependency, only needed for Parquet
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def export_query(auth_user_id: int | None = None, export_format: str = 'csv'):
+    """Rows of ``reservation_rows`` in id order, of one user or of all users.
+
+    JSONL nests them like the API does. The flat formats leave out ``reservations.passenger_info_id``, which would
+    be a second ``passenger_info_id`` column next to ``passenger_info.id`` (the one ``src.importer`` reads).
+    """
+    query = reservation_rows().order_by(models.Reservation.id)
+    if export_format != 'jsonl':
+        query = query.with_only_columns(*(
+            column for column in query.selected_columns
+            if column is not models.Reservation.__table__.c.passenger_info_id
+        ))
+    if auth_user_id is not None:
+        query = query.filter(models.Reservation.auth_user_id == auth_user_id)
+    return query
+
+
+async def read_chunks(bind, query):
+    """Chunks of ``query`` (ordered by id), each read on a short session of its own.
+
+    No connection is held while a chunk is sent, so a slow client does not keep one from the other requests.
+    """
+    after_id = None
+    while True:
+        page = query if after_id is None else query.filter(models.Reservation.id > after_id)
+        async with AsyncSession(bind=bind) as db:
+            chunk = (await db.execute(page.limit(EXPORT_CHUNK))).all()
+        if chunk:
+            yield chunk
+        if len(chunk) < EXPORT_CHUNK:
+            return
+        after_id = chunk[-1].id
+
+
+async def _encode_csv(query, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in query.selected_columns])
+    async for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+async def _encode_jsonl(query, chunks):
+    async for chunk in chunks:
+        yield dumps_ndjson(chunk)
+
+
+class _ParquetSink:
+    """Write-only file for ``ParquetWriter``, drained after every row group."""
+
+    def __init__(self):
+        self.closed = False
+        self._parts = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+async def _encode_parquet(query, chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def arrow_type(sql_type):
+        if isinstance(sql_type, sa.Integer):
+            return pa.int64()
+        if isinstance(sql_type, sa.Float):
+            return pa.float64()
+        if isinstance(sql_type, sa.DateTime):
+            return pa.timestamp('us')
+        return pa.string()
+
+    schema = pa.schema([(column.name, arrow_type(column.type)) for column in query.selected_columns])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        async for chunk in chunks:
+            # one row group per chunk
+            writer.write_batch(pa.record_batch(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)], schema=schema
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+_ENCODERS = {'csv': _encode_csv, 'jsonl': _encode_jsonl, 'parquet': _encode_parquet}
+
+
+def encode(export_format: str, query, chunks):
+    """Bytes of the export in ``export_format``, produced chunk by chunk from ``read_chunks``."""
+    return _ENCODERS[export_format](query, chunks)
+
+
+async def gzipped(data):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for part in data:
+        compressed = compressor.compress(part)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def export_to_file(output, export_format: str, username: str | None = None, compress: bool = False,
+                         url: str | None = None) -> int:
+    """Write the export of ``username`` (all users when None) to the binary file ``output``, returns the bytes."""
+    engine = make_engine(url)
+    try:
+        auth_user_id = None
+        if username is not None:
+            async with AsyncSession(bind=engine) as db:
+                auth_user_id = await db.scalar(
+                    sa.select(models.AuthUser.id).filter(models.AuthUser.username == username)
+                )
+            if auth_user_id is None:
+                raise SystemExit(f"unknown user {username}")
+        query = export_query(auth_user_id, export_format)
+        data = encode(export_format, query, read_chunks(engine, query))
+        if compress:
+            data = gzipped(data)
+        written = 0
+        async for part in data:
+            output.write(part)
+            written += len(part)
+        return written
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export reservations with their passenger and flight")
+    parser.add_argument("--format", choices=list(EXPORT_MEDIA_TYPES), default='csv')
+    parser.add_argument("--output", default='-', help="file to write, - for stdout")
+    parser.add_argument("--user", help="username whose reservations to export, all users when omitted")
+    parser.add_argument("--gzip", action='store_true', help="gzip the output")
+    args = parser.parse_args()
+    if args.format == 'parquet' and not parquet_available():
+        parser.error("Parquet export needs pyarrow installed")
+    if args.output == '-':
+        asyncio.run(export_to_file(sys.stdout.buffer, args.format, args.user, args.gzip))
+    else:
+        with open(args.output, 'wb') as output:
+            asyncio.run(export_to_file(output, args.format, args.user, args.gzip))
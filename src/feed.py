@@ -0,0 +1,319 @@
+"""Change feed of the reservations, pushed to clients instead of being polled from ``GET /reservations``.
+
+The reservation endpoints record an event in ``reservation_events`` in the transaction of the change, so its ``id`` is a
+sequence number shared by all worker processes. The ``ChangeFeed`` of every worker tails the table, right after
+commits of its own worker and every ``FEED_POLL_INTERVAL`` for those of the others, and fans the events out to bounded
+queues of the user's subscribers. A subscriber that lets ``FEED_QUEUE_SIZE`` events pile up is closed rather than
+buffered without bound; like any client it resumes from the sequence number of the last event it received, replayed
+from the table for ``FEED_RETENTION``.
+
+Events carry the reservation as it is when they are delivered, null once it is deleted, so the last event of a
+reservation always has its current state.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import orjson
+from sqlalchemy import delete, func, insert, literal, or_, select
+from starlette.websockets import WebSocketDisconnect
+from src import models
+from src.serialization import reservation_from_row, reservation_rows
+
+
+logger = logging.getLogger(__name__)
+
+FEED_QUEUE_SIZE = 1000  # events buffered per subscriber
+FEED_POLL_INTERVAL = 1.0  # seconds, events committed by other workers are delivered within this
+FEED_BATCH = 500
+FEED_RETENTION = timedelta(days=1)
+FEED_PURGE_INTERVAL = 3600  # seconds
+# sequence numbers skipped by the tail belong to transactions still running, or rolled back when missing for this long
+FEED_GAP_TIMEOUT = 60  # seconds
+FEED_GAP_LIMIT = 10000
+FEED_HEARTBEAT = 15  # seconds between keep-alive comments of an idle event stream
+
+_events = models.ReservationEvent.__table__
+
+
+def record_event(db, auth_user_id: int, reservation_id: int, event: str):
+    """Add an event to ``db`` so it is committed in the same transaction as the change."""
+    db.add(models.ReservationEvent(auth_user_id=auth_user_id, reservation_id=reservation_id, event=event))
+
+
+async def record_events(db, auth_user_id: int, reservation_ids, event: str):
+    """Bulk variant of ``record_event``."""
+    now = datetime.now()
+    rows = [
+        {'auth_user_id': auth_user_id, 'reservation_id': reservation_id, 'event': event, 'creation_timestamp': now}
+        for reservation_id in reservation_ids
+    ]
+    if rows:
+        await db.execute(insert(_events), rows)
+
+
+async def record_updates(db, condition):
+    """'updated' events of the reservations matching ``condition``, of any user, in one statement."""
+    await db.execute(insert(_events).from_select(
+        ['auth_user_id', 'reservation_id', 'event', 'creation_timestamp'],
+        select(
+            models.Reservation.auth_user_id, models.Reservation.id, literal('updated'), literal(datetime.now())
+        ).filter(condition)
+    ))
+
+
+async def _read_events(db, condition, limit: int) -> list[tuple[int, dict]]:
+    """(user, event) pairs of the events matching ``condition``, with the current state of their reservations."""
+    events = (await db.execute(
+        select(_events).filter(condition).order_by(_events.c.id).limit(limit)
+    )).all()
+    reservation_ids = {event.reservation_id for event in events if event.event != 'deleted'}
+    current = {}
+    if reservation_ids:
+        # keyed on the user too, so an id reused after a delete never shows another user's reservation
+        current = {
+            (row.id, row.auth_user_id): reservation_from_row(row)
+            for row in await db.execute(reservation_rows().filter(models.Reservation.id.in_(reservation_ids)))
+        }
+    return [
+        (event.auth_user_id, {
+            'sequence': event.id,
+            'event': event.event,
+            'reservation_id': event.reservation_id,
+            'timestamp': event.creation_timestamp,
+            'reservation': (
+                current.get((event.reservation_id, event.auth_user_id)) if event.event != 'deleted' else None
+            ),
+        })
+        for event in events
+    ]
+
+
+class FeedClosed(Exception):
+    """The subscription was closed, because the subscriber ``lagged`` behind or the worker is ``shutdown``."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Subscription:
+    def __init__(self, auth_user_id: int, maxsize: int):
+        self.auth_user_id = auth_user_id
+        self.closed = None
+        self._queue = asyncio.Queue(maxsize)
+
+    def push(self, event: dict) -> bool:
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.close('lagged')
+            return False
+
+    def close(self, reason: str):
+        # the events not read yet are dropped, the reader resumes from the last one it got
+        self.closed = reason
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    async def get(self, timeout: float | None = None) -> dict:
+        event = await asyncio.wait_for(self._queue.get(), timeout)
+        if event is None:
+            self._queue.put_nowait(None)
+            raise FeedClosed(self.closed)
+        return event
+
+
+class ChangeFeed:
+    """Tails ``reservation_events`` in the background and publishes the events to the subscribers of this worker."""
+
+    def __init__(self, session_factory=None, poll_interval: float = FEED_POLL_INTERVAL, batch_size: int = FEED_BATCH):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._subscribers = defaultdict(set)
+        self._last_id = 0
+        self._gaps = {}
+        self._purged = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    async def start(self, session_factory=None):
+        if session_factory is not None:
+            self.session_factory = session_factory
+        self._stopping = False
+        # set by wake() after commits of this worker, a new one per start as the tail loop of a restarted app runs on
+        # another event loop than the one the old Event is bound to
+        self._wakeup = asyncio.Event()
+        # earlier events are replayed on request, not published
+        async with self.session_factory() as db:
+            self._last_id = await db.scalar(select(func.max(_events.c.id))) or 0
+        self._gaps.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self.wake()
+            await self._task
+            self._task = None
+        for subscriptions in self._subscribers.values():
+            for subscription in subscriptions:
+                subscription.close('shutdown')
+        self._subscribers.clear()
+
+    def wake(self):
+        self._wakeup.set()
+
+    @property
+    def subscribers(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    @contextmanager
+    def subscribe(self, auth_user_id: int, maxsize: int | None = None):
+        subscription = Subscription(auth_user_id, maxsize or FEED_QUEUE_SIZE)
+        self._subscribers[auth_user_id].add(subscription)
+        try:
+            yield subscription
+        finally:
+            self._unsubscribe(subscription)
+
+    def _unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscribers.get(subscription.auth_user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[subscription.auth_user_id]
+
+    def publish(self, auth_user_id: int, event: dict):
+        for subscription in list(self._subscribers.get(auth_user_id, ())):
+            if not subscription.push(event):
+                self._unsubscribe(subscription)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                while await self.poll() == self.batch_size:
+                    pass
+                if time.monotonic() - self._purged > FEED_PURGE_INTERVAL:
+                    await self.purge()
+            except Exception:
+                logger.exception("Change feed poll failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def poll(self) -> int:
+        """Publish the events committed since the last poll, returns their number."""
+        tail = _events.c.id > self._last_id
+        if self._gaps:
+            tail = or_(tail, _events.c.id.in_(list(self._gaps)))
+        async with self.session_factory() as db:
+            events = await _read_events(db, tail, self.batch_size)
+        now = time.monotonic()
+        for auth_user_id, event in events:
+            sequence = event['sequence']
+            if sequence > self._last_id:
+                # on PostgreSQL, a transaction may commit a lower sequence number after a higher one
+                if sequence - self._last_id - 1 + len(self._gaps) <= FEED_GAP_LIMIT:
+                    self._gaps.update(dict.fromkeys(range(self._last_id + 1, sequence), now))
+                self._last_id = sequence
+            else:
+                self._gaps.pop(sequence, None)
+            self.publish(auth_user_id, event)
+        self._gaps = {sequence: seen for sequence, seen in self._gaps.items() if now - seen < FEED_GAP_TIMEOUT}
+        return len(events)
+
+    async def purge(self):
+        self._purged = time.monotonic()
+        async with self.session_factory() as db:
+            await db.execute(delete(models.ReservationEvent).filter(
+                models.ReservationEvent.creation_timestamp < datetime.now() - FEED_RETENTION
+            ))
+            await db.commit()
+
+    async def replay(self, auth_user_id: int, after: int):
+        """The user's events after sequence number ``after``, read from the table a batch per session."""
+        while True:
+            async with self.session_factory() as db:
+                events = await _read_events(
+                    db, (_events.c.auth_user_id == auth_user_id) & (_events.c.id > after), self.batch_size
+                )
+            for _, event in events:
+                yield event
+            if len(events) < self.batch_size:
+                return
+            after = events[-1][1]['sequence']
+
+    async def events(self, auth_user_id: int, after: int | None = None, heartbeat: float | None = None):
+        """The user's events after ``after`` replayed, then live ones; None after ``heartbeat`` seconds without any.
+
+        Ends with ``FeedClosed``.
+        """
+        with self.subscribe(auth_user_id) as subscription:
+            # subscribed first, so nothing committed during the replay is missed
+            replayed = set()
+            if after is not None:
+                async for event in self.replay(auth_user_id, after):
+                    replayed.add(event['sequence'])
+                    yield event
+            while True:
+                try:
+                    event = await subscription.get(heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event['sequence'] not in replayed:
+                    yield event
+
+
+async def sse_stream(events):
+    """Server-sent events of ``ChangeFeed.events``, ``id`` is the sequence number."""
+    try:
+        async for event in events:
+            if event is None:
+                yield b': keep-alive\n\n'
+            else:
+                yield b'id: %d\nevent: %s\ndata: %s\n\n' % (
+                    event['sequence'], event['event'].encode(), orjson.dumps(event)
+                )
+    except FeedClosed as closed:
+        # EventSource reconnects on its own, sending the id of the last event it got as Last-Event-ID
+        yield b'event: closed\ndata: %s\n\n' % orjson.dumps({'reason': closed.reason})
+
+
+async def websocket_stream(websocket, events):
+    """Send ``ChangeFeed.events`` as JSON text messages until the client disconnects or the feed is closed."""
+    async def send():
+        try:
+            async for event in events:
+                await websocket.send_text(orjson.dumps(event).decode())
+        except FeedClosed as closed:
+            # 1013 try again later: reconnect with ?after=<sequence of the last event received>
+            await websocket.close(code=1013 if closed.reason == 'lagged' else 1001, reason=closed.reason)
+
+    async def receive():
+        # messages of the client are ignored, receiving only notices that it went away
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+
+    tasks = {asyncio.create_task(send()), asyncio.create_task(receive())}
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(outcome, Exception) and not isinstance(outcome, WebSocketDisconnect):
+                logger.warning("Change feed WebSocket failed: %r", outcome)
+
+
+# one tail of reservation_events per worker process, serving all its subscribers; the lifespan hands it the sessions
+change_feed = ChangeFeed()
@@ -0,0 +1,74 @@
+"""``Idempotency-Key`` support for ``POST /reservations``.
+
+The key is claimed by the first statement of the create transaction and stored with the response before the commit,
+so a reservation and its key are committed together or not at all. A concurrent duplicate blocks on the key's
+primary key until the first request finishes, then replays its response; the reservation tables and the notification
+outbox are written once. Failed requests store nothing and may be retried with the same key.
+"""
+import hashlib
+from datetime import datetime, timedelta
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+from sqlalchemy import delete, select, update
+from src import models
+from src.database import dialect_insert
+
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# keys are replayed for this long, then purged and free to be reused
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# expired keys are deleted on every this many claims of a worker
+IDEMPOTENCY_PURGE_EVERY = 100
+
+_claims = 0
+
+
+def request_hash(payload: dict) -> str:
+    """Fingerprint of the request body, a key replayed with a different body is refused."""
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+async def claim(db, auth_user_id: int, key: str, fingerprint: str) -> bool:
+    """Claim ``key`` in the current transaction, False when it holds a response already (or is being handled)."""
+    global _claims
+    now = datetime.now()
+    _claims += 1
+    if _claims % IDEMPOTENCY_PURGE_EVERY == 0:
+        await db.execute(
+            delete(models.IdempotencyKey).filter(models.IdempotencyKey.creation_timestamp < now - IDEMPOTENCY_KEY_TTL)
+        )
+    stmt = dialect_insert(db, models.IdempotencyKey).values(
+        auth_user_id=auth_user_id, key=key, request_hash=fingerprint, creation_timestamp=now
+    )
+    # an expired key is taken over as if it was new
+    claimed = await db.execute(stmt.on_conflict_do_update(
+        index_elements=['auth_user_id', 'key'],
+        set_={'request_hash': stmt.excluded.request_hash, 'response': None, 'creation_timestamp': now},
+        where=models.IdempotencyKey.creation_timestamp < now - IDEMPOTENCY_KEY_TTL,
+    ).returning(models.IdempotencyKey.key))
+    return claimed.one_or_none() is not None
+
+
+async def complete(db, auth_user_id: int, key: str, body: str):
+    """Store the response of the claimed key, in the transaction that commits the request's changes."""
+    await db.execute(
+        update(models.IdempotencyKey)
+        .filter(models.IdempotencyKey.auth_user_id == auth_user_id, models.IdempotencyKey.key == key)
+        .values(response=body)
+    )
+
+
+async def replay(db, auth_user_id: int, key: str, fingerprint: str) -> Response:
+    """The stored response of ``key``, after ``claim`` found it taken."""
+    await db.rollback()
+    stored = (await db.execute(
+        select(models.IdempotencyKey.request_hash, models.IdempotencyKey.response)
+        .filter(models.IdempotencyKey.auth_user_id == auth_user_id, models.IdempotencyKey.key == key)
+    )).one_or_none()
+    if stored is None or stored.response is None:
+        # only while the claiming transaction has not committed, on backends that do not make us wait for it
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is in progress.")
+    if stored.request_hash != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+    return Response(stored.response, media_type='application/json', headers={'Idempotent-Replayed': 'true'})
@@ -0,0 +1,214 @@
+"""Bulk import of historical reservations from CSV or JSONL, owned by one user.
+
+JSONL lines are ``POST /reservations`` bodies, CSV rows have the columns of ``python -m src.export`` (``total_price``,
+``passenger_info_email``, ``flight_details_flight_number``, ...), so exports can be imported again; ``.gz`` files are
+read compressed. Optional ``creation_timestamp``/``last_update_timestamp`` fields are kept.
+
+Records are validated with ``schemas.Reservation`` in a process pool while the previous chunk is written. Every chunk
+is written in one transaction of multi-row inserts. Passengers and flights are looked up once and kept in memory for
+the rest of the import. Reservations already in the database are skipped, so an interrupted import can simply be run
+again; ``--resume`` also skips the records committed before, counted in the ``<input>.progress`` file. Imported
+reservations hold their seats, count in the reports and appear in the change feed, but send no notifications.
+
+    python -m src.importer reservations.jsonl --user kirill [--format csv] [--workers 4] [--resume]
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import orjson
+from pydantic import ValidationError
+from sqlalchemy import select
+from src import models, schemas
+from src.bulk import Catalog, create_reservations
+from src.database import make_engine, make_session_factory
+
+
+IMPORT_CHUNK = 5000
+# chunks validated ahead of the one being written, per worker process
+IMPORT_PREFETCH = 2
+IMPORT_FORMATS = ('csv', 'jsonl')
+TIMESTAMP_FIELDS = ('creation_timestamp', 'last_update_timestamp')
+
+
+class ImportStats:
+    def __init__(self):
+        self.records = 0  # read in this run, the ones skipped by --resume do not count
+        self.imported = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.started = time.monotonic()
+
+    def rate(self) -> float:
+        return self.records / max(time.monotonic() - self.started, 1e-9)
+
+    def __str__(self):
+        return (f"{self.records} records: {self.imported} imported, {self.skipped} already imported, "
+                f"{self.rejected} rejected, {self.rate():.0f} rows/s")
+
+
+def _nested(row: dict) -> dict:
+    # flat export columns back into the nested request body, empty cells are missing values
+    record = {'passenger_info': {}, 'flight_details': {}}
+    for column, value in row.items():
+        if value in ('', None):
+            continue
+        for prefix in ('passenger_info', 'flight_details'):
+            if column.startswith(prefix + '_'):
+                record[prefix][column.removeprefix(prefix + '_')] = value
+                break
+        else:
+            record[column] = value
+    return record
+
+
+def _validate_chunk(export_format: str, first: int, records: list) -> list:
+    """(record number, reservation values or None, error or None) per record, run in the worker processes."""
+    results = []
+    for number, record in enumerate(records, first):
+        try:
+            record = orjson.loads(record) if export_format == 'jsonl' else _nested(record)
+            values = schemas.Reservation.model_validate(record).model_dump(exclude={'id'})
+            for field in TIMESTAMP_FIELDS:
+                value = record.get(field)
+                values[field] = datetime.fromisoformat(value) if value else None
+            results.append((number, values, None))
+        except ValidationError as e:
+            results.append((number, None, e.errors(include_url=False, include_context=False)))
+        except (orjson.JSONDecodeError, TypeError, ValueError, AttributeError) as e:
+            results.append((number, None, str(e)))
+    return results
+
+
+def _open(path: str):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def read_records(file, export_format: str):
+    """Raw records of a binary file, JSONL lines or CSV rows as dicts."""
+    if export_format == 'jsonl':
+        return (line for line in file if line.strip())
+    return csv.DictReader(io.TextIOWrapper(file, encoding='utf-8', newline=''))
+
+
+async def write_chunk(db, catalog: Catalog, auth_user_id: int, chunk: list, stats: ImportStats, rejected: list):
+    """Insert the valid reservations of a validated chunk, in the session's transaction."""
+    valid = []
+    for number, values, error in chunk:
+        if error is None:
+            valid.append((number, values))
+        else:
+            rejected.append((number, error))
+    outcomes = await create_reservations(
+        db, catalog, auth_user_id, [values for _, values in valid], merge_passengers=True
+    )
+    for (number, _), outcome in zip(valid, outcomes):
+        if outcome is None:
+            stats.skipped += 1
+        elif isinstance(outcome, str):
+            rejected.append((number, outcome))
+        else:
+            stats.imported += 1
+
+
+def _read_progress(path: str) -> int:
+    try:
+        with open(path) as file:
+            return json.load(file)['records']
+    except FileNotFoundError:
+        return 0
+
+
+def _write_progress(path: str, records: int):
+    # replaced atomically, an interrupted write leaves the previous count
+    with open(path + '.tmp', 'w') as file:
+        json.dump({'records': records}, file)
+    os.replace(path + '.tmp', path)
+
+
+async def import_file(path: str, username: str, export_format: str | None = None, chunk_size: int = IMPORT_CHUNK,
+                      workers: int | None = None, resume: bool = False, errors=None, url: str | None = None,
+                      progress=None) -> ImportStats:
+    """Import the reservations in ``path`` for ``username``.
+
+    ``workers=0`` validates in this process. Rejected records are written to the text file ``errors`` as JSONL, and
+    ``progress`` is called with the ``ImportStats`` after every chunk.
+    """
+    export_format = export_format or ('csv' if path.removesuffix('.gz').endswith('.csv') else 'jsonl')
+    progress_path = path + '.progress'
+    skip = _read_progress(progress_path) if resume else 0
+    stats = ImportStats()
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    engine = make_engine(url)
+    pool = ProcessPoolExecutor(workers) if workers else None
+    try:
+        async with make_session_factory(engine)() as db:
+            auth_user_id = await db.scalar(select(models.AuthUser.id).filter(models.AuthUser.username == username))
+            if auth_user_id is None:
+                raise SystemExit(f"unknown user {username}")
+            catalog = Catalog()
+            loop = asyncio.get_running_loop()
+            prefetch = IMPORT_PREFETCH * max(workers, 1)
+            pending = deque()
+
+            async def write_next():
+                chunk = await pending.popleft()
+                rejected = []
+                await write_chunk(db, catalog, auth_user_id, chunk, stats, rejected)
+                await db.commit()
+                stats.records += len(chunk)
+                stats.rejected += len(rejected)
+                if errors is not None:
+                    for number, error in rejected:
+                        errors.write(orjson.dumps({'record': number, 'error': error}).decode() + '\n')
+                _write_progress(progress_path, skip + stats.records)
+                if progress is not None:
+                    progress(stats)
+
+            with _open(path) as file:
+                records = itertools.islice(read_records(file, export_format), skip, None)
+                first = skip + 1
+                while chunk := list(itertools.islice(records, chunk_size)):
+                    # the pool validates the chunks ahead while this process writes
+                    pending.append(loop.run_in_executor(pool, _validate_chunk, export_format, first, chunk))
+                    first += len(chunk)
+                    if len(pending) > prefetch:
+                        await write_next()
+                while pending:
+                    await write_next()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        await engine.dispose()
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import historical reservations")
+    parser.add_argument("input", help="CSV or JSONL file, optionally gzipped")
+    parser.add_argument("--user", required=True, help="username owning the imported reservations")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="input format, by default from the file name")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK, help="records per transaction")
+    parser.add_argument("--workers", type=int, help="validation processes, one per CPU by default, 0 for none")
+    parser.add_argument("--resume", action='store_true', help="skip the records committed by an earlier run")
+    parser.add_argument("--errors", help="file to write the rejected records to, as JSONL")
+    args = parser.parse_args()
+    errors_file = open(args.errors, 'w') if args.errors else None
+    try:
+        result = asyncio.run(import_file(
+            args.input, args.user, args.format, args.chunk_size, args.workers, args.resume, errors_file,
+            progress=lambda stats: print(stats, file=sys.stderr, flush=True),
+        ))
+    finally:
+        if errors_file is not None:
+            errors_file.close()
+    print(result)
@@ -0,0 +1,247 @@
+"""In-process request, database and notification metrics, rendered in the Prometheus text format on ``/metrics``.
+
+Updates are plain dict operations on the event loop thread, cheap enough to run on every request and query.
+Values are per process, every worker is scraped separately.
+"""
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def clear(self):
+        self._values.clear()
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple = ()):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, labels: tuple, value: float):
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, labels: tuple, value: float):
+        series = self._values.get(labels)
+        if series is None:
+            # per bucket (non-cumulative) counts, the last one is +Inf, then the sum
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels: tuple = ()):
+        series = self._values.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        labelnames = self.labelnames + ('le',)
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, observations in zip(self.buckets + ('+Inf',), series):
+                cumulative += observations
+                yield f'{self.name}_bucket{_format_labels(labelnames, labels + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-1])}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """``collect()`` is called on every scrape and returns metrics computed at that time."""
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for metric in collect():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'http_requests_total', 'HTTP requests by route and status code.', ('method', 'route', 'status')
+))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency until the response is sent.', ('method', 'route')
+))
+http_requests_in_flight = registry.register(Gauge(
+    'http_requests_in_flight', 'HTTP requests being handled.'
+))
+db_queries = registry.register(Counter(
+    'db_queries_total', 'Database queries executed while handling requests, by route.', ('method', 'route')
+))
+db_query_time = registry.register(Counter(
+    'db_query_seconds_total', 'Time spent in database queries while handling requests, by route.', ('method', 'route')
+))
+db_query_duration = registry.register(Histogram(
+    'db_query_duration_seconds', 'Latency of every database query.', buckets=DB_QUERY_BUCKETS
+))
+notification_send_duration = registry.register(Histogram(
+    'notification_send_duration_seconds', 'Latency of notification gateway calls by outcome.', ('outcome',)
+))
+notifications_coalesced = registry.register(Counter(
+    'notifications_coalesced_total', 'Notifications merged into a pending notification of the same reservation.'
+))
+notifications_rate_limited = registry.register(Counter(
+    'notifications_rate_limited_total', 'Notification deliveries postponed by the per-recipient rate limit.'
+))
+
+
+def cache_collector(caches: dict):
+    """Collector exporting ``TTLCache.stats()`` of ``caches``, a mapping of cache name to cache."""
+    def collect():
+        size = Gauge('cache_entries', 'Entries held by in-memory caches.', ('cache',))
+        lookups = Counter('cache_lookups_total', 'In-memory cache lookups by result.', ('cache', 'result'))
+        evictions = Counter('cache_evictions_total', 'Entries evicted from in-memory caches when full.', ('cache',))
+        for name, cache in caches.items():
+            stats = cache.stats()
+            size.set((name,), stats['size'])
+            lookups.inc((name, 'hit'), stats['hits'])
+            lookups.inc((name, 'miss'), stats['misses'])
+            evictions.inc((name,), stats['evictions'])
+        return size, lookups, evictions
+    return collect
+
+
+class _RequestDbStats:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_request_db_stats: ContextVar[_RequestDbStats | None] = ContextVar('request_db_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['metrics_query_started'].pop()
+    db_query_duration.observe((), elapsed)
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += elapsed
+
+
+def _handle_error(context):
+    # a failed statement gets no after_cursor_execute, drop its start time so the next one is timed from its own
+    started = context.connection.info.get('metrics_query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine):
+    """Time the queries of ``engine`` (sync or async) and attribute them to the request running them."""
+    sync_engine = getattr(engine, 'sync_engine', engine)
+    if not event.contains(sync_engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(sync_engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(sync_engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(sync_engine, 'handle_error', _handle_error)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, avoids the per-request task and body buffering of ``BaseHTTPMiddleware``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        stats = _RequestDbStats()
+        token = _request_db_stats.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_requests_in_flight.dec()
+            _request_db_stats.reset(token)
+            # the router stores the matched route in the scope, its path template keeps the label set bounded
+            route = scope.get('route')
+            labels = (scope['method'], route.path if route is not None else 'unmatched')
+            http_requests.inc(labels + (status,))
+            http_request_duration.observe(labels, elapsed)
+            if stats.queries:
+                db_queries.inc(labels, stats.queries)
+                db_query_time.inc(labels, stats.seconds)
@@ -0,0 +1,257 @@
+"""Versioned schema migrations.
+
+Each migration is a function taking a sync ``Connection`` and is applied once, in order, by ``upgrade``.
+Applied versions are recorded in the ``schema_version`` table. Migrations describe the schema with their own
+``Table`` definitions rather than ``src.models`` so that they keep producing the same DDL as the models evolve.
+"""
+from datetime import datetime
+import sqlalchemy as sa
+
+
+schema_version = sa.Table(
+    'schema_version', sa.MetaData(),
+    sa.Column('version', sa.Integer, primary_key=True),
+    sa.Column('description', sa.String(200), nullable=False),
+    sa.Column('applied_timestamp', sa.DateTime, nullable=False),
+)
+
+
+def _initial_schema(conn):
+    # the schema before migrations existed; tables already present (e.g. in local.db) are left untouched
+    metadata = sa.MetaData()
+    sa.Table(
+        'passenger_info', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, index=True),
+        sa.Column('full_name', sa.String(100), nullable=False),
+        sa.Column('email', sa.String(100), unique=True, nullable=False),
+        sa.Column('phone_number', sa.String(15), nullable=False),
+    )
+    sa.Table(
+        'flight_details', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, index=True),
+        sa.Column('flight_number', sa.String(10), nullable=False),
+        sa.Column('airline', sa.String(50), nullable=False),
+        sa.Column('origin_airport', sa.String(50), nullable=False),
+        sa.Column('destination_airport', sa.String(50), nullable=False),
+        sa.Column('departure_datetime', sa.DateTime, nullable=False),
+        sa.Column('arrival_datetime', sa.DateTime, nullable=False),
+        sa.Column('seat_information', sa.String(5), nullable=False),
+        sa.Column('travel_class', sa.String(10), nullable=False),
+    )
+    sa.Table(
+        'auth_user', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('username', sa.String, unique=True, nullable=False),
+        sa.Column('password', sa.String, nullable=False),
+    )
+    sa.Table(
+        'reservations', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, index=True),
+        sa.Column('total_price', sa.Float, nullable=False),
+        sa.Column('reservation_status', sa.String(20), nullable=False),
+        sa.Column('creation_timestamp', sa.DateTime),
+        sa.Column('last_update_timestamp', sa.DateTime),
+        sa.Column('passenger_info_id', sa.Integer, sa.ForeignKey('passenger_info.id'), nullable=False),
+        sa.Column('flight_details_id', sa.Integer, sa.ForeignKey('flight_details.id'), nullable=False),
+        sa.Column('auth_user_id', sa.Integer, sa.ForeignKey('auth_user.id'), nullable=False),
+    )
+    sa.Table(
+        'notification_outbox', metadata,
+        sa.Column('id', sa.Integer, primary_key=True, index=True),
+        sa.Column('email', sa.String(100), nullable=False),
+        sa.Column('message', sa.String, nullable=False),
+        sa.Column('status', sa.String(10), nullable=False),
+        sa.Column('attempts', sa.Integer, nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime, nullable=False),
+        sa.Column('last_error', sa.String, nullable=True),
+        sa.Column('creation_timestamp', sa.DateTime),
+        sa.Column('sent_timestamp', sa.DateTime, nullable=True),
+    )
+    metadata.create_all(conn)
+
+
+def _hot_query_indexes(conn):
+    metadata = sa.MetaData()
+    flight_details = sa.Table('flight_details', metadata, autoload_with=conn)
+    reservations = sa.Table('reservations', metadata, autoload_with=conn)
+    notification_outbox = sa.Table('notification_outbox', metadata, autoload_with=conn)
+    indexes = [
+        # flight lookup and the ON CONFLICT target of the create upsert
+        sa.Index('ix_flight_details_flight_number', flight_details.c.flight_number, unique=True),
+        # GET /reservations: equality on the user, keyset range and ordering on the id
+        sa.Index('ix_reservations_auth_user_id_id', reservations.c.auth_user_id, reservations.c.id),
+        # one reservation per passenger and flight, backs the duplicate reservation check
+        sa.Index(
+            'ux_reservations_passenger_flight',
+            reservations.c.passenger_info_id, reservations.c.flight_details_id, unique=True
+        ),
+        sa.Index('ix_notification_outbox_due', notification_outbox.c.status, notification_outbox.c.next_attempt_at),
+    ]
+    for index in indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _reservations_covering_index(conn):
+    metadata = sa.MetaData()
+    reservations = sa.Table('reservations', metadata, autoload_with=conn)
+    # also covers last_update_timestamp, so conditional GETs are answered from the index alone
+    sa.Index(
+        'ix_reservations_auth_user_id_id_updated',
+        reservations.c.auth_user_id, reservations.c.id, reservations.c.last_update_timestamp
+    ).create(conn, checkfirst=True)
+    # superseded, the new index has the same leading columns
+    sa.Index('ix_reservations_auth_user_id_id', reservations.c.auth_user_id).drop(conn, checkfirst=True)
+
+
+def _search_indexes(conn):
+    metadata = sa.MetaData()
+    flight_details = sa.Table('flight_details', metadata, autoload_with=conn)
+    reservations = sa.Table('reservations', metadata, autoload_with=conn)
+    indexes = [
+        # GET /reservations?reservation_status=...: equality on user and status, ordering and keyset on id
+        sa.Index(
+            'ix_reservations_user_status_id',
+            reservations.c.auth_user_id, reservations.c.reservation_status, reservations.c.id
+        ),
+        # the flight filters select flights first, then their reservations
+        sa.Index('ix_reservations_flight', reservations.c.flight_details_id),
+        sa.Index(
+            'ix_flight_details_route_departure',
+            flight_details.c.origin_airport, flight_details.c.destination_airport, flight_details.c.departure_datetime
+        ),
+        sa.Index('ix_flight_details_departure', flight_details.c.departure_datetime),
+    ]
+    for index in indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _reservation_summary(conn):
+    metadata = sa.MetaData()
+    sa.Table('auth_user', metadata, autoload_with=conn)
+    sa.Table('flight_details', metadata, autoload_with=conn)
+    summary = sa.Table(
+        'reservation_summary', metadata,
+        sa.Column('auth_user_id', sa.Integer, sa.ForeignKey('auth_user.id'), primary_key=True),
+        sa.Column('flight_details_id', sa.Integer, sa.ForeignKey('flight_details.id'), primary_key=True),
+        sa.Column('reservation_status', sa.String(20), primary_key=True),
+        sa.Column('bookings', sa.Integer, nullable=False),
+        sa.Column('revenue', sa.Float, nullable=False),
+    )
+    summary.create(conn, checkfirst=True)
+    # the endpoints only apply deltas from now on, start from the existing reservations
+    conn.execute(sa.delete(summary))
+    conn.execute(sa.text(
+        "INSERT INTO reservation_summary (auth_user_id, flight_details_id, reservation_status, bookings, revenue) "
+        "SELECT auth_user_id, flight_details_id, reservation_status, count(*), sum(total_price) FROM reservations "
+        "GROUP BY auth_user_id, flight_details_id, reservation_status"
+    ))
+
+
+def _seat_inventory(conn):
+    metadata = sa.MetaData()
+    sa.Table('flight_details', metadata, autoload_with=conn)
+    reservations = sa.Table('reservations', metadata, autoload_with=conn)
+    if 'seat_information' not in reservations.c:
+        conn.execute(sa.text("ALTER TABLE reservations ADD COLUMN seat_information VARCHAR(5)"))
+    # reservations so far booked the seat of their flight row, without the leading zero of the row number
+    conn.execute(sa.text(
+        "UPDATE reservations SET seat_information = ("
+        "SELECT CASE WHEN length(f.seat_information) = 3 AND substr(f.seat_information, 1, 1) = '0' "
+        "THEN substr(f.seat_information, 2) ELSE f.seat_information END "
+        "FROM flight_details f WHERE f.id = reservations.flight_details_id"
+        ") WHERE seat_information IS NULL"
+    ))
+    seat_assignments = sa.Table(
+        'seat_assignments', metadata,
+        sa.Column('flight_details_id', sa.Integer, sa.ForeignKey('flight_details.id'), primary_key=True),
+        sa.Column('seat_information', sa.String(5), primary_key=True),
+        sa.Column('reservation_id', sa.Integer, sa.ForeignKey('reservations.id'), nullable=False, unique=True),
+    )
+    seat_assignments.create(conn, checkfirst=True)
+    # a seat already booked several times stays with its first reservation
+    conn.execute(sa.text(
+        "INSERT INTO seat_assignments (flight_details_id, seat_information, reservation_id) "
+        "SELECT flight_details_id, seat_information, min(id) FROM reservations "
+        "WHERE reservation_status != 'cancelled' GROUP BY flight_details_id, seat_information"
+    ))
+
+
+def _idempotency_keys(conn):
+    metadata = sa.MetaData()
+    sa.Table('auth_user', metadata, autoload_with=conn)
+    idempotency_keys = sa.Table(
+        'idempotency_keys', metadata,
+        sa.Column('auth_user_id', sa.Integer, sa.ForeignKey('auth_user.id'), primary_key=True),
+        sa.Column('key', sa.String(255), primary_key=True),
+        sa.Column('request_hash', sa.String(64), nullable=False),
+        sa.Column('response', sa.Text, nullable=True),
+        sa.Column('creation_timestamp', sa.DateTime, nullable=False),
+        # expired keys are purged by creation time
+        sa.Index('ix_idempotency_keys_created', 'creation_timestamp'),
+    )
+    idempotency_keys.create(conn, checkfirst=True)
+
+
+def _reservation_version(conn):
+    reservations = sa.Table('reservations', sa.MetaData(), autoload_with=conn)
+    if 'version' not in reservations.c:
+        conn.execute(sa.text("ALTER TABLE reservations ADD COLUMN version INTEGER DEFAULT 1 NOT NULL"))
+
+
+def _reservation_events(conn):
+    metadata = sa.MetaData()
+    sa.Table('auth_user', metadata, autoload_with=conn)
+    reservation_events = sa.Table(
+        'reservation_events', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('auth_user_id', sa.Integer, sa.ForeignKey('auth_user.id'), nullable=False),
+        # no foreign key, the events of deleted reservations stay
+        sa.Column('reservation_id', sa.Integer, nullable=False),
+        sa.Column('event', sa.String(10), nullable=False),
+        sa.Column('creation_timestamp', sa.DateTime, nullable=False),
+        # replay of a user's feed from a sequence number, and the purge of old events
+        sa.Index('ix_reservation_events_user_id', 'auth_user_id', 'id'),
+        sa.Index('ix_reservation_events_created', 'creation_timestamp'),
+    )
+    reservation_events.create(conn, checkfirst=True)
+
+
+def _notification_coalescing(conn):
+    notification_outbox = sa.Table('notification_outbox', sa.MetaData(), autoload_with=conn)
+    for column in ('reservation_id INTEGER', 'action VARCHAR(10)'):
+        if column.split()[0] not in notification_outbox.c:
+            conn.execute(sa.text(f"ALTER TABLE notification_outbox ADD COLUMN {column}"))
+    notification_outbox = sa.Table('notification_outbox', sa.MetaData(), autoload_with=conn)
+    sa.Index('ix_notification_outbox_reservation_id', notification_outbox.c.reservation_id).create(
+        conn, checkfirst=True
+    )
+
+
+MIGRATIONS = [
+    (1, "initial schema", _initial_schema),
+    (2, "indexes for hot query predicates", _hot_query_indexes),
+    (3, "reservations index covering last_update_timestamp", _reservations_covering_index),
+    (4, "indexes for reservation search filters", _search_indexes),
+    (5, "reservation_summary reporting table", _reservation_summary),
+    (6, "seat inventory", _seat_inventory),
+    (7, "idempotency keys of POST /reservations", _idempotency_keys),
+    (8, "reservations version for optimistic concurrency control", _reservation_version),
+    (9, "reservation change feed events", _reservation_events),
+    (10, "notification_outbox reservation for coalescing", _notification_coalescing),
+]
+
+
+def upgrade(conn):
+    """Apply the migrations missing from ``schema_version``, returns the versions applied."""
+    schema_version.create(conn, checkfirst=True)
+    applied = set(conn.execute(sa.select(schema_version.c.version)).scalars())
+    newly_applied = []
+    for version, description, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        migration(conn)
+        conn.execute(sa.insert(schema_version).values(
+            version=version, description=description, applied_timestamp=datetime.now()
+        ))
+        newly_applied.append(version)
+    return newly_applied
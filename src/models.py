@@ -1,11 +1,19 @@
 from sqlalchemy.orm import relationship, declarative_base
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index, Text
 from datetime import datetime
 import base64
+import secrets
+import bcrypt
 
 
 Base = declarative_base()
 
+BCRYPT_PREFIX = '$2'
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
 
 class PassengerInfo(Base):
     __tablename__ = 'passenger_info'
@@ -23,7 +31,7 @@ class FlightDetails(Base):
     __tablename__ = 'flight_details'
 
     id = Column(Integer, primary_key=True, index=True)
-    flight_number = Column(String(10), nullable=False)
+    flight_number = Column(String(10), nullable=False, unique=True, index=True)
     airline = Column(String(50), nullable=False)
     origin_airport = Column(String(50), nullable=False)
     destination_airport = Column(String(50), nullable=False)
@@ -32,6 +40,11 @@ class FlightDetails(Base):
     seat_information = Column(String(5), nullable=False)
     travel_class = Column(String(10), nullable=False)
 
+    __table_args__ = (
+        Index('ix_flight_details_route_departure', 'origin_airport', 'destination_airport', 'departure_datetime'),
+        Index('ix_flight_details_departure', 'departure_datetime'),
+    )
+
     def __str__(self):
         return self.__tablename__
 
@@ -48,9 +61,22 @@ class Reservation(Base):
     passenger_info_id = Column(Integer, ForeignKey('passenger_info.id'), nullable=False)
     flight_details_id = Column(Integer, ForeignKey('flight_details.id'), nullable=False)
     auth_user_id = Column(Integer, ForeignKey('auth_user.id'), nullable=False)
-
-    passenger_info = relationship("PassengerInfo", backref="reservations")
-    flight_details = relationship("FlightDetails", backref="reservations")
+    # the booked seat, flight_details.seat_information is the seat of the flight's first reservation
+    seat_information = Column(String(5), nullable=True)
+    # incremented by every UPDATE, which only applies to the version it was read at
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __table_args__ = (
+        Index('ix_reservations_auth_user_id_id_updated', 'auth_user_id', 'id', 'last_update_timestamp'),
+        Index('ux_reservations_passenger_flight', 'passenger_info_id', 'flight_details_id', unique=True),
+        Index('ix_reservations_user_status_id', 'auth_user_id', 'reservation_status', 'id'),
+        Index('ix_reservations_flight', 'flight_details_id'),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+    # many-to-one and always serialized with the reservation, so load both in the same SELECT
+    passenger_info = relationship("PassengerInfo", backref="reservations", lazy="joined", innerjoin=True)
+    flight_details = relationship("FlightDetails", backref="reservations", lazy="joined", innerjoin=True)
 
     def __str__(self):
         return self.__tablename__
@@ -65,3 +91,103 @@ class AuthUser(Base):
 
     def decode_pass(self):
         return base64.b64decode(self.password.encode('utf-8')).decode('utf-8')
+
+    def needs_rehash(self):
+        # rows created before bcrypt hold base64 encoded passwords
+        return not self.password.startswith(BCRYPT_PREFIX)
+
+    def set_password(self, password: str):
+        self.password = hash_password(password)
+
+    def check_password(self, password: str) -> bool:
+        if self.needs_rehash():
+            return secrets.compare_digest(password.encode('utf-8'), self.decode_pass().encode('utf-8'))
+        return bcrypt.checkpw(password.encode('utf-8'), self.password.encode('utf-8'))
+
+
+class NotificationOutbox(Base):
+    __tablename__ = 'notification_outbox'
+
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String(100), nullable=False)
+    message = Column(String, nullable=False)
+    status = Column(String(10), nullable=False, default='pending')  # pending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.now)
+    last_error = Column(String, nullable=True)
+    creation_timestamp = Column(DateTime, default=datetime.now)
+    sent_timestamp = Column(DateTime, nullable=True)
+    # later notifications of the reservation are merged into a row still pending, see src.email_notify
+    reservation_id = Column(Integer, nullable=True)
+    action = Column(String(10), nullable=True)  # created, updated
+
+    __table_args__ = (
+        Index('ix_notification_outbox_due', 'status', 'next_attempt_at'),
+        Index('ix_notification_outbox_reservation_id', 'reservation_id'),
+    )
+
+    def __str__(self):
+        return self.__tablename__
+
+
+class ReservationSummary(Base):
+    """Bookings and revenue per user, flight and status, kept in step with ``reservations`` by ``src.reporting``."""
+    __tablename__ = 'reservation_summary'
+
+    auth_user_id = Column(Integer, ForeignKey('auth_user.id'), primary_key=True)
+    flight_details_id = Column(Integer, ForeignKey('flight_details.id'), primary_key=True)
+    reservation_status = Column(String(20), primary_key=True)
+    bookings = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+
+    def __str__(self):
+        return self.__tablename__
+
+
+class SeatAssignment(Base):
+    """Seat held by a reservation, see ``src.seats``; the primary key allows one reservation per seat."""
+    __tablename__ = 'seat_assignments'
+
+    flight_details_id = Column(Integer, ForeignKey('flight_details.id'), primary_key=True)
+    seat_information = Column(String(5), primary_key=True)
+    reservation_id = Column(Integer, ForeignKey('reservations.id'), nullable=False, unique=True)
+
+    def __str__(self):
+        return self.__tablename__
+
+
+class IdempotencyKey(Base):
+    """Response of a ``POST /reservations`` sent with an ``Idempotency-Key``, see ``src.idempotency``."""
+    __tablename__ = 'idempotency_keys'
+
+    auth_user_id = Column(Integer, ForeignKey('auth_user.id'), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    response = Column(Text, nullable=True)
+    creation_timestamp = Column(DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        Index('ix_idempotency_keys_created', 'creation_timestamp'),
+    )
+
+    def __str__(self):
+        return self.__tablename__
+
+
+class ReservationEvent(Base):
+    """Change of a reservation, numbered by ``id``, delivered by the change feed in ``src.feed``."""
+    __tablename__ = 'reservation_events'
+
+    id = Column(Integer, primary_key=True)
+    auth_user_id = Column(Integer, ForeignKey('auth_user.id'), nullable=False)
+    reservation_id = Column(Integer, nullable=False)
+    event = Column(String(10), nullable=False)  # created, updated, deleted
+    creation_timestamp = Column(DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        Index('ix_reservation_events_user_id', 'auth_user_id', 'id'),
+        Index('ix_reservation_events_created', 'creation_timestamp'),
+    )
+
+    def __str__(self):
+        return self.__tablename__
@@ -0,0 +1,121 @@
+"""Booking and revenue reports from the ``reservation_summary`` table.
+
+The reservation endpoints apply their changes to the summary as deltas, in the transaction that changes the
+reservations, so reports never group the ``reservations`` table itself. ``rebuild`` recomputes the summary from
+scratch:
+
+    python -m src.reporting rebuild
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from sqlalchemy import delete, func, insert, select, text
+from src import models
+from src.database import dialect_insert, make_engine, make_session_factory
+
+
+REPORT_DIMENSIONS = {
+    'flight_number': models.FlightDetails.flight_number,
+    'airline': models.FlightDetails.airline,
+    'travel_class': models.FlightDetails.travel_class,
+    'reservation_status': models.ReservationSummary.reservation_status,
+}
+
+
+class SummaryDelta:
+    """Changes to ``reservation_summary`` collected while handling a request, applied by ``apply``."""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0, 0.0])
+
+    def add(self, auth_user_id: int, flight_details_id: int, reservation_status: str, total_price: float):
+        delta = self._deltas[(auth_user_id, flight_details_id, reservation_status)]
+        delta[0] += 1
+        delta[1] += total_price
+
+    def remove(self, auth_user_id: int, flight_details_id: int, reservation_status: str, total_price: float):
+        delta = self._deltas[(auth_user_id, flight_details_id, reservation_status)]
+        delta[0] -= 1
+        delta[1] -= total_price
+
+    async def apply(self, db):
+        rows = [
+            {
+                'auth_user_id': auth_user_id, 'flight_details_id': flight_details_id,
+                'reservation_status': reservation_status, 'bookings': bookings, 'revenue': revenue,
+            }
+            for (auth_user_id, flight_details_id, reservation_status), (bookings, revenue) in self._deltas.items()
+            if bookings or revenue
+        ]
+        if not rows:
+            return
+        stmt = dialect_insert(db, models.ReservationSummary)
+        # increments are applied by the database, so concurrent writers never overwrite each other's counts
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=['auth_user_id', 'flight_details_id', 'reservation_status'],
+            set_={
+                'bookings': models.ReservationSummary.bookings + stmt.excluded.bookings,
+                'revenue': models.ReservationSummary.revenue + stmt.excluded.revenue,
+            }
+        ), rows)
+
+
+def report_query(auth_user_id: int, group_by: list[str]):
+    columns = [REPORT_DIMENSIONS[name].label(name) for name in group_by]
+    summary = models.ReservationSummary
+    return select(
+        *columns, func.sum(summary.bookings).label('bookings'), func.sum(summary.revenue).label('revenue')
+    ).select_from(summary).join(
+        models.FlightDetails, summary.flight_details_id == models.FlightDetails.id
+    ).filter(
+        summary.auth_user_id == auth_user_id
+    ).group_by(*columns).having(func.sum(summary.bookings) > 0).order_by(*columns)
+
+
+def full_report_query(auth_user_id: int, group_by: list[str]):
+    """``report_query`` computed from ``reservations`` directly, what the summary has to agree with."""
+    columns = [
+        (models.Reservation.reservation_status if name == 'reservation_status' else REPORT_DIMENSIONS[name]).label(name)
+        for name in group_by
+    ]
+    return select(
+        *columns, func.count().label('bookings'), func.sum(models.Reservation.total_price).label('revenue')
+    ).select_from(models.Reservation).join(
+        models.FlightDetails, models.Reservation.flight_details_id == models.FlightDetails.id
+    ).filter(
+        models.Reservation.auth_user_id == auth_user_id
+    ).group_by(*columns).order_by(*columns)
+
+
+async def rebuild(db):
+    """Recompute the whole summary from ``reservations`` in one transaction, returns the number of rows."""
+    if db.bind.dialect.name == 'postgresql':
+        # writers would apply deltas to rows being replaced, hold them off until the rebuild commits
+        await db.execute(text("LOCK TABLE reservations IN SHARE MODE"))
+    await db.execute(delete(models.ReservationSummary))
+    reservation = models.Reservation
+    result = await db.execute(insert(models.ReservationSummary).from_select(
+        ['auth_user_id', 'flight_details_id', 'reservation_status', 'bookings', 'revenue'],
+        select(
+            reservation.auth_user_id, reservation.flight_details_id, reservation.reservation_status,
+            func.count(), func.sum(reservation.total_price)
+        ).group_by(reservation.auth_user_id, reservation.flight_details_id, reservation.reservation_status)
+    ))
+    await db.commit()
+    return result.rowcount
+
+
+async def _rebuild_command():
+    engine = make_engine()
+    try:
+        async with make_session_factory(engine)() as db:
+            print(f"reservation_summary rebuilt with {await rebuild(db)} rows")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reporting maintenance")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: recompute reservation_summary from scratch")
+    args = parser.parse_args()
+    asyncio.run(_rebuild_command())
@@ -3,6 +3,20 @@ import re
 from datetime import datetime
 
 
+def _check_full_name(value):
+    if not re.match(r"^[a-zA-Z\s'-]+$", value):
+        raise ValueError("Full name must contain only letters, spaces, hyphens, or apostrophes.")
+    if len(value.split()) < 2:
+        raise ValueError("Full name must include at least a first and last name.")
+    return value.strip()
+
+
+def _check_phone_number(value):
+    if not re.match(r"^\+?[0-9]{9,15}$", value):
+        raise ValueError("Phone number must contain only digits and may include an optional '+' prefix.")
+    return value.strip()
+
+
 class PassengerInfo(BaseModel):
     id: int = Field(default=None)
     full_name: str = Field(..., min_length=3, max_length=100, description="Full name of the passenger")
@@ -12,18 +26,12 @@ class PassengerInfo(BaseModel):
     @field_validator("full_name")
     @classmethod
     def validate_full_name(cls, value):
-        if not re.match(r"^[a-zA-Z\s'-]+$", value):
-            raise ValueError("Full name must contain only letters, spaces, hyphens, or apostrophes.")
-        if len(value.split()) < 2:
-            raise ValueError("Full name must include at least a first and last name.")
-        return value.strip()
+        return _check_full_name(value)
 
     @field_validator("phone_number")
     @classmethod
     def validate_phone_number(cls, value):
-        if not re.match(r"^\+?[0-9]{9,15}$", value):
-            raise ValueError("Phone number must contain only digits and may include an optional '+' prefix.")
-        return value.strip()
+        return _check_phone_number(value)
 
     class Config:
         from_attributes = True
@@ -55,6 +63,56 @@ class Reservation(BaseModel):
         from_attributes = True
 
 
+class PassengerInfoPatch(BaseModel):
+    full_name: str | None = Field(None, min_length=3, max_length=100, description="Full name of the passenger")
+    email: EmailStr | None = Field(None, description="Email address of the passenger")
+    phone_number: str | None = Field(None, min_length=10, max_length=15, description="Phone number of the passenger")
+
+    @field_validator("full_name")
+    @classmethod
+    def validate_full_name(cls, value):
+        # null keeps the stored value
+        return None if value is None else _check_full_name(value)
+
+    @field_validator("phone_number")
+    @classmethod
+    def validate_phone_number(cls, value):
+        return None if value is None else _check_phone_number(value)
+
+    class Config:
+        extra = 'forbid'
+
+
+class FlightDetailsPatch(BaseModel):
+    flight_number: str | None = Field(None, min_length=3, max_length=10, description="Flight number")
+    airline: str | None = Field(None, min_length=3, max_length=50, description="Airline name")
+    origin_airport: str | None = Field(None, min_length=3, max_length=50, description="Origin airport code or name")
+    destination_airport: str | None = Field(
+        None, min_length=3, max_length=50, description="Destination airport code or name"
+    )
+    departure_datetime: datetime | None = Field(None, description="Departure date and time")
+    arrival_datetime: datetime | None = Field(None, description="Arrival date and time")
+    seat_information: str | None = Field(None, pattern="^[0-9]{1,2}[A-Z]{1}$", description="Seat number")
+    travel_class: str | None = Field(None, pattern="^(economy|business|first)$", description="Class of travel")
+
+    class Config:
+        extra = 'forbid'
+
+
+class ReservationPatch(BaseModel):
+    """Body of ``PATCH /reservations/{reservation_id}``: only the fields to change, omitted or null ones are kept."""
+
+    passenger_info: PassengerInfoPatch | None = None
+    flight_details: FlightDetailsPatch | None = None
+    total_price: float | None = Field(None, gt=0, description="Total price of the reservation")
+    reservation_status: str | None = Field(
+        None, pattern="^(confirmed|pending|cancelled)$", description="Status of the reservation"
+    )
+
+    class Config:
+        extra = 'forbid'
+
+
 class ReservationOut(BaseModel):
 
     id: int = Field(default=None)
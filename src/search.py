@@ -0,0 +1,137 @@
+"""Server-side filtering and ordering of ``GET /reservations``.
+
+Every filter maps to an indexed column: the reservation status to ``ix_reservations_user_status_id``, the flight
+filters to the ``flight_details`` indexes, from which reservations are reached through ``ix_reservations_flight``.
+"""
+from datetime import datetime
+from typing import Literal
+from fastapi import HTTPException, Query
+from sqlalchemy import func, select, tuple_
+from src import models
+
+
+SORT_COLUMNS = {
+    'id': models.Reservation.id,
+    'total_price': models.Reservation.total_price,
+    'departure_datetime': models.FlightDetails.departure_datetime,
+}
+# parse the after_value cursor and read it back from a serialized reservation
+_CURSOR_VALUES = {
+    'total_price': (float, lambda reservation: reservation['total_price']),
+    'departure_datetime': (
+        datetime.fromisoformat, lambda reservation: reservation['flight_details']['departure_datetime'].isoformat()
+    ),
+}
+Sort = Literal['id', '-id', 'total_price', '-total_price', 'departure_datetime', '-departure_datetime']
+
+
+class ReservationSearch:
+    """Query parameters of the reservation search, used as a dependency."""
+
+    def __init__(
+            self,
+            reservation_status: list[Literal['confirmed', 'pending', 'cancelled']] = Query(
+                None, description="Only reservations with one of these statuses, may be repeated"
+            ),
+            flight_number: str = Query(None, max_length=10),
+            origin_airport: str = Query(None, max_length=50),
+            destination_airport: str = Query(None, max_length=50),
+            departure_from: datetime = Query(None, description="Departure at or after this time"),
+            departure_to: datetime = Query(None, description="Departure before this time"),
+            sort: Sort = Query('id', description="Order by this field, descending with a '-' prefix"),
+            include_total: bool = Query(
+                False, description="Count all matching reservations into the X-Total-Count header"
+            ),
+    ):
+        self.reservation_status = reservation_status
+        self.flight_number = flight_number
+        self.origin_airport = origin_airport
+        self.destination_airport = destination_airport
+        self.departure_from = departure_from
+        self.departure_to = departure_to
+        self.sort = sort
+        self.include_total = include_total
+
+    @property
+    def descending(self) -> bool:
+        return self.sort.startswith('-')
+
+    @property
+    def sort_column(self):
+        return SORT_COLUMNS[self.sort.lstrip('-')]
+
+    @property
+    def filters_flight(self) -> bool:
+        return bool(
+            self.flight_number or self.origin_airport or self.destination_airport
+            or self.departure_from or self.departure_to
+        )
+
+    def filters(self) -> list:
+        reservation, flight = models.Reservation, models.FlightDetails
+        filters = []
+        if self.reservation_status:
+            filters.append(reservation.reservation_status.in_(self.reservation_status))
+        if self.flight_number:
+            filters.append(flight.flight_number == self.flight_number)
+        if self.origin_airport:
+            filters.append(flight.origin_airport == self.origin_airport)
+        if self.destination_airport:
+            filters.append(flight.destination_airport == self.destination_airport)
+        if self.departure_from:
+            filters.append(flight.departure_datetime >= self.departure_from)
+        if self.departure_to:
+            filters.append(flight.departure_datetime < self.departure_to)
+        return filters
+
+    def apply(self, query, joined: bool = False, ordered: bool = True):
+        """Filter ``query``, a select from ``reservations``; ``joined`` when it already joins ``flight_details``."""
+        needs_flight = self.filters_flight or (ordered and self.sort_column.class_ is models.FlightDetails)
+        if needs_flight and not joined:
+            query = query.join(models.FlightDetails, models.Reservation.flight_details_id == models.FlightDetails.id)
+        return query.filter(*self.filters())
+
+    def cursor(self, reservation: dict) -> dict:
+        """Query parameters continuing after ``reservation``, the last one of a page."""
+        cursor = {'after_id': reservation['id']}
+        if self.sort_column is not models.Reservation.id:
+            cursor['after_value'] = _CURSOR_VALUES[self.sort.lstrip('-')][1](reservation)
+        return cursor
+
+    def page(self, query, after_id: int | None, limit: int | None, after_value: str | None = None):
+        """Order the filtered ``query`` and seek past the keyset cursor ``after_id`` (and ``after_value``)."""
+        column, reservation_id = self.sort_column, models.Reservation.id
+        if after_id is not None:
+            if column is reservation_id:
+                query = query.filter(reservation_id < after_id if self.descending else reservation_id > after_id)
+            else:
+                # the cursor is the (sort value, id) of the reservation the previous page ended with
+                if after_value is not None:
+                    try:
+                        after_value = _CURSOR_VALUES[self.sort.lstrip('-')][0](after_value)
+                    except ValueError:
+                        raise HTTPException(status_code=422, detail=f"Invalid after_value for sort {self.sort}")
+                else:
+                    # looked up when only after_id is given, which ends the listing if it was deleted since
+                    after_value = select(column).select_from(models.Reservation).filter(reservation_id == after_id)
+                    if column.class_ is models.FlightDetails:
+                        after_value = after_value.join(
+                            models.FlightDetails, models.Reservation.flight_details_id == models.FlightDetails.id
+                        )
+                    after_value = after_value.scalar_subquery()
+                key, cursor = tuple_(column, reservation_id), tuple_(after_value, after_id)
+                query = query.filter(key < cursor if self.descending else key > cursor)
+        if column is reservation_id:
+            order = [reservation_id.desc() if self.descending else reservation_id]
+        else:
+            order = [column.desc(), reservation_id.desc()] if self.descending else [column, reservation_id]
+        query = query.order_by(*order)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def count(self, auth_user_id: int):
+        query = select(func.count()).select_from(models.Reservation).filter(
+            models.Reservation.auth_user_id == auth_user_id
+        )
+        return self.apply(query, ordered=False)
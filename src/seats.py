@@ -0,0 +1,118 @@
+"""Seat inventory: the seats held on each flight, as one bitmap per flight.
+
+A reservation holds its seat unless it is cancelled. Holds are rows of ``seat_assignments``, whose primary key on
+(flight, seat) rejects a second hold on the same seat. The bitmaps of recently used flights are cached, so a taken
+seat is refused without a database round trip and ``GET /flights/{flight_number}/seats`` never reads reservations.
+"""
+import base64
+from sqlalchemy import delete, select
+from src import models
+from src.cache import TTLCache
+from src.database import dialect_insert
+
+
+# seat_information is a row number of one or two digits and a letter
+SEAT_ROWS = 100
+SEATS_PER_ROW = 26
+SEAT_MAP_SIZE = 4096
+# Seats released by another worker process may be reported as taken for at most this long. Seats taken by another
+# worker but still free in the bitmap are refused by the primary key of seat_assignments.
+SEAT_MAP_TTL = 10  # seconds
+
+# SeatMap of every recently used flight, keyed on flight_details.id
+seat_maps = TTLCache(maxsize=SEAT_MAP_SIZE, ttl=SEAT_MAP_TTL)
+
+
+def canonical_seat(seat: str) -> str:
+    """``01A`` and ``1A`` are the same seat, store it without the leading zero."""
+    return f'{int(seat[:-1])}{seat[-1]}'
+
+
+def holds_seat(reservation_status: str) -> bool:
+    return reservation_status != 'cancelled'
+
+
+def _seat_index(seat: str) -> int:
+    return int(seat[:-1]) * SEATS_PER_ROW + ord(seat[-1]) - ord('A')
+
+
+class SeatMap:
+    """Bitmap of the taken seats of a flight, bit ``row * 26 + letter`` (``A`` = 0) in little-endian bit order."""
+    __slots__ = ('bits',)
+
+    def __init__(self, seats=()):
+        self.bits = bytearray(SEAT_ROWS * SEATS_PER_ROW // 8)
+        for seat in seats:
+            self.take(seat)
+
+    def is_taken(self, seat: str) -> bool:
+        index = _seat_index(seat)
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def take(self, seat: str):
+        index = _seat_index(seat)
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def release(self, seat: str):
+        index = _seat_index(seat)
+        self.bits[index >> 3] &= ~(1 << (index & 7))
+
+    def taken(self) -> list[str]:
+        seats = []
+        for byte_index, byte in enumerate(self.bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    row, letter = divmod(byte_index * 8 + bit, SEATS_PER_ROW)
+                    seats.append(f'{row}{chr(ord("A") + letter)}')
+        return seats
+
+    def as_dict(self) -> dict:
+        return {
+            'rows': SEAT_ROWS,
+            'seats_per_row': SEATS_PER_ROW,
+            'taken': self.taken(),
+            'bitmap': base64.b64encode(self.bits).decode('ascii'),
+        }
+
+
+async def seat_map(db, flight_details_id: int) -> SeatMap:
+    """The cached map of a flight, loaded from ``seat_assignments`` on a miss."""
+    seats = seat_maps.get(flight_details_id)
+    if seats is None:
+        seats = SeatMap(await db.scalars(
+            select(models.SeatAssignment.seat_information)
+            .filter(models.SeatAssignment.flight_details_id == flight_details_id)
+        ))
+        seat_maps.set(flight_details_id, seats)
+    return seats
+
+
+async def hold_seat(db, flight_details_id: int, seat: str, reservation_id: int) -> bool:
+    """Hold ``seat`` for the reservation, False when it is taken already."""
+    held = await db.execute(dialect_insert(db, models.SeatAssignment).values(
+        flight_details_id=flight_details_id, seat_information=seat, reservation_id=reservation_id
+    ).on_conflict_do_nothing().returning(models.SeatAssignment.reservation_id))
+    return held.one_or_none() is not None
+
+
+async def release_seat(db, reservation_id: int) -> bool:
+    """Release the seat held by the reservation, False when it held none."""
+    released = await db.execute(
+        delete(models.SeatAssignment).filter(models.SeatAssignment.reservation_id == reservation_id)
+    )
+    return released.rowcount > 0
+
+
+def mark_taken(flight_details_id: int, seat: str):
+    """Apply a committed hold to the cached map of the flight."""
+    seats = seat_maps.get(flight_details_id)
+    if seats is not None:
+        seats.take(seat)
+
+
+def mark_free(flight_details_id: int, seat: str):
+    seats = seat_maps.get(flight_details_id)
+    if seats is not None:
+        seats.release(seat)
@@ -1,14 +1,33 @@
+import asyncio
+import base64
+import csv
+import gzip
+import io
 import time
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import httpx
 import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from src.database import Base, get_db
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, select
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 from fastapi.testclient import TestClient
 from main import app
 import json
-from unittest.mock import AsyncMock
-from src import models
+from unittest.mock import AsyncMock, patch
+import bcrypt
+from src.catalog import flight_cache
+from src.seats import seat_maps
+from src import metrics
+from src.metrics import instrument_engine
+from src import conditional, export, importer, models, reporting, schemas, seats
+from src.auth import credentials_cache
+from src.database import make_engine
+from src.settings import Settings, settings
 from copy import deepcopy
 
 
@@ -18,15 +37,14 @@ engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+instrument_engine(async_engine)
+AsyncTestingSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
 
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        Base.metadata.create_all(bind=db.bind)
+async def override_get_db():
+    async with AsyncTestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @pytest.fixture(autouse=True)
@@ -37,16 +55,40 @@ def mock_send_notifications(monkeypatch):
     mock_send_notifications.reset_mock()
 
 
+@pytest.fixture(autouse=True)
+def clear_credentials_cache():
+    credentials_cache.clear()
+    yield
+    credentials_cache.clear()
+
+
 @pytest.fixture(autouse=True)
 def test_db():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    # cached flight rows and seat maps would outlive the tables they were read from
+    flight_cache.clear()
+    seat_maps.clear()
     yield
     Base.metadata.drop_all(bind=engine)
 
 
 app.dependency_overrides[get_db] = override_get_db
 
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
 client = TestClient(app)
 
 
@@ -61,11 +103,12 @@ def mock_users():
 
 @pytest.fixture
 def add_mock_users(mock_users):
-    db = next(override_get_db())
+    db = TestingSessionLocal()
     for user_data in mock_users:
         user = models.AuthUser(username=user_data["username"], password=user_data["password"])
         db.add(user)
     db.commit()
+    db.close()
 
 
 @pytest.fixture
@@ -246,3 +289,898 @@ def test__assert_authorization_on_delete(
     assert len(json.loads(client.get('/reservations', auth=('claradavis', 'mypass')).content)) == 0
 
 
+def test__legacy_password_upgraded_to_bcrypt(test_db, add_mock_users):
+    assert client.get('/reservations', auth=('kirill', 'mypass')).status_code == 200
+    db = TestingSessionLocal()
+    user = db.query(models.AuthUser).filter(models.AuthUser.username == 'kirill').first()
+    db.close()
+    assert user.password.startswith('$2')
+    assert user.check_password('mypass')
+    credentials_cache.clear()
+    assert client.get('/reservations', auth=('kirill', 'mypass')).status_code == 200
+    assert client.get('/reservations', auth=('kirill', 'wrongpass')).status_code == 401
+
+
+def test__credentials_verified_once_while_cached(test_db, add_mock_users):
+    db = TestingSessionLocal()
+    user = db.query(models.AuthUser).filter(models.AuthUser.username == 'kirill').first()
+    user.set_password('mypass')
+    db.commit()
+    db.close()
+    with patch('src.models.bcrypt.checkpw', wraps=bcrypt.checkpw) as checkpw:
+        for _ in range(3):
+            assert client.get('/reservations', auth=('kirill', 'mypass')).status_code == 200
+        assert checkpw.call_count == 1
+        assert client.get('/reservations', auth=('kirill', 'wrongpass')).status_code == 401
+        assert client.get('/reservations', auth=('kirill', 'wrongpass')).status_code == 401
+        assert checkpw.call_count == 3
+
+
+def test__password_change_invalidates_cached_credentials(test_db, add_mock_users):
+    assert client.get('/reservations', auth=('kirill', 'mypass')).status_code == 200
+    db = TestingSessionLocal()
+    user = db.query(models.AuthUser).filter(models.AuthUser.username == 'kirill').first()
+    user.set_password('newpass')
+    db.commit()
+    db.close()
+    assert client.get('/reservations', auth=('kirill', 'mypass')).status_code == 401
+    assert client.get('/reservations', auth=('kirill', 'newpass')).status_code == 200
+
+
+def _create_reservations(reservation, count, auth):
+    for i in range(1, count + 1):
+        new_reservation = deepcopy(reservation)
+        new_reservation['passenger_info']['id'] = i
+        new_reservation['passenger_info']['email'] = f'passenger{i}@example.com'
+        new_reservation['flight_details']['flight_number'] = f'UA{i}'
+        assert client.post('/reservations', json=new_reservation, auth=auth).status_code == 200
+
+
+def test__get_reservations_keyset_pagination(reservation_passenger_kirill, test_db, add_mock_users):
+    _create_reservations(reservation_passenger_kirill, 5, ('kirill', 'mypass'))
+    res = client.get('/reservations', params={'limit': 2}, auth=('kirill', 'mypass'))
+    assert [reservation['id'] for reservation in res.json()] == [1, 2]
+    assert res.links['next']['url'].endswith('/reservations?limit=2&after_id=2')
+    res = client.get(res.links['next']['url'], auth=('kirill', 'mypass'))
+    assert [reservation['id'] for reservation in res.json()] == [3, 4]
+    res = client.get(res.links['next']['url'], auth=('kirill', 'mypass'))
+    assert [reservation['id'] for reservation in res.json()] == [5]
+    assert 'next' not in res.links
+    assert client.get('/reservations', params={'limit': 0}, auth=('kirill', 'mypass')).status_code == 422
+
+
+def test__get_reservations_ndjson_stream(reservation_passenger_kirill, test_db, add_mock_users):
+    _create_reservations(reservation_passenger_kirill, 3, ('kirill', 'mypass'))
+    res = client.get('/reservations', params={'stream': True, 'after_id': 1}, auth=('kirill', 'mypass'))
+    assert res.status_code == 200
+    assert res.headers['content-type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [reservation['id'] for reservation in lines] == [2, 3]
+    assert lines[0]['flight_details']['flight_number'] == 'UA2'
+    # read in keyset pages, continuing in the requested order and stopping at the limit
+    with patch('main.RESERVATIONS_STREAM_CHUNK', 1):
+        res = client.get('/reservations', params={'stream': True, 'sort': '-departure_datetime', 'limit': 2},
+                         auth=('kirill', 'mypass'))
+    assert [json.loads(line)['id'] for line in res.text.splitlines()] == [3, 2]
+    assert client.get('/reservations', params={'stream': True}, auth=('claradavis', 'mypass')).text == ''
+
+
+def test__fast_serialization_matches_schema(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    _create_reservations(reservation_passenger_kirill, 2, auth)
+    db = TestingSessionLocal()
+    expected = [
+        schemas.ReservationOut.model_validate(reservation).model_dump(mode='json')
+        for reservation in db.query(models.Reservation).order_by(models.Reservation.id)
+    ]
+    db.close()
+    assert client.get('/reservations', auth=auth).json() == expected
+    assert client.get('/reservations/2', auth=auth).json() == expected[1]
+    lines = client.get('/reservations', params={'stream': True}, auth=auth).text.splitlines()
+    assert [json.loads(line) for line in lines] == expected
+    paths = app.openapi()['paths']
+    list_schema = paths['/reservations']['get']['responses']['200']['content']['application/json']['schema']
+    assert list_schema['items'] == {'$ref': '#/components/schemas/ReservationOut'}
+    detail_schema = paths['/reservations/{reservation_id}']['get']['responses']['200']['content']['application/json']
+    assert detail_schema['schema'] == {'$ref': '#/components/schemas/ReservationOut'}
+
+
+def test__conditional_get_reservation(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    _create_reservations(reservation_passenger_kirill, 2, auth)
+    res = client.get('/reservations/1', auth=auth)
+    etag, last_modified = res.headers['etag'], res.headers['last-modified']
+    with count_queries() as statements:
+        res = client.get('/reservations/1', headers={'If-None-Match': etag}, auth=auth)
+    assert res.status_code == 304
+    assert res.headers['etag'] == etag
+    assert res.content == b''
+    assert len(statements) == 1
+    assert client.get('/reservations/1', headers={'If-Modified-Since': last_modified}, auth=auth).status_code == 304
+    assert client.get('/reservations/1', headers={'If-None-Match': '"other"'}, auth=auth).status_code == 200
+    # someone else's reservation is still not found
+    assert client.get('/reservations/1', headers={'If-None-Match': '*'}, auth=('claradavis', 'mypass')).status_code \
+           == 404
+    time.sleep(0.001)
+    updated_reservation = deepcopy(reservation_passenger_kirill)
+    updated_reservation['reservation_status'] = 'cancelled'
+    assert client.put('/reservations/1', json=updated_reservation, auth=auth).status_code == 200
+    res = client.get('/reservations/1', headers={'If-None-Match': etag}, auth=auth)
+    assert res.status_code == 200
+    assert res.json()['reservation_status'] == 'cancelled'
+    assert res.headers['etag'] != etag
+
+
+def test__conditional_get_reservations(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    _create_reservations(reservation_passenger_kirill, 3, auth)
+
+    def get(**params):
+        res = client.get('/reservations', params=params, auth=auth)
+        assert res.status_code == 200
+        return res.headers['etag']
+
+    etag = get()
+    assert get(limit=2) != etag
+    with count_queries() as statements:
+        res = client.get('/reservations', headers={'If-None-Match': etag}, auth=auth)
+    assert res.status_code == 304
+    assert len(statements) == 1
+    page_etag = get(limit=2)
+    assert client.get('/reservations', params={'limit': 2}, headers={'If-None-Match': page_etag}, auth=auth) \
+               .status_code == 304
+    # renaming a passenger through one reservation changes their other reservations as well
+    second_flight = deepcopy(reservation_passenger_kirill)
+    second_flight['passenger_info']['email'] = 'passenger1@example.com'
+    second_flight['flight_details']['flight_number'] = 'UA4'
+    assert client.post('/reservations', json=second_flight, auth=auth).status_code == 200
+    time.sleep(0.001)
+    second_flight['passenger_info']['full_name'] = 'Alex Smith'
+    assert client.put('/reservations/4', json=second_flight, auth=auth).status_code == 200
+    res = client.get('/reservations', params={'limit': 2}, headers={'If-None-Match': page_etag}, auth=auth)
+    assert res.status_code == 200
+    assert res.json()[0]['passenger_info']['full_name'] == 'Alex Smith'
+    etag = get()
+    assert client.delete('/reservations/2', auth=auth).status_code == 200
+    assert client.get('/reservations', headers={'If-None-Match': etag}, auth=auth).status_code == 200
+    # a delete leaves the latest update time of the page as it was, so lists have no Last-Modified to go by
+    res = client.get('/reservations', params={'limit': 3}, auth=auth)
+    assert 'last-modified' not in res.headers
+    since = conditional.http_date(datetime.now() + timedelta(days=1))
+    assert client.delete(f"/reservations/{res.json()[1]['id']}", auth=auth).status_code == 200
+    res = client.get('/reservations', params={'limit': 3}, headers={'If-Modified-Since': since}, auth=auth)
+    assert res.status_code == 200
+    assert len(res.json()) == 2
+
+
+def test__queries_per_endpoint_do_not_grow_with_reservations(
+        reservation_passenger_kirill, test_db, add_mock_users
+):
+    auth = ('kirill', 'mypass')
+    _create_reservations(reservation_passenger_kirill, 10, auth)
+    with count_queries() as statements:
+        assert len(client.get('/reservations', auth=auth).json()) == 10
+    assert len(statements) == 1
+    with count_queries() as statements:
+        assert len(client.get('/reservations', params={'limit': 5}, auth=auth).json()) == 5
+    assert len(statements) == 1
+    with count_queries() as statements:
+        assert client.get('/reservations/3', auth=auth).status_code == 200
+    assert len(statements) == 1
+    updated_reservation = deepcopy(reservation_passenger_kirill)
+    updated_reservation['passenger_info']['full_name'] = 'Alex Smith'
+    updated_reservation['reservation_status'] = 'cancelled'
+    with count_queries() as statements:
+        assert client.put('/reservations/1', json=updated_reservation, auth=auth).status_code == 200
+    # reservation with its passenger and flight, the three UPDATEs, the last_update_timestamp of the other
+    # reservations of the renamed passenger and their change feed events, the reservation's own event, the held
+    # notification to merge into (none, the e-mail changed) and the new outbox row, the reporting summary and the seat
+    # released by the cancellation
+    assert len(statements) == 11
+    with count_queries() as statements:
+        assert client.delete('/reservations/2', auth=auth).status_code == 200
+    assert len(statements) == 5
+    new_reservation = deepcopy(reservation_passenger_kirill)
+    new_reservation['passenger_info']['id'] = 11
+    new_reservation['passenger_info']['email'] = 'passenger11@example.com'
+    with count_queries() as statements:
+        assert client.post('/reservations', json=new_reservation, auth=auth).status_code == 200
+    # passenger and flight upserts, the reservation, its seat, its outbox row, its change feed event and the reporting
+    # summary; the seat map of the flight is cached since its first reservation
+    assert len(statements) == 7
+
+
+def test__create_reservations_batch(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    batch = []
+    for i in range(2, 52):
+        new_reservation = deepcopy(reservation_passenger_kirill)
+        new_reservation['passenger_info']['id'] = i
+        new_reservation['passenger_info']['email'] = f'passenger{i}@example.com'
+        new_reservation['flight_details']['flight_number'] = f'UA{i % 5}'
+        new_reservation['flight_details']['seat_information'] = f'{i}A'
+        batch.append(new_reservation)
+    invalid = deepcopy(reservation_passenger_kirill)
+    invalid['flight_details']['seat_information'] = 'window'
+    anonymous = deepcopy(reservation_passenger_kirill)
+    del anonymous['passenger_info']['id']
+    anonymous['passenger_info']['email'] = 'anonymous@example.com'
+    anonymous['flight_details']['seat_information'] = '1B'
+    # seats held before the batch and earlier in the batch
+    taken_seat = deepcopy(reservation_passenger_kirill)
+    taken_seat['passenger_info'].update(id=60, email='passenger60@example.com')
+    seat_in_batch = deepcopy(batch[0])
+    seat_in_batch['passenger_info'].update(id=61, email='passenger61@example.com')
+    batch += [invalid, deepcopy(reservation_passenger_kirill), deepcopy(batch[0]), anonymous, taken_seat, seat_in_batch]
+    with count_queries() as statements:
+        res = client.post('/reservations/batch', json=batch, auth=auth)
+    assert res.status_code == 200
+    # four lookups and one multi-row insert per table (two for passengers, with and without ids), including the
+    # change feed events, independent of the batch size
+    assert len(statements) == 12
+    results = res.json()
+    assert [result['id'] for result in results[:50]] == list(range(2, 52))
+    assert results[50]['error'][0]['loc'] == ['flight_details', 'seat_information']
+    assert results[51]['error'] == "Reservation already exists for this passenger and flight."
+    assert results[52]['error'] == "Reservation already exists for this passenger and flight."
+    assert results[53]['id'] == 52
+    assert results[54]['error'] == "Seat 22F is already taken on flight UA789."
+    assert results[55]['error'] == "Seat 2A is already taken on flight UA2."
+    reservations = client.get('/reservations', auth=auth).json()
+    assert len(reservations) == 52
+    assert reservations[9]['passenger_info']['email'] == 'passenger10@example.com'
+    assert reservations[9]['flight_details']['flight_number'] == 'UA0'
+    assert reservations[51]['passenger_info']['email'] == 'anonymous@example.com'
+    db = TestingSessionLocal()
+    assert db.query(models.FlightDetails).count() == 6
+    assert db.query(models.NotificationOutbox).count() == 52
+    db.close()
+
+
+def test__concurrent_batches_conflict(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    new_flight = deepcopy(reservation_passenger_kirill)
+    new_flight['flight_details']['flight_number'] = 'UA900'
+
+    flight = models.FlightDetails(**{
+        **new_flight['flight_details'],
+        'departure_datetime': datetime(2024, 12, 15, 9), 'arrival_datetime': datetime(2024, 12, 15, 11, 15),
+    })
+
+    def create_flight_first(conn, cursor, statement, parameters, context, executemany):
+        # another request adds the flight after the batch found it missing
+        if statement.startswith('INSERT INTO flight_details') and flight not in created:
+            created.append(flight)
+            db = TestingSessionLocal()
+            db.add(flight)
+            db.commit()
+            db.close()
+
+    created = []
+    event.listen(Engine, 'before_cursor_execute', create_flight_first)
+    try:
+        res = client.post('/reservations/batch', json=[new_flight], auth=auth)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', create_flight_first)
+    assert res.status_code == 409
+    assert len(client.get('/reservations', auth=auth).json()) == 1
+    # retried, the flight is found
+    res = client.post('/reservations/batch', json=[new_flight], auth=auth)
+    assert res.status_code == 200
+    assert res.json()[0]['id'] == 2
+
+
+def test__batch_items_documented():
+    schema = app.openapi()['paths']['/reservations/batch']['post']['requestBody']['content']['application/json']
+    assert schema['schema']['items'] == {'$ref': '#/components/schemas/Reservation'}
+
+
+def test__create_reuses_existing_passenger_and_flight(
+        reservation_passenger_kirill, reservation_passenger_claradavis, test_db, add_mock_users
+):
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=('kirill', 'mypass')).status_code == 200
+    same_passenger = deepcopy(reservation_passenger_kirill)
+    same_passenger['passenger_info']['full_name'] = 'Someone Else'
+    same_passenger['flight_details']['flight_number'] = 'UA799'
+    res = client.post('/reservations', json=same_passenger, auth=('kirill', 'mypass'))
+    assert res.status_code == 200
+    assert res.json()['passenger_info_id'] == 1
+    assert res.json()['passenger_info']['full_name'] == 'Kirill Rass'
+    same_flight = deepcopy(reservation_passenger_claradavis)
+    same_flight['passenger_info']['id'] = 2
+    same_flight['flight_details']['airline'] = 'Other Airline'
+    same_flight['flight_details']['seat_information'] = '23A'
+    res = client.post('/reservations', json=same_flight, auth=('claradavis', 'mypass'))
+    assert res.status_code == 200
+    assert res.json()['flight_details_id'] == 2
+    assert res.json()['flight_details']['airline'] == 'United Airlines'
+    taken_email = deepcopy(reservation_passenger_claradavis)
+    taken_email['passenger_info']['id'] = 3
+    taken_email['passenger_info']['email'] = 'kirill.rass@example.com'
+    taken_email['flight_details']['seat_information'] = '23B'
+    assert client.post('/reservations', json=taken_email, auth=('claradavis', 'mypass')).status_code == 400
+    db = TestingSessionLocal()
+    assert db.query(models.PassengerInfo).count() == 2
+    assert db.query(models.FlightDetails).count() == 2
+    assert db.query(models.Reservation).count() == 3
+    db.close()
+
+
+def test__flight_catalog_cache(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    same_flight = deepcopy(reservation_passenger_kirill)
+    same_flight['passenger_info']['id'] = 2
+    same_flight['passenger_info']['email'] = 'passenger2@example.com'
+    same_flight['flight_details']['seat_information'] = '23A'
+    before = client.get('/cache-stats', auth=auth).json()['flights']
+    with count_queries() as statements:
+        res = client.post('/reservations', json=same_flight, auth=auth)
+    assert res.status_code == 200
+    assert res.json()['flight_details_id'] == 1
+    # the flight upsert and the seat map query are skipped
+    assert len(statements) == 6
+    after = client.get('/cache-stats', auth=auth).json()['flights']
+    assert (after['size'], after['hits'] - before['hits'], after['misses'] - before['misses']) == (1, 1, 0)
+    updated_reservation = deepcopy(same_flight)
+    updated_reservation['flight_details']['airline'] = 'Other Airline'
+    assert client.put('/reservations/2', json=updated_reservation, auth=auth).status_code == 200
+    assert len(flight_cache) == 0
+    same_flight['passenger_info']['id'] = 3
+    same_flight['passenger_info']['email'] = 'passenger3@example.com'
+    same_flight['flight_details']['seat_information'] = '23B'
+    assert client.post('/reservations', json=same_flight, auth=auth).json()['flight_details']['airline'] \
+           == 'Other Airline'
+
+
+def test__database_metrics_per_route(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    _create_reservations(reservation_passenger_kirill, 3, auth)
+    labels = ('GET', '/reservations')
+    queries, seconds = metrics.db_queries.value(labels), metrics.db_query_time.value(labels)
+    with count_queries() as statements:
+        assert client.get('/reservations', auth=auth).status_code == 200
+    assert metrics.db_queries.value(labels) - queries == len(statements)
+    assert metrics.db_query_time.value(labels) > seconds
+
+
+def test__search_reservations(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    batch = []
+    for i in range(1, 9):
+        reservation = deepcopy(reservation_passenger_kirill)
+        reservation['passenger_info']['id'] = i
+        reservation['passenger_info']['email'] = f'passenger{i}@example.com'
+        reservation['flight_details']['flight_number'] = f'UA{i % 4}'
+        reservation['flight_details']['seat_information'] = f'{i}A'
+        reservation['flight_details']['origin_airport'] = 'PRG' if i % 4 == 0 else 'SFO'
+        reservation['flight_details']['departure_datetime'] = f'2024-12-{10 + i % 4}T09:00:00'
+        reservation['flight_details']['arrival_datetime'] = f'2024-12-{10 + i % 4}T11:00:00'
+        reservation['total_price'] = 100 + i % 3
+        reservation['reservation_status'] = 'cancelled' if i % 2 else 'confirmed'
+        batch.append(reservation)
+    assert client.post('/reservations/batch', json=batch, auth=auth).status_code == 200
+
+    def ids(**params):
+        res = client.get('/reservations', params=params, auth=auth)
+        assert res.status_code == 200, res.text
+        return [reservation['id'] for reservation in res.json()]
+
+    assert ids(reservation_status='cancelled') == [1, 3, 5, 7]
+    assert ids(reservation_status=['cancelled', 'confirmed'], limit=3) == [1, 2, 3]
+    assert ids(flight_number='UA1') == [1, 5]
+    assert ids(origin_airport='PRG') == [4, 8]
+    assert ids(origin_airport='SFO', destination_airport='SEA', reservation_status='confirmed') == [2, 6]
+    assert ids(departure_from='2024-12-11T00:00:00', departure_to='2024-12-13T00:00:00') == [1, 2, 5, 6]
+    assert ids(sort='-id', limit=3) == [8, 7, 6]
+    assert ids(sort='total_price') == [3, 6, 1, 4, 7, 2, 5, 8]
+    assert ids(sort='-departure_datetime') == [7, 3, 6, 2, 5, 1, 8, 4]
+    assert client.get('/reservations', params={'sort': 'airline'}, auth=auth).status_code == 422
+
+    # keyset pages in a non-id order, also when the last reservation of a page is deleted in between
+    res = client.get('/reservations', params={'sort': 'total_price', 'limit': 3, 'include_total': True}, auth=auth)
+    assert res.headers['x-total-count'] == '8'
+    assert [reservation['id'] for reservation in res.json()] == [3, 6, 1]
+    assert client.delete('/reservations/1', auth=auth).status_code == 200
+    res = client.get(res.links['next']['url'], auth=auth)
+    assert [reservation['id'] for reservation in res.json()] == [4, 7, 2]
+    res = client.get(res.links['next']['url'], auth=auth)
+    assert [reservation['id'] for reservation in res.json()] == [5, 8]
+    res = client.get('/reservations', params={'reservation_status': 'cancelled', 'include_total': True, 'limit': 1},
+                     auth=auth)
+    assert res.headers['x-total-count'] == '3'
+
+
+def test__incremental_report_matches_full_recompute(
+        reservation_passenger_kirill, reservation_passenger_claradavis, test_db, add_mock_users
+):
+    auth = ('kirill', 'mypass')
+    batch = []
+    for i in range(1, 21):
+        reservation = deepcopy(reservation_passenger_kirill)
+        reservation['passenger_info']['id'] = i
+        reservation['passenger_info']['email'] = f'passenger{i}@example.com'
+        reservation['flight_details']['flight_number'] = f'UA{i % 4}'
+        reservation['flight_details']['seat_information'] = f'{i}A'
+        reservation['flight_details']['airline'] = ['United Airlines', 'Lufthansa'][i % 2]
+        reservation['flight_details']['travel_class'] = ['economy', 'business', 'first'][i % 3]
+        reservation['total_price'] = 50 + i * 10.15
+        reservation['reservation_status'] = ['confirmed', 'pending', 'cancelled'][i % 3]
+        batch.append(reservation)
+    assert client.post('/reservations/batch', json=batch[:15], auth=auth).status_code == 200
+    for reservation in batch[15:]:
+        assert client.post('/reservations', json=reservation, auth=auth).status_code == 200
+    # another user's reservation on a shared flight stays out of the report
+    reservation_passenger_claradavis['passenger_info']['id'] = 100
+    reservation_passenger_claradavis['flight_details'] = {**batch[0]['flight_details'], 'seat_information': '30C'}
+    assert client.post('/reservations', json=reservation_passenger_claradavis, auth=('claradavis', 'mypass')) \
+               .status_code == 200
+    changes = [(1, 'cancelled', 75.5), (2, 'confirmed', 12.25), (3, None, 300.0), (4, 'pending', None)]
+    for reservation_id, status, price in changes:
+        updated = deepcopy(batch[reservation_id - 1])
+        updated['reservation_status'] = status or updated['reservation_status']
+        updated['total_price'] = price or updated['total_price']
+        assert client.put(f'/reservations/{reservation_id}', json=updated, auth=auth).status_code == 200
+    for reservation_id in (5, 6, 18):
+        assert client.delete(f'/reservations/{reservation_id}', auth=auth).status_code == 200
+
+    db = TestingSessionLocal()
+    user_id = db.query(models.AuthUser.id).filter(models.AuthUser.username == 'kirill').scalar()
+    dimensions = ['flight_number', 'airline', 'travel_class', 'reservation_status']
+    for group_by in [[name] for name in dimensions] + [dimensions]:
+        report = client.get('/reports/reservations', params={'group_by': group_by}, auth=auth).json()
+        expected = [
+            {**row._asdict(), 'revenue': round(row.revenue, 2)}
+            for row in db.execute(reporting.full_report_query(user_id, group_by))
+        ]
+        assert report == expected
+    assert sum(row['bookings'] for row in report) == 17
+
+    def summary_rows():
+        return sorted(
+            (row.auth_user_id, row.flight_details_id, row.reservation_status, row.bookings, round(row.revenue, 2))
+            for row in db.query(models.ReservationSummary) if row.bookings
+        )
+
+    incremental = summary_rows()
+    db.close()
+
+    async def rebuild():
+        async with AsyncTestingSessionLocal() as async_db:
+            return await reporting.rebuild(async_db)
+
+    assert asyncio.run(rebuild()) == len(incremental)
+    db = TestingSessionLocal()
+    assert summary_rows() == incremental
+    db.close()
+
+
+def test__seat_inventory(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    other = deepcopy(reservation_passenger_kirill)
+    other['passenger_info'].update(id=2, email='passenger2@example.com')
+    with count_queries() as statements:
+        res = client.post('/reservations', json=other, auth=auth)
+    # refused from the cached flight and seat map, only the check for a repeated request reads the database
+    assert res.status_code == 409
+    assert res.json()['detail'] == "Seat 22F is already taken on flight UA789."
+    assert len(statements) == 1
+    other['flight_details']['seat_information'] = '03A'
+    assert client.post('/reservations', json=other, auth=auth).json()['flight_details']['seat_information'] == '3A'
+    res = client.get('/flights/UA789/seats', auth=auth)
+    assert res.status_code == 200
+    seat_map = res.json()
+    assert (seat_map['flight_number'], seat_map['taken']) == ('UA789', ['3A', '22F'])
+    bitmap = base64.b64decode(seat_map['bitmap'])
+    assert len(bitmap) == 325
+    assert [index for index in range(len(bitmap) * 8) if bitmap[index // 8] & (1 << index % 8)] \
+           == [3 * 26 + 0, 22 * 26 + 5]
+    with count_queries() as statements:
+        assert client.get('/flights/UA789/seats', auth=auth).status_code == 200
+    assert len(statements) == 0
+    assert client.get('/flights/XX000/seats', auth=auth).status_code == 404
+
+    # moving to a taken seat is refused, cancelling and deleting release the seat
+    moved = deepcopy(other)
+    moved['flight_details']['seat_information'] = '22F'
+    assert client.put('/reservations/2', json=moved, auth=auth).status_code == 409
+    cancelled = deepcopy(reservation_passenger_kirill)
+    cancelled['reservation_status'] = 'cancelled'
+    assert client.put('/reservations/1', json=cancelled, auth=auth).status_code == 200
+    res = client.put('/reservations/2', json=moved, auth=auth)
+    assert res.status_code == 200
+    assert res.json()['flight_details']['seat_information'] == '22F'
+    assert client.get('/reservations/1', auth=auth).json()['flight_details']['seat_information'] == '22F'
+    assert client.get('/flights/UA789/seats', auth=auth).json()['taken'] == ['22F']
+    assert client.put('/reservations/1', json=reservation_passenger_kirill, auth=auth).status_code == 409
+    assert client.delete('/reservations/2', auth=auth).status_code == 200
+    assert client.get('/flights/UA789/seats', auth=auth).json()['taken'] == []
+
+    # a map gone stale in another worker process is corrected by the primary key of seat_assignments
+    third = deepcopy(reservation_passenger_kirill)
+    third['passenger_info'].update(id=3, email='passenger3@example.com')
+    assert client.put('/reservations/1', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    seat_maps.set(1, seats.SeatMap())
+    assert client.post('/reservations', json=third, auth=auth).status_code == 409
+    db = TestingSessionLocal()
+    assert db.query(models.SeatAssignment.seat_information, models.SeatAssignment.reservation_id).all() \
+           == [('22F', 1)]
+    db.close()
+
+
+def test__idempotent_create_replays_response(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    headers = {'Idempotency-Key': 'create-1'}
+    first = client.post('/reservations', json=reservation_passenger_kirill, headers=headers, auth=auth)
+    assert first.status_code == 200
+    with count_queries() as statements:
+        replayed = client.post('/reservations', json=reservation_passenger_kirill, headers=headers, auth=auth)
+    assert replayed.status_code == 200
+    assert replayed.json() == first.json()
+    assert replayed.headers['idempotent-replayed'] == 'true'
+    # the claim of the key and the read of its response, nothing else
+    assert len(statements) == 2
+    assert all('reservations' not in statement and 'notification_outbox' not in statement for statement in statements)
+    # the same key is refused for another request, the same user without a key or with another key gets a 400
+    other = deepcopy(reservation_passenger_kirill)
+    other['total_price'] = 1
+    assert client.post('/reservations', json=other, headers=headers, auth=auth).status_code == 422
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 400
+    assert client.post('/reservations', json=reservation_passenger_kirill, headers={'Idempotency-Key': 'create-2'},
+                       auth=auth).status_code == 400
+    # keys are per user, and a failed request stores nothing
+    assert client.post('/reservations', json=reservation_passenger_kirill, headers=headers,
+                       auth=('claradavis', 'mypass')).status_code == 400
+    db = TestingSessionLocal()
+    assert db.query(models.IdempotencyKey.key, models.IdempotencyKey.auth_user_id).all() == [('create-1', 2)]
+    assert db.query(models.NotificationOutbox).count() == 1
+    # an expired key is free again
+    db.query(models.IdempotencyKey).update({'creation_timestamp': datetime(2020, 1, 1)})
+    db.commit()
+    db.close()
+    assert client.post('/reservations', json=reservation_passenger_kirill, headers=headers, auth=auth).status_code \
+           == 400
+
+
+def test__concurrent_idempotent_creates_run_once(reservation_passenger_kirill, test_db, add_mock_users):
+    async def post_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test', auth=('kirill', 'mypass')) as c:
+            return await asyncio.gather(*(
+                c.post('/reservations', json=reservation_passenger_kirill, headers={'Idempotency-Key': 'retry'})
+                for _ in range(5)
+            ))
+
+    responses = asyncio.run(post_concurrently())
+    assert [response.status_code for response in responses] == [200] * 5
+    assert len({response.json()['id'] for response in responses}) == 1
+    assert sum(response.headers.get('idempotent-replayed') == 'true' for response in responses) == 4
+    db = TestingSessionLocal()
+    assert db.query(models.Reservation).count() == 1
+    assert db.query(models.NotificationOutbox).count() == 1
+    db.close()
+
+
+def test__put_if_match(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    etag = client.get('/reservations/1', auth=auth).headers['etag']
+    time.sleep(0.001)
+    updated = deepcopy(reservation_passenger_kirill)
+    updated['total_price'] = 150
+    res = client.put('/reservations/1', json=updated, headers={'If-Match': etag}, auth=auth)
+    assert res.status_code == 200
+    assert res.headers['etag'] != etag
+    assert res.headers['etag'] == client.get('/reservations/1', auth=auth).headers['etag']
+    updated['total_price'] = 200
+    res = client.put('/reservations/1', json=updated, headers={'If-Match': etag}, auth=auth)
+    assert res.status_code == 412
+    assert client.get('/reservations/1', auth=auth).json()['total_price'] == 150
+    assert client.put('/reservations/1', json=updated, headers={'If-Match': f'W/{etag}'}, auth=auth).status_code == 412
+    assert client.put('/reservations/1', json=updated, headers={'If-Match': '*'}, auth=auth).status_code == 200
+    db = TestingSessionLocal()
+    assert db.query(models.Reservation.version).scalar() == 3
+    db.close()
+
+
+def test__patch_reservation(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    etag = client.get('/reservations/1', auth=auth).headers['etag']
+    time.sleep(0.001)
+    with count_queries() as statements:
+        res = client.patch('/reservations/1', json={'reservation_status': 'pending'}, auth=auth)
+    assert res.status_code == 200
+    # the reservation read once and one UPDATE of its changed columns, its change feed event, the notification merged
+    # into the one of its creation and the reporting summary; passenger and flight rows are left alone
+    assert len(statements) == 5
+    assert [statement.split(' SET ')[0] for statement in statements if statement.startswith('UPDATE')] \
+           == ['UPDATE reservations', 'UPDATE notification_outbox']
+    assert res.json()['reservation_status'] == 'pending'
+    current = client.get('/reservations/1', auth=auth)
+    assert res.json() == current.json()
+    assert res.headers['etag'] == current.headers['etag'] != etag
+    db = TestingSessionLocal()
+    assert [outbox.message for outbox in db.query(models.NotificationOutbox)] == [
+        'Dear Kirill Rass, your reservation has been created. Details: Flight UA789, Status: pending.'
+    ]
+    assert db.query(models.Reservation.version).scalar() == 2
+    db.close()
+
+    # nested fields, the seat moves with the reservation
+    res = client.patch('/reservations/1', json={
+        'passenger_info': {'email': 'kirill@example.com'}, 'flight_details': {'seat_information': '01A'}
+    }, headers={'If-Match': current.headers['etag']}, auth=auth)
+    assert res.status_code == 200
+    assert res.json()['passenger_info']['email'] == 'kirill@example.com'
+    assert res.json()['passenger_info']['full_name'] == 'Kirill Rass'
+    assert res.json()['flight_details']['seat_information'] == '1A'
+    assert res.json() == client.get('/reservations/1', auth=auth).json()
+    assert client.get('/flights/UA789/seats', auth=auth).json()['taken'] == ['1A']
+
+    # a stale If-Match, invalid or unknown fields and other users' reservations are refused
+    assert client.patch('/reservations/1', json={'total_price': 1}, headers={'If-Match': etag}, auth=auth).status_code \
+           == 412
+    assert client.patch('/reservations/1', json={'reservation_status': 'lost'}, auth=auth).status_code == 422
+    assert client.patch('/reservations/1', json={'auth_user_id': 3}, auth=auth).status_code == 422
+    assert client.patch('/reservations/1', json={'total_price': 1}, auth=('claradavis', 'mypass')).status_code == 404
+    # nothing to change, nothing written
+    with count_queries() as statements:
+        res = client.patch('/reservations/1', json={'total_price': 99.99}, auth=auth)
+    assert res.status_code == 200
+    assert len(statements) == 1
+    # null fields are kept
+    res = client.patch('/reservations/1', json={
+        'passenger_info': {'full_name': None, 'phone_number': None}, 'reservation_status': None
+    }, auth=auth)
+    assert res.status_code == 200
+    passenger = res.json()['passenger_info']
+    assert passenger['full_name'] == 'Kirill Rass'
+    assert passenger['phone_number'] == reservation_passenger_kirill['passenger_info']['phone_number']
+    assert res.json()['reservation_status'] == 'pending'
+
+
+def test__concurrent_updates_lose_nothing(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    reservation_passenger_kirill['total_price'] = 100
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    clients, statuses = 10, []
+
+    async def add_one(c):
+        # read-modify-write of the price, retried until the update applies to the version it read
+        while True:
+            res = await c.get('/reservations/1')
+            reservation = res.json()
+            reservation['total_price'] += 1
+            res = await c.put('/reservations/1', json=reservation, headers={'If-Match': res.headers['etag']})
+            statuses.append(res.status_code)
+            if res.status_code == 200:
+                return
+            assert res.status_code in (409, 412)
+
+    async def hammer():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test', auth=auth) as c:
+            await asyncio.gather(*(add_one(c) for _ in range(clients)))
+
+    with count_queries() as statements:
+        asyncio.run(hammer())
+    assert client.get('/reservations/1', auth=auth).json()['total_price'] == 100 + clients
+    # the clients did run into each other
+    assert statuses.count(200) == clients < len(statuses)
+    # conflicts are detected by the conditional UPDATE, never by waiting on row locks
+    assert not any('FOR UPDATE' in statement for statement in statements)
+
+
+def test__create_passenger_without_id(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    reservation_passenger_kirill['passenger_info']['id'] = 5
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    anonymous = deepcopy(reservation_passenger_kirill)
+    del anonymous['passenger_info']['id']
+    anonymous['passenger_info']['email'] = 'anonymous@example.com'
+    anonymous['flight_details']['seat_information'] = '1B'
+    with count_queries() as statements:
+        res = client.post('/reservations', json=anonymous, auth=auth)
+    assert res.status_code == 200
+    # a new passenger with the next id, not resolved to an existing one by an upsert on the id
+    assert res.json()['passenger_info']['id'] == 6
+    assert res.json()['passenger_info']['email'] == 'anonymous@example.com'
+    passenger_inserts = [statement for statement in statements if statement.startswith('INSERT INTO passenger_info')]
+    assert len(passenger_inserts) == 1 and 'ON CONFLICT' not in passenger_inserts[0]
+
+
+def test__concurrent_deletes(reservation_passenger_kirill, test_db, add_mock_users):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+
+    async def delete_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test', auth=auth) as c:
+            return await asyncio.gather(*(c.delete('/reservations/1') for _ in range(5)))
+
+    statuses = sorted(response.status_code for response in asyncio.run(delete_concurrently()))
+    # one request deletes, the others find the row gone instead of failing the versioned DELETE
+    assert statuses == [200, 404, 404, 404, 404]
+    db = TestingSessionLocal()
+    assert db.query(models.Reservation).count() == 0
+    assert db.query(models.SeatAssignment).count() == 0
+    db.close()
+
+
+def test__export_reservations(reservation_passenger_kirill, test_db, add_mock_users, monkeypatch):
+    auth = ('kirill', 'mypass')
+    batch = []
+    for i in range(1, 8):
+        new_reservation = deepcopy(reservation_passenger_kirill)
+        new_reservation['passenger_info'].update(id=i, email=f'passenger{i}@example.com')
+        new_reservation['flight_details']['seat_information'] = f'{i}A'
+        batch.append(new_reservation)
+    assert client.post('/reservations/batch', json=batch, auth=auth).status_code == 200
+    other = deepcopy(reservation_passenger_kirill)
+    other['passenger_info'].update(id=20, email='passenger20@example.com')
+    other['flight_details']['seat_information'] = '20A'
+    assert client.post('/reservations', json=other, auth=('claradavis', 'mypass')).status_code == 200
+    # several chunks, each encoded and sent on its own
+    monkeypatch.setattr(export, 'EXPORT_CHUNK', 3)
+
+    res = client.get('/exports/reservations?format=csv', auth=auth)
+    assert res.status_code == 200
+    assert res.headers['content-type'].startswith('text/csv')
+    assert res.headers['content-disposition'] == 'attachment; filename="reservations.csv"'
+    header = next(csv.reader(io.StringIO(res.text)))
+    assert len(header) == len(set(header))
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert [row['id'] for row in rows] == [str(i) for i in range(1, 8)]
+    assert rows[2]['passenger_info_id'] == '3'
+    assert rows[2]['passenger_info_email'] == 'passenger3@example.com'
+    assert rows[2]['flight_details_seat_information'] == '3A'
+
+    res = client.get('/exports/reservations?format=jsonl&gzip=true', auth=auth)
+    assert res.headers['content-type'] == 'application/gzip'
+    assert res.headers['content-disposition'] == 'attachment; filename="reservations.jsonl.gz"'
+    lines = gzip.decompress(res.content).splitlines()
+    assert [json.loads(line) for line in lines] == client.get('/reservations', auth=auth).json()
+
+    # all users for admins only
+    assert client.get('/exports/reservations?all_users=true', auth=auth).status_code == 403
+    monkeypatch.setattr(settings, 'admin_usernames', ['admin'])
+    res = client.get('/exports/reservations?format=jsonl&all_users=true', auth=('admin', 'admin'))
+    assert [json.loads(line)['id'] for line in res.content.splitlines()] == list(range(1, 9))
+
+    pq = pytest.importorskip('pyarrow.parquet')
+    res = client.get('/exports/reservations?format=parquet', auth=auth)
+    assert res.headers['content-type'] == 'application/vnd.apache.parquet'
+    parquet = pq.ParquetFile(io.BytesIO(res.content))
+    assert parquet.metadata.num_row_groups == 3
+    table = parquet.read()
+    assert table.column('id').to_pylist() == list(range(1, 8))
+    assert table.column('passenger_info_email').to_pylist()[0] == 'passenger1@example.com'
+    assert isinstance(table.column('creation_timestamp').to_pylist()[0], datetime)
+    # readers that look columns up by name need them to be unique
+    table = pq.read_table(io.BytesIO(res.content))
+    assert len(table.column_names) == len(set(table.column_names))
+    assert table.column('passenger_info_id').to_pylist() == list(range(1, 8))
+
+
+def test__export_holds_no_connection_between_chunks(reservation_passenger_kirill, test_db, add_mock_users,
+                                                    monkeypatch):
+    _create_reservations(reservation_passenger_kirill, 5, ('kirill', 'mypass'))
+    monkeypatch.setattr(export, 'EXPORT_CHUNK', 2)
+
+    async def read_while_paused():
+        # a single connection, as a slow client would hold it
+        engine = make_engine("sqlite+aiosqlite:///./test.db", Settings(db_pool_size=1, db_max_overflow=0,
+                                                                        db_pool_timeout=1))
+        try:
+            query = export.export_query()
+            chunks = export.read_chunks(engine, query)
+            ids = [row.id for row in await anext(chunks)]
+            async with AsyncSession(engine) as db:
+                assert await db.scalar(select(func.count()).select_from(models.Reservation)) == 5
+            async for chunk in chunks:
+                ids += [row.id for row in chunk]
+            return ids
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(read_while_paused()) == [1, 2, 3, 4, 5]
+
+
+def test__export_cli(reservation_passenger_kirill, test_db, add_mock_users, tmp_path):
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=('kirill', 'mypass')).status_code == 200
+    output = tmp_path / 'reservations.jsonl.gz'
+    with open(output, 'wb') as file:
+        asyncio.run(export.export_to_file(
+            file, 'jsonl', username='kirill', compress=True, url="sqlite+aiosqlite:///./test.db"
+        ))
+    exported = [json.loads(line) for line in gzip.decompress(output.read_bytes()).splitlines()]
+    assert exported == client.get('/reservations', auth=('kirill', 'mypass')).json()
+    with open(output, 'wb') as file:
+        asyncio.run(export.export_to_file(file, 'csv', username='claradavis', url="sqlite+aiosqlite:///./test.db"))
+    assert output.read_text().count('\n') == 1
+
+
+def test__bulk_import(reservation_passenger_kirill, test_db, add_mock_users, tmp_path):
+    auth = ('kirill', 'mypass')
+    assert client.post('/reservations', json=reservation_passenger_kirill, auth=auth).status_code == 200
+    records = []
+    for i in range(2, 9):
+        record = deepcopy(reservation_passenger_kirill)
+        record['passenger_info'].update(id=i, email=f'passenger{i}@example.com')
+        record['flight_details'].update(flight_number=f'UA{i % 3}', seat_information=f'{i}A')
+        records.append(record)
+    records[0]['creation_timestamp'] = '2020-01-02T03:04:05'
+    anonymous = deepcopy(reservation_passenger_kirill)
+    del anonymous['passenger_info']['id']
+    anonymous['passenger_info']['email'] = 'anonymous@example.com'
+    anonymous['flight_details']['seat_information'] = '30A'
+    # the same passenger without an id, on another flight
+    anonymous_again = deepcopy(anonymous)
+    anonymous_again['flight_details'].update(flight_number='UA2', seat_information='31A')
+    taken_seat = deepcopy(reservation_passenger_kirill)
+    taken_seat['passenger_info'].update(id=40, email='passenger40@example.com')
+    taken_email = deepcopy(records[1])
+    taken_email['passenger_info']['id'] = 41
+    taken_email['flight_details']['seat_information'] = '41A'
+    invalid = deepcopy(records[2])
+    invalid['flight_details']['seat_information'] = 'window'
+    records += [anonymous, anonymous_again, deepcopy(records[3]), taken_seat, taken_email, invalid]
+    path = tmp_path / 'reservations.jsonl'
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records) + 'not json\n')
+    errors = io.StringIO()
+    progress = []
+
+    stats = asyncio.run(importer.import_file(
+        str(path), 'kirill', chunk_size=4, workers=1, errors=errors, url="sqlite+aiosqlite:///./test.db",
+        progress=lambda stats: progress.append(stats.records),
+    ))
+    assert (stats.records, stats.imported, stats.skipped, stats.rejected) == (14, 9, 1, 4)
+    assert progress == [4, 8, 12, 14]
+    assert [(error['record'], error['error']) for error in map(json.loads, errors.getvalue().splitlines())
+            if isinstance(error['error'], str)][:2] == [
+        (11, "Seat 22F is already taken on flight UA789."),
+        (12, "Passenger email is already registered."),
+    ]
+    reservations = client.get('/reservations', auth=auth).json()
+    assert len(reservations) == 10
+    assert reservations[1]['creation_timestamp'] == '2020-01-02T03:04:05'
+    assert reservations[1]['flight_details']['seat_information'] == '2A'
+    assert reservations[8]['passenger_info_id'] == reservations[9]['passenger_info_id']
+    assert client.get('/flights/UA2/seats', auth=auth).json()['taken'] == ['2A', '5A', '8A', '31A']
+    report = client.get('/reports/reservations', auth=auth).json()
+    assert sum(row['bookings'] for row in report) == 10
+
+    # a repeated import skips what is there, --resume does not even read the committed records
+    stats = asyncio.run(importer.import_file(str(path), 'kirill', workers=0, url="sqlite+aiosqlite:///./test.db"))
+    assert (stats.imported, stats.skipped, stats.rejected) == (0, 10, 4)
+    stats = asyncio.run(importer.import_file(
+        str(path), 'kirill', workers=0, resume=True, url="sqlite+aiosqlite:///./test.db"
+    ))
+    assert (stats.records, stats.imported, stats.skipped, stats.rejected) == (0, 0, 0, 0)
+
+    # exports import again
+    export_path = tmp_path / 'reservations.csv.gz'
+    with open(export_path, 'wb') as file:
+        asyncio.run(export.export_to_file(
+            file, 'csv', username='kirill', compress=True, url="sqlite+aiosqlite:///./test.db"
+        ))
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    credentials_cache.clear()
+    seat_maps.clear()
+    flight_cache.clear()
+    db = TestingSessionLocal()
+    db.add(models.AuthUser(username='kirill', password='bXlwYXNz'))
+    db.commit()
+    db.close()
+    stats = asyncio.run(importer.import_file(str(export_path), 'kirill', url="sqlite+aiosqlite:///./test.db"))
+    assert (stats.imported, stats.rejected) == (10, 0)
+    def content(reservation):
+        # ids of the user and of new flights are assigned anew
+        return {k: v for k, v in reservation.items() if k not in ('auth_user_id', 'flight_details_id')}
+
+    assert [content(r) for r in client.get('/reservations', auth=auth).json()] == [content(r) for r in reservations]
@@ -0,0 +1,52 @@
+from src.cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test__entries_expire_after_ttl():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set('a', 1)
+    timer.now = 4.9
+    assert cache.get('a') == 1
+    timer.now = 5
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test__least_recently_used_entry_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test__discard_where():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('a', {'username': 'kirill'})
+    cache.set('b', {'username': 'admin'})
+    assert cache.discard_where(lambda key, value: value['username'] == 'kirill') == 1
+    assert cache.get('a') is None
+    assert cache.get('b') == {'username': 'admin'}
+
+
+def test__hit_miss_and_eviction_counters():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=1, ttl=5, timer=timer)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    cache.set('b', 2)
+    timer.now = 5
+    assert cache.get('b') is None
+    assert cache.stats() == {'size': 0, 'maxsize': 1, 'hits': 1, 'misses': 2, 'evictions': 1}
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from src.database import make_engine
+from src.email_notify import NotificationDispatcher
+from src.settings import Settings
+
+
+def test__sqlite_engine_applies_pragmas(tmp_path):
+    config = Settings(sqlite_busy_timeout_ms=1234, sqlite_cache_size_kib=2048)
+
+    async def pragmas():
+        engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'tuned.db'}", config)
+        async with engine.connect() as conn:
+            values = [
+                (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+                for name in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size')
+            ]
+        await engine.dispose()
+        return values
+
+    # synchronous=NORMAL is reported as 1
+    assert asyncio.run(pragmas()) == ['wal', 1, 1234, -2048]
+
+
+def test__engine_settings_from_environment(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgresql+asyncpg://booking:secret@db/booking')
+    monkeypatch.setenv('DB_POOL_SIZE', '25')
+    monkeypatch.setenv('DB_STATEMENT_TIMEOUT_MS', '5000')
+    config = Settings()
+    engine = make_engine(config=config)
+    assert engine.dialect.name == 'postgresql'
+    assert engine.pool.size() == 25
+    assert engine.pool._pre_ping
+    monkeypatch.delenv('DB_POOL_SIZE')
+    sqlite_engine = make_engine("sqlite+aiosqlite:///./unused.db", Settings())
+    assert sqlite_engine.pool.size() == 5
+
+
+def test__sqlite_long_read_does_not_block_others(tmp_path):
+    async def read_while_writing():
+        engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'busy.db'}", Settings(db_pool_timeout=2))
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+                await conn.execute(text("INSERT INTO items (id) VALUES (:id)"), [{'id': i} for i in range(1000)])
+            async with engine.connect() as reader:
+                # a read paused half way, as a stream to a slow client is
+                result = await reader.stream(text("SELECT id FROM items ORDER BY id"))
+                first = await result.fetchmany(10)
+                async with engine.begin() as writer:
+                    await writer.execute(text("INSERT INTO items (id) VALUES (1000)"))
+                async with engine.connect() as other:
+                    count = (await other.execute(text("SELECT count(*) FROM items"))).scalar()
+                rest = await result.fetchall()
+            return len(first) + len(rest), count
+        finally:
+            await engine.dispose()
+
+    # the write and the other read completed meanwhile, the paused read kept its snapshot
+    assert asyncio.run(read_while_writing()) == (1000, 1001)
+
+
+def test__outbox_claim_skips_locked_rows_on_postgresql():
+    query = NotificationDispatcher(None)._due_ids(datetime(2024, 12, 15))
+    assert 'FOR UPDATE SKIP LOCKED' in str(query.compile(dialect=postgresql.dialect()))
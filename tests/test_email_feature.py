@@ -1,11 +1,24 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pytest
+from sqlalchemy import func, select
 from src.database import Base, get_db
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
 from fastapi.testclient import TestClient
 from main import app
 from unittest.mock import AsyncMock, call, patch
+from src.catalog import flight_cache
+from src.seats import seat_maps
+from src.metrics import instrument_engine, notification_send_duration
 from src import models
+from src.email_notify import NotificationDispatcher, TokenBucket, enqueue_notification
+from src.settings import settings
 from copy import deepcopy
 
 
@@ -15,25 +28,37 @@ engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+instrument_engine(async_engine)
+AsyncTestingSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
 
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        Base.metadata.create_all(bind=db.bind)
+async def override_get_db():
+    async with AsyncTestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @pytest.fixture(autouse=True)
 def test_db():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    # cached flight rows and seat maps would outlive the tables they were read from
+    flight_cache.clear()
+    seat_maps.clear()
     yield
     Base.metadata.drop_all(bind=engine)
 
 
+@pytest.fixture(autouse=True)
+def no_coalescing(monkeypatch):
+    # notifications are due at once, unless a test sets a window
+    monkeypatch.setattr(settings, 'notification_coalesce_seconds', 0)
+
+
+def deliver_notifications(**dispatcher_kwargs):
+    return asyncio.run(NotificationDispatcher(AsyncTestingSessionLocal, **dispatcher_kwargs).drain())
+
+
 app.dependency_overrides[get_db] = override_get_db
 
 client = TestClient(app)
@@ -50,11 +75,12 @@ def mock_users():
 
 @pytest.fixture
 def add_mock_users(mock_users):
-    db = next(override_get_db())
+    db = TestingSessionLocal()
     for user_data in mock_users:
         user = models.AuthUser(username=user_data["username"], password=user_data["password"])
         db.add(user)
     db.commit()
+    db.close()
 
 
 @pytest.fixture
@@ -113,6 +139,8 @@ def test__email_send_on_creation(reservation_passenger_kirill, test_db, add_mock
             json=reservation_passenger_kirill,
             auth=('kirill', 'mypass')
         ).status_code == 200
+        assert mock_send_notification.mock_calls == []
+        assert deliver_notifications() == 1
         assert call(
             'kirill.rass@example.com', 'Dear Kirill Rass, your reservation has been created. Details: Flight UA789, Status: pending.'
         ) in mock_send_notification.mock_calls
@@ -134,6 +162,7 @@ def test__email_send_on_update_status(reservation_passenger_kirill, test_db, add
             json=updated_reservation,
             auth=('kirill', 'mypass')
         ).status_code == 200
+        assert deliver_notifications() == 2
 
         assert call(
             'kirill.rass@example.com',
@@ -157,6 +186,7 @@ def test__email_not_send_on_regular_update(reservation_passenger_kirill, test_db
             json=updated_reservation,
             auth=('kirill', 'mypass')
         ).status_code == 200
+        assert deliver_notifications() == 1
         assert call(
             'kirill.rass@example.com',
             'Dear Kirill Rass, your reservation has been created. Details: Flight UA789, Status: pending.'
@@ -165,3 +195,195 @@ def test__email_not_send_on_regular_update(reservation_passenger_kirill, test_db
             'kirill.rass@example.com',
             'Dear Kirill Rass, your reservation has been updated. Details: Flight UA789, Status: confirmed.'
         ) in mock_send_notification.mock_calls
+
+
+def _outbox_statuses():
+    db = TestingSessionLocal()
+    statuses = [row.status for row in db.query(models.NotificationOutbox).order_by(models.NotificationOutbox.id)]
+    db.close()
+    return statuses
+
+
+def test__failed_delivery_retried(reservation_passenger_kirill, test_db, add_mock_users):
+    mock_send_notification = AsyncMock(side_effect=[Exception('gateway down'), None])
+    with patch('src.email_notify.send_notification', mock_send_notification):
+        assert client.post(
+            '/reservations',
+            json=reservation_passenger_kirill,
+            auth=('kirill', 'mypass')
+        ).status_code == 200
+        assert _outbox_statuses() == ['pending']
+        sent, errors = notification_send_duration.count(('sent',)), notification_send_duration.count(('error',))
+        assert deliver_notifications(backoff_base=0) == 1
+    assert mock_send_notification.await_count == 2
+    assert _outbox_statuses() == ['sent']
+    assert notification_send_duration.count(('sent',)) == sent + 1
+    assert notification_send_duration.count(('error',)) == errors + 1
+
+
+def test__delivery_gives_up_after_max_attempts(reservation_passenger_kirill, test_db, add_mock_users):
+    mock_send_notification = AsyncMock(side_effect=Exception('gateway down'))
+    with patch('src.email_notify.send_notification', mock_send_notification):
+        assert client.post(
+            '/reservations',
+            json=reservation_passenger_kirill,
+            auth=('kirill', 'mypass')
+        ).status_code == 200
+        assert deliver_notifications(backoff_base=0, max_attempts=3) == 0
+    assert mock_send_notification.await_count == 3
+    assert _outbox_statuses() == ['failed']
+
+
+@pytest.fixture
+def mail_gateway():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(self.rfile.read(int(self.headers['Content-Length'])))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 128
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    with patch('src.email_notify.mock_url', f'http://127.0.0.1:{server.server_address[1]}/post'):
+        yield received
+    server.shutdown()
+    server.server_close()
+
+
+def test__delivery_throughput_against_local_gateway(test_db, mail_gateway):
+    total = 300
+    db = TestingSessionLocal()
+    passenger = models.PassengerInfo(full_name='Kirill Rass', email='kirill.rass@example.com', phone_number='+12123334455')
+    flight = models.FlightDetails(flight_number='UA789')
+    for i in range(total):
+        passenger.email = f'passenger{i}@example.com'
+        enqueue_notification(db, passenger, flight, 'pending', 'created')
+    db.commit()
+    db.close()
+
+    async def deliver_all():
+        # the gateway's throughput, without the overall rate limit
+        dispatcher = NotificationDispatcher(AsyncTestingSessionLocal, concurrency=16, send_rate=0)
+        started = time.perf_counter()
+        await dispatcher.start()
+        dispatcher.wake()
+        while True:
+            async with AsyncTestingSessionLocal() as session:
+                pending = await session.scalar(select(func.count()).select_from(models.NotificationOutbox).filter(
+                    models.NotificationOutbox.status != 'sent'
+                ))
+            if not pending or time.perf_counter() - started > 30:
+                break
+            await asyncio.sleep(0.05)
+        await dispatcher.stop()
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(deliver_all())
+    assert len(mail_gateway) == total
+    assert set(_outbox_statuses()) == {'sent'}
+    # about 300/s on one CPU, far below that the deliveries are no longer concurrent and pooled
+    assert total / elapsed > 50
+
+
+def test__notifications_coalesced(reservation_passenger_kirill, test_db, add_mock_users, monkeypatch):
+    monkeypatch.setattr(settings, 'notification_coalesce_seconds', 0.5)
+    mock_send_notification = AsyncMock()
+    with patch('src.email_notify.send_notification', mock_send_notification):
+        assert client.post('/reservations', json=reservation_passenger_kirill, auth=('kirill', 'mypass')).status_code == 200
+        updated_reservation = deepcopy(reservation_passenger_kirill)
+        for status in ('confirmed', 'cancelled'):
+            updated_reservation['reservation_status'] = status
+            assert client.put('/reservations/1', json=updated_reservation, auth=('kirill', 'mypass')).status_code == 200
+        assert _outbox_statuses() == ['pending']
+        # held for the window
+        assert deliver_notifications() == 0
+        time.sleep(0.6)
+        assert deliver_notifications() == 1
+    assert mock_send_notification.mock_calls == [call(
+        'kirill.rass@example.com', 'Dear Kirill Rass, your reservation has been created. Details: Flight UA789, Status: cancelled.'
+    )]
+
+    # a notification already sent is not changed, the next change is held again
+    updated_reservation['reservation_status'] = 'confirmed'
+    assert client.put('/reservations/1', json=updated_reservation, auth=('kirill', 'mypass')).status_code == 200
+    assert _outbox_statuses() == ['sent', 'pending']
+
+
+def test__recipient_rate_limit(test_db):
+    db = TestingSessionLocal()
+    passenger = models.PassengerInfo(full_name='Kirill Rass', email='kirill.rass@example.com', phone_number='+12123334455')
+    flight = models.FlightDetails(flight_number='UA789')
+    for _ in range(3):
+        enqueue_notification(db, passenger, flight, 'pending', 'created')
+    db.commit()
+    db.close()
+    mock_send_notification = AsyncMock()
+    with patch('src.email_notify.send_notification', mock_send_notification):
+        assert deliver_notifications(recipient_rate=1 / 60, recipient_burst=2) == 2
+    assert mock_send_notification.await_count == 2
+    db = TestingSessionLocal()
+    postponed = db.query(models.NotificationOutbox).filter(models.NotificationOutbox.status == 'pending').one()
+    # postponed until the recipient has a token again, without using up an attempt
+    assert postponed.attempts == 0
+    assert postponed.next_attempt_at > datetime.now() + timedelta(seconds=50)
+    db.close()
+
+
+def test__postponed_rows_come_back_one_turn_each(test_db):
+    total = 12
+    db = TestingSessionLocal()
+    passenger = models.PassengerInfo(full_name='Kirill Rass', email='kirill.rass@example.com', phone_number='+12123334455')
+    for i in range(total):
+        enqueue_notification(db, passenger, models.FlightDetails(flight_number=f'UA{i}'), 'pending', 'created')
+    db.commit()
+    db.close()
+    claimed = []
+
+    async def deliver_all():
+        dispatcher = NotificationDispatcher(
+            AsyncTestingSessionLocal, recipient_rate=5, recipient_burst=2, send_rate=0, poll_interval=0.5
+        )
+        claim_batch = dispatcher._claim_batch
+
+        async def counted_claim_batch():
+            rows = await claim_batch()
+            claimed.extend(row.id for row in rows)
+            return rows
+
+        dispatcher._claim_batch = counted_claim_batch
+        started = time.perf_counter()
+        while _outbox_statuses().count('sent') < total and time.perf_counter() - started < 10:
+            await dispatcher.drain()
+            await asyncio.sleep(await dispatcher._until_next_due())
+
+    mock_send_notification = AsyncMock()
+    with patch('src.email_notify.send_notification', mock_send_notification):
+        asyncio.run(deliver_all())
+    # sent in the order they were queued, every postponed row claimed again only once its turn came
+    assert [c.args[1].split('Flight ')[1].split(',')[0] for c in mock_send_notification.mock_calls] \
+           == [f'UA{i}' for i in range(total)]
+    assert len(claimed) < 2 * total
+
+
+def test__token_bucket():
+    bucket = TokenBucket(10, 2)
+    assert [bucket.try_take(), bucket.try_take()] == [0, 0]
+    assert 0.05 < bucket.try_take() <= 0.1
+    # reserved tokens queue up behind each other
+    waits = [bucket.reserve() for _ in range(3)]
+    assert waits == sorted(waits) and 0.25 < waits[-1] <= 0.3
+    # turns of refused requests follow each other, one token apart
+    turns = TokenBucket(10, 1)
+    turns.try_take()
+    first, second = turns.schedule(), turns.schedule()
+    assert 0.09 < first <= 0.1 and abs(second - first - 0.1) < 0.001
@@ -0,0 +1,142 @@
+import base64
+import threading
+import time
+from copy import deepcopy
+from unittest.mock import AsyncMock
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.websockets import WebSocketDisconnect
+from main import app
+from src import feed, models
+from src.auth import credentials_cache
+from src.catalog import flight_cache
+from src.feed import change_feed
+from src.seats import seat_maps
+from src.settings import settings
+
+
+@pytest.fixture
+def feed_client(tmp_path, monkeypatch):
+    """The app with its lifespan, so the change feed runs, on a database of its own."""
+    monkeypatch.setattr(settings, 'database_url', f"sqlite+aiosqlite:///{tmp_path / 'feed.db'}")
+    monkeypatch.setattr(app, 'dependency_overrides', {})
+    monkeypatch.setattr('src.email_notify.send_notification', AsyncMock())
+    with TestClient(app) as client:
+        engine = create_engine(f"sqlite:///{tmp_path / 'feed.db'}")
+        db = sessionmaker(bind=engine)()
+        db.add_all([
+            models.AuthUser(username='kirill', password='bXlwYXNz'),
+            models.AuthUser(username='claradavis', password='bXlwYXNz'),
+        ])
+        db.commit()
+        db.close()
+        engine.dispose()
+        yield client
+    credentials_cache.clear()
+    flight_cache.clear()
+    seat_maps.clear()
+
+
+def basic_auth(username: str, password: str = 'mypass'):
+    return {'Authorization': 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()}
+
+
+def wait_until(condition, timeout: float = 5):
+    # the app runs in the test client's thread, WebSocket sessions are closed without waiting for it
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def reservation(i: int) -> dict:
+    return {
+        "passenger_info": {
+            "id": i, "full_name": "Kirill Rass", "email": f"passenger{i}@example.com", "phone_number": "+12123334455"
+        },
+        "flight_details": {
+            "flight_number": "UA789",
+            "airline": "United Airlines",
+            "origin_airport": "SFO",
+            "destination_airport": "SEA",
+            "departure_datetime": "2024-12-15T09:00:00",
+            "arrival_datetime": "2024-12-15T11:30:00",
+            "seat_information": f"{i}F",
+            "travel_class": "economy"
+        },
+        "total_price": 99.99,
+        "reservation_status": "confirmed"
+    }
+
+
+def test__websocket_feed(feed_client):
+    auth = ('kirill', 'mypass')
+    with feed_client.websocket_connect('/feeds/reservations', headers=basic_auth('kirill')) as websocket:
+        created = feed_client.post('/reservations', json=reservation(1), auth=auth).json()
+        event = websocket.receive_json()
+        first_sequence = event['sequence']
+        assert (event['event'], event['reservation_id']) == ('created', created['id'])
+        assert event['reservation'] == feed_client.get(f"/reservations/{created['id']}", auth=auth).json()
+        # other users' changes are not sent
+        assert feed_client.post('/reservations', json=reservation(2), auth=('claradavis', 'mypass')).status_code == 200
+        updated = deepcopy(reservation(1))
+        updated['reservation_status'] = 'pending'
+        assert feed_client.put(f"/reservations/{created['id']}", json=updated, auth=auth).status_code == 200
+        event = websocket.receive_json()
+        assert event['event'] == 'updated'
+        assert event['reservation']['reservation_status'] == 'pending'
+        assert feed_client.delete(f"/reservations/{created['id']}", auth=auth).status_code == 200
+        deleted = websocket.receive_json()
+        assert (deleted['event'], deleted['reservation_id'], deleted['reservation']) == ('deleted', created['id'], None)
+    assert wait_until(lambda: change_feed.subscribers == 0)
+
+    # resumed after the first event, from the table
+    with feed_client.websocket_connect(
+            f'/feeds/reservations?after={first_sequence}', headers=basic_auth('kirill')
+    ) as websocket:
+        assert [websocket.receive_json()['event'] for _ in range(2)] == ['updated', 'deleted']
+
+    with pytest.raises(WebSocketDisconnect) as refused:
+        with feed_client.websocket_connect('/feeds/reservations', headers=basic_auth('kirill', 'wrong')):
+            pass
+    assert refused.value.code == 1008
+
+
+def test__lagging_subscriber_is_closed(feed_client, monkeypatch):
+    auth = ('kirill', 'mypass')
+    monkeypatch.setattr(feed, 'FEED_QUEUE_SIZE', 2)
+    with feed_client.websocket_connect('/feeds/reservations', headers=basic_auth('kirill')) as websocket:
+        # published by one poll, before the subscriber gets to read any of them
+        results = feed_client.post('/reservations/batch', json=[reservation(i) for i in range(1, 6)], auth=auth).json()
+        with pytest.raises(WebSocketDisconnect) as closed:
+            while True:
+                websocket.receive_json()
+        assert closed.value.code == 1013
+    with feed_client.websocket_connect('/feeds/reservations?after=0', headers=basic_auth('kirill')) as websocket:
+        assert [websocket.receive_json()['reservation_id'] for _ in range(5)] == [result['id'] for result in results]
+
+
+def test__server_sent_events(feed_client):
+    auth = ('kirill', 'mypass')
+    first = feed_client.post('/reservations', json=reservation(1), auth=auth).json()
+    responses = []
+    # the stream only ends with the app, read it to the end in another thread
+    reader = threading.Thread(target=lambda: responses.append(
+        feed_client.get('/feeds/reservations', headers={'Last-Event-ID': '0'}, auth=auth)
+    ))
+    reader.start()
+    assert wait_until(lambda: change_feed.subscribers == 1)
+    second = feed_client.post('/reservations', json=reservation(2), auth=auth).json()
+    # sent before the app shuts down, which closes the stream
+    time.sleep(0.2)
+    feed_client.__exit__(None, None, None)
+    reader.join(5)
+    response = responses[0]
+    assert response.headers['content-type'].startswith('text/event-stream')
+    messages = [message.split('\n') for message in response.text.strip().split('\n\n')]
+    assert [message[:2] for message in messages[:2]] == [['id: 1', 'event: created'], ['id: 2', 'event: created']]
+    assert f'"reservation_id":{first["id"]}' in messages[0][2]
+    assert f'"reservation_id":{second["id"]}' in messages[1][2]
+    assert messages[2] == ['event: closed', 'data: {"reason":"shutdown"}']
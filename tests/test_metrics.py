@@ -0,0 +1,60 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from main import app
+from src import metrics
+from src.metrics import Counter, Histogram, Registry
+
+
+def test__render_prometheus_text():
+    registry = Registry()
+    requests = registry.register(Counter('requests_total', 'Requests.', ('route',)))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0)))
+    requests.inc(('/a"b',))
+    requests.inc(('/a"b',), 2)
+    latency.observe((), 0.05)
+    latency.observe((), 0.5)
+    latency.observe((), 5)
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{route="/a\\"b"} 3',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+    ]) + '\n'
+
+
+def test__requests_recorded_by_route_template():
+    client = TestClient(app)
+    labels = ('GET', '/reservations/{reservation_id}')
+    before = metrics.http_requests.value(labels + (401,)), metrics.http_request_duration.count(labels)
+    assert client.get('/reservations/1').status_code == 401
+    assert client.get('/reservations/2').status_code == 401
+    assert client.get('/no-such-route').status_code == 404
+    assert metrics.http_requests.value(labels + (401,)) == before[0] + 2
+    assert metrics.http_request_duration.count(labels) == before[1] + 2
+    assert metrics.http_requests.value(('GET', 'unmatched', 404)) >= 1
+    assert metrics.http_requests_in_flight.value() == 0
+    res = client.get('/metrics')
+    assert res.headers['content-type'].startswith('text/plain')
+    assert 'http_requests_total{method="GET",route="/reservations/{reservation_id}",status="401"}' in res.text
+    assert 'cache_lookups_total{cache="flights",result="miss"}' in res.text
+
+
+def test__failed_queries_not_left_timing():
+    engine = create_engine('sqlite://')
+    metrics.instrument_engine(engine)
+    count = metrics.db_query_duration.count(())
+    with engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.execute(text('SELECT * FROM no_such_table'))
+        assert conn.info['metrics_query_started'] == []
+        conn.execute(text('SELECT 1'))
+        assert conn.info['metrics_query_started'] == []
+    assert metrics.db_query_duration.count(()) == count + 1
@@ -0,0 +1,166 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import sqlite
+from src import models, migrations
+from src.email_notify import notification_dispatcher
+from src.conditional import page_validators_query
+from src.search import ReservationSearch
+from main import _user_reservations
+
+
+@pytest.fixture
+def migrated_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrated.db'}")
+    with engine.begin() as conn:
+        migrations.upgrade(conn)
+    yield engine
+    engine.dispose()
+
+
+def _indexes(engine):
+    inspector = inspect(engine)
+    return {
+        table: {index['name']: (tuple(index['column_names']), bool(index['unique']))
+                for index in inspector.get_indexes(table)}
+        for table in inspector.get_table_names() if table != 'schema_version'
+    }
+
+
+def test__migrations_match_models(migrated_engine, tmp_path):
+    models_engine = create_engine(f"sqlite:///{tmp_path / 'models.db'}")
+    models.Base.metadata.create_all(models_engine)
+    assert _indexes(migrated_engine) == _indexes(models_engine)
+    for table in models.Base.metadata.tables:
+        assert {c['name'] for c in inspect(migrated_engine).get_columns(table)} \
+               == {c['name'] for c in inspect(models_engine).get_columns(table)}
+    models_engine.dispose()
+
+
+def test__upgrade_is_idempotent(migrated_engine):
+    with migrated_engine.begin() as conn:
+        assert migrations.upgrade(conn) == []
+        assert conn.execute(text("SELECT max(version) FROM schema_version")).scalar() == migrations.MIGRATIONS[-1][0]
+
+
+def test__upgrade_existing_database_without_version_table(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        migrations.MIGRATIONS[0][2](conn)
+        conn.execute(text("INSERT INTO auth_user (username, password) VALUES ('admin', 'YWRtaW4=')"))
+    with engine.begin() as conn:
+        assert migrations.upgrade(conn) == [version for version, _, _ in migrations.MIGRATIONS]
+        assert conn.execute(text("SELECT username FROM auth_user")).scalar() == 'admin'
+    assert 'ux_reservations_passenger_flight' in _indexes(engine)['reservations']
+    engine.dispose()
+
+
+def test__seat_inventory_backfill(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'seats.db'}")
+    with engine.begin() as conn:
+        for _, _, migration in migrations.MIGRATIONS[:5]:
+            migration(conn)
+        conn.execute(text("INSERT INTO auth_user (username, password) VALUES ('admin', 'YWRtaW4=')"))
+        conn.execute(text(
+            "INSERT INTO flight_details (flight_number, airline, origin_airport, destination_airport, "
+            "departure_datetime, arrival_datetime, seat_information, travel_class) "
+            "VALUES ('UA789', 'United', 'SFO', 'SEA', '2024-12-15 09:00:00', '2024-12-15 11:00:00', '07C', 'economy')"
+        ))
+        for passenger, status in [(1, 'cancelled'), (2, 'confirmed'), (3, 'pending')]:
+            conn.execute(text(
+                f"INSERT INTO passenger_info (id, full_name, email, phone_number) "
+                f"VALUES ({passenger}, 'A B', 'p{passenger}@example.com', '+123456789')"
+            ))
+            conn.execute(text(
+                f"INSERT INTO reservations (total_price, reservation_status, passenger_info_id, flight_details_id, "
+                f"auth_user_id) VALUES (10, '{status}', {passenger}, 1, 1)"
+            ))
+        migrations.MIGRATIONS[5][2](conn)
+        assert conn.execute(text("SELECT DISTINCT seat_information FROM reservations")).scalars().all() == ['7C']
+        # the seat stays with the first reservation holding it, cancelled ones hold none
+        assert conn.execute(text("SELECT flight_details_id, seat_information, reservation_id FROM seat_assignments")) \
+                   .all() == [(1, '7C', 2)]
+    engine.dispose()
+
+
+def _query_plan(engine, query):
+    compiled = query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))]
+
+
+def _assert_indexed(plan):
+    assert not [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step], plan
+    assert not [step for step in plan if 'TEMP B-TREE' in step], plan
+
+
+@pytest.mark.parametrize('query', [
+    pytest.param(_user_reservations(1).order_by(models.Reservation.id).limit(50), id='list'),
+    pytest.param(
+        _user_reservations(1).filter(models.Reservation.id > 100).order_by(models.Reservation.id).limit(50),
+        id='list_after_id'
+    ),
+    pytest.param(_user_reservations(1).filter(models.Reservation.id == 7), id='detail'),
+    pytest.param(
+        models.FlightDetails.__table__.select().filter(models.FlightDetails.flight_number == 'UA789'),
+        id='flight_by_number'
+    ),
+    pytest.param(
+        models.Reservation.__table__.select().filter(
+            models.Reservation.passenger_info_id == 1, models.Reservation.flight_details_id == 2
+        ),
+        id='duplicate_check'
+    ),
+])
+def test__hot_queries_use_indexes(migrated_engine, query):
+    _assert_indexed(_query_plan(migrated_engine, query))
+
+
+@pytest.mark.parametrize('query', [
+    pytest.param(
+        page_validators_query(
+            _user_reservations(1).with_only_columns(models.Reservation.id, models.Reservation.last_update_timestamp)
+            .filter(models.Reservation.id > 100).order_by(models.Reservation.id).limit(50)
+        ),
+        id='list'
+    ),
+    pytest.param(
+        _user_reservations(1).with_only_columns(models.Reservation.last_update_timestamp)
+        .filter(models.Reservation.id == 7),
+        id='detail'
+    ),
+])
+def test__conditional_get_checks_are_index_only(migrated_engine, query):
+    plan = _query_plan(migrated_engine, query)
+    # reservations are only read through the covering index or a single primary key lookup,
+    # the list aggregate then scans its own page-sized subquery
+    reservation_steps = [step for step in plan if 'reservations' in step]
+    assert reservation_steps, plan
+    assert all(
+        'COVERING INDEX ix_reservations_auth_user_id_id_updated' in step or 'INTEGER PRIMARY KEY (rowid=?)' in step
+        for step in reservation_steps
+    ), plan
+
+
+def _search(**filters):
+    params = dict(
+        reservation_status=None, flight_number=None, origin_airport=None, destination_airport=None,
+        departure_from=None, departure_to=None, sort='id', include_total=False
+    )
+    return ReservationSearch(**{**params, **filters})
+
+
+@pytest.mark.parametrize('search', [
+    pytest.param(_search(reservation_status=['pending', 'confirmed']), id='status'),
+    pytest.param(_search(flight_number='UA789'), id='flight_number'),
+    pytest.param(_search(origin_airport='SFO', destination_airport='SEA'), id='route'),
+    pytest.param(_search(departure_from=datetime(2024, 12, 1), departure_to=datetime(2025, 1, 1)), id='departure'),
+])
+def test__search_filters_use_indexes(migrated_engine, search):
+    _assert_indexed(_query_plan(migrated_engine, search.page(search.apply(_user_reservations(1)), 10, 50)))
+    _assert_indexed(_query_plan(migrated_engine, search.count(1)))
+
+
+def test__outbox_claim_uses_index(migrated_engine):
+    plan = _query_plan(migrated_engine, notification_dispatcher._due_ids(datetime(2024, 12, 15)))
+    _assert_indexed(plan)
@@ -0,0 +1,22 @@
+from fastapi.testclient import TestClient
+from main import app
+from src import email_notify
+from src.settings import settings
+
+
+def test__liveness():
+    assert TestClient(app).get('/health/live').json() == {'status': 'ok'}
+
+
+def test__lifespan_owns_worker_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'database_url', f"sqlite+aiosqlite:///{tmp_path / 'worker.db'}")
+    client = TestClient(app)
+    with client:
+        assert client.get('/health/ready').json() == {'status': 'ok'}
+        assert str(app.state.engine.url).endswith('worker.db')
+        assert email_notify.notification_dispatcher._task is not None
+        assert email_notify._http_client is not None
+    assert app.state.ready is False
+    assert email_notify.notification_dispatcher._task is None
+    assert email_notify._http_client is None
+    assert (tmp_path / 'worker.db').exists()